@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+bench_host_analysis.py - Micro-benchmarks of the host-side analysis code
+
+Feeds the functions that analyze test output on the host with synthetic
+inputs of increasing size and reports the run time and peak memory of
+each case:
+
+* rv_audio.verify_recording - raw recordings of 1 minute up to 2 hours
+* rv_input.analyze_results - keycode dumps
+* utils_spice TCP table parsing used by verify_established - /proc/net/tcp
+  and netstat dumps with up to tens of thousands of sockets
+* utils_spice.gen_rv_file - .vv files with large CA certificates
+* rv_smartcard.check_pklogin_output - pklogin_finder output with many certs
+
+No VMs are needed. When virttest/autotest are not installed, the few names
+the analysis code imports from them are replaced by inert placeholders.
+Each case runs in a forked child, so peak memory is measured per case.
+
+Usage: bench_host_analysis.py [-r REPEAT] [-m MAX_MINUTES] [-s SUITE]
+                              [--json FILE]
+"""
+import os
+import sys
+import imp
+import time
+import json
+import types
+import random
+import shutil
+import logging
+import resource
+import tempfile
+import optparse
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "tests")
+
+# Bytes per second of the recordings checked by rv_audio (44.1kHz, 16 bit,
+# stereo)
+AUDIO_RATE = 44100 * 2 * 2
+
+
+def _placeholder(name, **attrs):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, module)
+    for key, value in attrs.items():
+        if not hasattr(module, key):
+            setattr(module, key, value)
+    return module
+
+
+def _exceptions(*names):
+    return dict((name, type(name, (Exception,), {})) for name in names)
+
+
+def load_test_modules():
+    """
+    Import the spice test modules needed by the benchmarks.
+
+    :return: dict mapping module names to modules
+    """
+    for name in ("autotest", "autotest.client", "autotest.client.shared"):
+        try:
+            __import__(name)
+        except ImportError:
+            _placeholder(name)
+    try:
+        __import__("autotest.client.shared.error")
+        __import__("autotest.client.shared.utils")
+    except ImportError:
+        _placeholder("autotest.client.shared.error",
+                     **_exceptions("TestFail", "TestError", "TestNAError",
+                                   "TestWarn"))
+        _placeholder("autotest.client.shared.utils", InterruptedThread=None)
+
+    shell_errors = _exceptions("ShellError", "ShellCmdError",
+                               "ShellStatusError", "ShellTimeoutError",
+                               "ShellProcessTerminatedError")
+    try:
+        __import__("aexpect")
+    except ImportError:
+        _placeholder("aexpect", **shell_errors)
+    try:
+        __import__("virttest")
+    except ImportError:
+        _placeholder("virttest")
+    _placeholder("virttest.aexpect", **shell_errors)
+    _placeholder("virttest.utils_net",
+                 get_host_ip_address=lambda params: "192.168.122.1")
+    for name in ("utils_misc", "remote", "data_dir"):
+        _placeholder("virttest." + name)
+    _placeholder("virttest.qemu_monitor",
+                 QMPMonitor=type("QMPMonitor", (object,), {}),
+                 **_exceptions("QMPCmdError"))
+
+    modules = {}
+    for name in ("utils_spice", "rv_audio", "rv_input", "rv_smartcard"):
+        module = imp.load_source(name, os.path.join(TESTS_DIR, name + ".py"))
+        if name == "utils_spice":
+            # Test modules do "from virttest import utils_spice"
+            sys.modules["virttest.utils_spice"] = module
+            sys.modules["virttest"].utils_spice = module
+        modules[name] = module
+    return modules
+
+
+class FakeVM(object):
+
+    """Minimal VM object providing what gen_rv_file() reads"""
+
+    name = "guest"
+
+    def __init__(self, ssl):
+        self.spice = {"spice_port": "5900", "spice_ssl": ssl,
+                      "spice_tls_port": "5901"}
+
+    def get_spice_var(self, name):
+        return self.spice.get(name)
+
+
+def write_recording(path, seconds, pauses):
+    """
+    Write a raw recording made of noise interrupted by silent pauses.
+
+    :param path: path of the file
+    :param seconds: length of the recording in seconds
+    :param pauses: number of pauses longer than the default threshold
+    """
+    rand = random.Random(seconds)
+    noise = "".join(chr(rand.randint(1, 255)) for _ in xrange(AUDIO_RATE))
+    silence = "\0" * 30000
+    pause_at = set(rand.sample(xrange(seconds), min(pauses, seconds)))
+    out = open(path, "wb")
+    try:
+        for second in xrange(seconds):
+            if second in pause_at:
+                out.write(silence + noise[len(silence):])
+            else:
+                out.write(noise)
+    finally:
+        out.close()
+
+
+def gen_proc_net_tcp(sockets, port=5900):
+    """
+    Return /proc/net/tcp content with the given number of sockets, a few of
+    them connected to the spice port.
+    """
+    lines = ["  sl  local_address rem_address   st tx_queue rx_queue tr "
+             "tm->when retrnsmt   uid  timeout inode"]
+    for i in xrange(sockets):
+        remote_port = port if i % 100 == 0 else 1024 + i % 60000
+        lines.append("%4d: 0501A8C0:%04X 0101A8C0:%04X 01 00000000:00000000 "
+                     "00:00000000 00000000  1000        0 %d 1 "
+                     "ffff880000000000 20 4 30 10 -1"
+                     % (i, 30000 + i % 30000, remote_port, 10000 + i))
+    return "\n".join(lines) + "\n"
+
+
+def gen_socket_owners(sockets, pid=4242):
+    """
+    Return the PID/inode listing parsed by parse_socket_owners().
+    """
+    return "".join("%d %d\n" % (pid, 10000 + i)
+                   for i in xrange(0, sockets, 100))
+
+
+def gen_netstat_windows(sockets, port=5900):
+    """
+    Return "netstat -n" output of a windows client.
+    """
+    lines = ["", "Active Connections", "",
+             "  Proto  Local Address          Foreign Address        State"]
+    for i in xrange(sockets):
+        remote_port = port if i % 100 == 0 else 1024 + i % 60000
+        lines.append("  TCP    192.168.1.5:%d      192.168.1.1:%d    "
+                     "ESTABLISHED" % (30000 + i % 30000, remote_port))
+    return "\r\n".join(lines)
+
+
+def gen_pklogin_output(certs):
+    """
+    Return pklogin_finder output listing the given number of certificates.
+    """
+    parts = ["DEBUG:pam_config.c:239: Using config file pam_pkcs11.conf\n",
+             "Found 1 slot(s)\n"]
+    for i in xrange(certs):
+        parts.append("Certificate #%d:\n- Subject:   CN=cert%d\n"
+                     "- Issuer:    CN=cert%d\n- Algorithm: PKCS #1 RSA\n"
+                     % (i + 1, i, i))
+    return "".join(parts)
+
+
+def gen_cacert(kbytes):
+    """
+    Return PEM looking certificate data of the given size.
+    """
+    line = "MIIDazCCAlOgAwIBAgIJAJ5rYqMpR1vzMA0GCSqGSIb3DQEBCwUAMEwxCzAJBgNV\n"
+    body = line * (kbytes * 1024 / len(line) + 1)
+    return ("-----BEGIN CERTIFICATE-----\n" + body +
+            "-----END CERTIFICATE-----\n")
+
+
+def build_cases(modules, workdir, max_minutes):
+    """
+    Return list of (suite, case name, setup, function) tuples. setup() is
+    called in the parent and its result is passed to function() in the
+    child.
+    """
+    utils_spice = modules["utils_spice"]
+    rv_audio = modules["rv_audio"]
+    rv_input = modules["rv_input"]
+    rv_smartcard = modules["rv_smartcard"]
+    cases = []
+
+    for minutes in (1, 10, 30, 60, 120):
+        if minutes > max_minutes:
+            continue
+        path = os.path.join(workdir, "rec-%dmin.raw" % minutes)
+
+        def setup(path=path, minutes=minutes):
+            write_recording(path, minutes * 60, minutes)
+            return path
+
+        cases.append(("audio", "verify_recording %3d min" % minutes, setup,
+                      lambda path: rv_audio.verify_recording(
+                          path, {"rv_audio_threshold": "25000"})))
+
+    for keys in (60, 10000, 1000000):
+        path = os.path.join(workdir, "keys-%d.txt" % keys)
+
+        def setup(path=path, keys=keys):
+            out = open(path, "w")
+            out.write("\n".join(["65307", "49", "50"] +
+                                ["97"] * (keys - 3)))
+            out.close()
+            return path
+
+        cases.append(("input", "analyze_results %7d keys" % keys, setup,
+                      lambda path: rv_input.analyze_results(
+                          path, "type_and_func_keys")))
+
+    for sockets in (100, 1000, 10000, 50000):
+        def setup(sockets=sockets):
+            return (gen_proc_net_tcp(sockets) + utils_spice._OWNERS_MARK +
+                    "\n" + gen_socket_owners(sockets))
+
+        def parse_linux(output):
+            table, owners = output.split(utils_spice._OWNERS_MARK)
+            conns = utils_spice.parse_proc_net_tcp(
+                table, utils_spice.parse_socket_owners(owners))
+            return utils_spice._check_established(
+                conns, set([4242]), "192.168.1.1", 5900, None)
+
+        cases.append(("tcp", "parse_proc_net_tcp %6d sockets" % sockets,
+                      setup, parse_linux))
+        cases.append(("tcp", "parse_netstat_windows %6d sockets" % sockets,
+                      lambda sockets=sockets: gen_netstat_windows(sockets),
+                      utils_spice.parse_netstat_windows))
+
+    for kbytes in (2, 64, 1024):
+        path = os.path.join(workdir, "cacert-%dk.pem" % kbytes)
+
+        def setup(path=path, kbytes=kbytes):
+            out = open(path, "w")
+            out.write(gen_cacert(kbytes))
+            out.close()
+            return path
+
+        def gen_file(path):
+            params = {"display": "spice", "full_screen": "yes",
+                      "spice_password": "12456"}
+            utils_spice.gen_rv_file(params, FakeVM("yes"),
+                                    "C=CZ,O=Red Hat,CN=host", path)
+
+        cases.append(("rvfile", "gen_rv_file %5d kB cacert" % kbytes,
+                      setup, gen_file))
+
+    for certs in (2, 100, 2000):
+        names = ["cert%d" % i for i in xrange(certs)]
+        cases.append(("smartcard", "check_pklogin_output %5d certs" % certs,
+                      lambda certs=certs: gen_pklogin_output(certs),
+                      lambda output, names=names:
+                      rv_smartcard.check_pklogin_output(
+                          output, "Found 1 slot(s)", names, "Certificate #",
+                          "Issuer", "Algorithm")))
+    return cases
+
+
+def run_case(func, data, repeat):
+    """
+    Run func(data) repeat times in a forked child.
+
+    :return: tuple (best time in seconds, peak RSS in kB, baseline RSS in kB)
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            best = None
+            for _ in xrange(repeat):
+                start = time.time()
+                func(data)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, json.dumps([best, peak, base]))
+        except Exception, err:
+            os.write(write_fd, json.dumps(str(err)))
+            status = 1
+        os.close(write_fd)
+        os._exit(status)
+
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    result = json.loads("".join(chunks))
+    if not isinstance(result, list):
+        raise RuntimeError(result)
+    return tuple(result)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each case, the best is reported "
+                           "[default: %default]")
+    parser.add_option("-m", "--max-minutes", type="int", default=10,
+                      help="longest recording to benchmark, up to 120 "
+                           "[default: %default]")
+    parser.add_option("-s", "--suite", action="append", default=[],
+                      help="run only the given suite (audio, input, tcp, "
+                           "rvfile, smartcard), may be repeated")
+    parser.add_option("--json", help="write the results to a JSON file")
+    options, _ = parser.parse_args()
+
+    # The analysis code logs heavily; keep the benchmark output readable
+    logging.basicConfig(level=logging.CRITICAL)
+    modules = load_test_modules()
+
+    workdir = tempfile.mkdtemp(prefix="spice-bench-")
+    cwd = os.getcwd()
+    # gen_rv_file() writes into the current directory
+    os.chdir(workdir)
+    results = []
+    try:
+        print "%-10s %-42s %10s %12s %12s" % ("suite", "case", "time [s]",
+                                              "peak [kB]", "delta [kB]")
+        for suite, name, setup, func in build_cases(modules, workdir,
+                                                    options.max_minutes):
+            if options.suite and suite not in options.suite:
+                continue
+            data = setup()
+            try:
+                best, peak, base = run_case(func, data, options.repeat)
+            except RuntimeError, err:
+                print "%-10s %-42s FAILED: %s" % (suite, name, err)
+                continue
+            finally:
+                if isinstance(data, str) and data.startswith(workdir):
+                    os.unlink(data)
+            print "%-10s %-42s %10.4f %12d %12d" % (suite, name, best, peak,
+                                                    peak - base)
+            sys.stdout.flush()
+            results.append({"suite": suite, "case": name, "time": best,
+                            "peak_rss_kb": peak, "delta_rss_kb": peak - base})
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.json:
+        out = open(options.json, "w")
+        json.dump(results, out, indent=2)
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
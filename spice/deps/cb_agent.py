@@ -0,0 +1,101 @@
+"""
+cb_agent.py - long running clipboard agent
+
+Keeps one interpreter with GTK initialized in the X session and runs the
+clipboard scripts (cb.py, cb_status.py) inside it, so a clipboard
+operation costs only the clipboard work itself. Content placed into the
+clipboard stays owned by the agent until it quits.
+
+Commands are read from stdin as JSON lines, every answer is one line
+prefixed by "CBAGENT " and carries the "id" of its command:
+
+    {"cmd": "run", "id": 1, "script": "/tmp/cb.py", "argv": ["--clear"]}
+    CBAGENT {"id": 1, "status": 0, "output": "..."}
+    {"cmd": "quit", "id": 2}
+
+Usage: python cb_agent.py
+"""
+import sys
+import json
+import runpy
+import traceback
+import StringIO
+import gobject
+import gtk
+
+PREFIX = "CBAGENT"
+
+
+def reply(data):
+    """
+    Write one answer line to the real stdout.
+    """
+    sys.__stdout__.write("%s %s\n" % (PREFIX, json.dumps(data)))
+    sys.__stdout__.flush()
+
+
+def run_script(script, argv):
+    """
+    Run script as __main__ with argv, capturing what it prints.
+
+    :param script: path of the clipboard script
+    :param argv: list of arguments
+    :return: dict with the exit status and the output of the script
+    """
+    output = StringIO.StringIO()
+    status = 0
+    sys.argv = [script] + list(argv)
+    sys.stdout = sys.stderr = output
+    try:
+        try:
+            runpy.run_path(script, run_name="__main__")
+        except SystemExit, err:
+            if err.code and not isinstance(err.code, int):
+                output.write("%s\n" % err.code)
+                status = 1
+            else:
+                status = err.code or 0
+        except Exception:
+            traceback.print_exc(file=output)
+            status = 1
+    finally:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+    return {"status": status, "output": output.getvalue()}
+
+
+def handle(source, condition):
+    """
+    Answer one command from stdin; stop the main loop on quit or EOF.
+    """
+    line = sys.stdin.readline()
+    if not line:
+        gtk.main_quit()
+        return False
+    line = line.strip()
+    if not line.startswith("{"):
+        return True
+    try:
+        command = json.loads(line)
+    except ValueError, err:
+        reply({"error": "invalid command: %s" % err})
+        return True
+    if command.get("cmd") == "quit":
+        answer = {"status": 0}
+    elif command.get("cmd") == "run":
+        answer = run_script(command["script"], command.get("argv", []))
+    else:
+        answer = {"error": "unknown command %s" % command.get("cmd")}
+    if "id" in command:
+        answer["id"] = command["id"]
+    reply(answer)
+    if command.get("cmd") == "quit":
+        gtk.main_quit()
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    gobject.io_add_watch(sys.stdin, gobject.IO_IN | gobject.IO_HUP, handle)
+    reply({"status": 0, "ready": True})
+    gtk.main()
@@ -0,0 +1,80 @@
+"""
+cb_status.py - report what the clipboard of the X session currently offers
+
+Prints the targets the clipboard offers, so a paste can be started as soon
+as the data is available. Only the targets are asked for: the SPICE agent
+transfers the content itself each time it is requested.
+
+With --digest the content is hashed instead and one JSON line with the
+targets, size and digest is printed; --save writes the content to a file
+as well. Text is hashed as GTK returns it, whole. Images are hashed as PNG
+encoded from the clipboard pixbuf, the way the clipboard script saves
+them; the encoder output is hashed chunk by chunk as it is produced.
+
+Usage: python cb_status.py [--digest md5|sha256] [--save PATH] text|image
+"""
+import sys
+import json
+import hashlib
+import optparse
+import gtk
+
+
+def clipboard_targets():
+    """
+    Return the targets the clipboard offers, without reading its content.
+    """
+    return gtk.clipboard_get().wait_for_targets() or []
+
+
+def clipboard_digest(kind, algorithm, save=None):
+    """
+    Hash the clipboard content, optionally saving it.
+
+    :param kind: "text" or "image"
+    :param algorithm: hashlib algorithm name, e.g. md5 or sha256
+    :param save: path the content is written to as well
+    :return: dict with targets, size, algorithm and digest
+    """
+    clipboard = gtk.clipboard_get()
+    targets = clipboard.wait_for_targets() or []
+    digest = hashlib.new(algorithm)
+    output = open(save, "wb") if save else None
+    size = [0]
+
+    def consume(chunk):
+        digest.update(chunk)
+        size[0] += len(chunk)
+        if output:
+            output.write(chunk)
+        return True
+
+    try:
+        if kind == "text":
+            text = clipboard.wait_for_text()
+            if text:
+                consume(text)
+        else:
+            pixbuf = clipboard.wait_for_image()
+            if pixbuf is not None:
+                pixbuf.save_to_callback(consume, "png")
+    finally:
+        if output:
+            output.close()
+    return {"targets": targets, "size": size[0],
+            "algorithm": algorithm, "digest": digest.hexdigest()}
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--digest", help="hash the content with DIGEST")
+    parser.add_option("--save", help="write the content to SAVE as well")
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ("text", "image"):
+        parser.print_usage()
+        sys.exit(1)
+    if options.digest:
+        print json.dumps(clipboard_digest(args[0], options.digest,
+                                          options.save))
+    else:
+        print "targets: %s" % " ".join(clipboard_targets())
@@ -0,0 +1,47 @@
+"""
+gen_image.py - generate a test image for the clipboard tests
+
+Creates an image of the given resolution and format inside the VM, either
+flat (one color, compresses to almost nothing) or noise (random pixels,
+incompressible), so large images need not be copied from the host.
+
+Usage: python gen_image.py WIDTH HEIGHT png|bmp flat|noise PATH
+"""
+import os
+import sys
+import gtk
+
+# Color of flat images, RGBA
+FLAT_COLOR = 0x3366ccff
+
+
+def generate(width, height, image_format, pattern, path):
+    """
+    Write an image to path and return its size in bytes.
+
+    :param width: width in pixels
+    :param height: height in pixels
+    :param image_format: "png" or "bmp"
+    :param pattern: "flat" or "noise"
+    :param path: destination of the image
+    """
+    if pattern == "noise":
+        pixbuf = gtk.gdk.pixbuf_new_from_data(os.urandom(width * height * 3),
+                                              gtk.gdk.COLORSPACE_RGB, False,
+                                              8, width, height, width * 3)
+    else:
+        pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width,
+                                height)
+        pixbuf.fill(FLAT_COLOR)
+    pixbuf.save(path, image_format)
+    return os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) != 6 or sys.argv[3] not in ("png", "bmp") or
+            sys.argv[4] not in ("flat", "noise")):
+        print __doc__
+        sys.exit(1)
+    size = generate(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3],
+                    sys.argv[4], sys.argv[5])
+    print "Image generated: %s %d bytes" % (sys.argv[5], size)
@@ -0,0 +1,115 @@
+"""
+proc_sampler.py - sample resource usage of named processes
+
+Reads /proc at a fixed interval and appends one CSV row per matching
+process with its CPU time, RSS, number of open file descriptors and
+context switches, until interrupted (SIGINT or SIGTERM). Descriptors of
+processes owned by other users are only visible to root; -1 is written
+when they cannot be counted.
+
+Usage: python proc_sampler.py [--interval SECONDS] [--output PATH] NAME...
+"""
+import os
+import sys
+import csv
+import time
+import signal
+import optparse
+
+FIELDS = ["time", "pid", "name", "cpu", "rss", "fds", "voluntary_ctxt",
+          "nonvoluntary_ctxt"]
+
+TICKS = float(os.sysconf("SC_CLK_TCK"))
+
+
+def read_process(pid):
+    """
+    Return (name, cpu seconds, status dict) of a process.
+
+    :param pid: process id as a string
+    """
+    stat = open("/proc/%s/stat" % pid).read()
+    name = stat[stat.index("(") + 1:stat.rindex(")")]
+    # utime and stime are the 14th and 15th field
+    fields = stat[stat.rindex(")") + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / TICKS
+    status = {}
+    for line in open("/proc/%s/status" % pid):
+        key, _, value = line.partition(":")
+        status[key] = value.split()
+    return name, cpu, status
+
+
+def count_fds(pid):
+    """
+    Return number of open file descriptors of a process or -1.
+
+    :param pid: process id as a string
+    """
+    try:
+        return len(os.listdir("/proc/%s/fd" % pid))
+    except OSError:
+        return -1
+
+
+def sample(names):
+    """
+    Return a list of rows, one for every running process of names.
+
+    :param names: list of process names (as in /proc/PID/stat)
+    """
+    now = time.time()
+    rows = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            name, cpu, status = read_process(pid)
+            if name not in names:
+                continue
+            rows.append([
+                "%.3f" % now, pid, name, "%.2f" % cpu,
+                status.get("VmRSS", ["0"])[0], count_fds(pid),
+                status.get("voluntary_ctxt_switches", ["0"])[0],
+                status.get("nonvoluntary_ctxt_switches", ["0"])[0]])
+        except (IOError, OSError, ValueError):
+            # The process exited while being read
+            continue
+    return rows
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] NAME...")
+    parser.add_option("--interval", type="float", default=1.0,
+                      help="seconds between samples")
+    parser.add_option("--output", default="/tmp/proc_sampler.csv",
+                      help="CSV file to write")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no process name given")
+    # Names in /proc/PID/stat are cut to 15 characters
+    wanted = set(name[:15] for name in args)
+
+    signal.signal(signal.SIGTERM, interrupt)
+    out = open(options.output, "w")
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    out.flush()
+    count = 0
+    print "proc_sampler: started"
+    sys.stdout.flush()
+    try:
+        while True:
+            start = time.time()
+            writer.writerows(sample(wanted))
+            out.flush()
+            count += 1
+            time.sleep(max(0, options.interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    out.close()
+    print "proc_sampler: %d samples" % count
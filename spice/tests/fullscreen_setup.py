@@ -10,6 +10,7 @@ import logging
 from virttest import utils_spice
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Simple test for Remote Desktop connection
@@ -22,23 +23,21 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Get necessary params
     test_timeout = float(params.get("test_timeout", 600))
 
-    utils_spice.wait_timeout(20)
-
-    for vm in params.get("vms").split():
-        utils_spice.clear_interface(env.get_vm(vm),
-                                    int(params.get("login_timeout", "360")))
-
-    utils_spice.wait_timeout(20)
+    utils_spice.clear_interfaces([env.get_vm(vm)
+                                  for vm in params.get("vms").split()],
+                                 int(params.get("login_timeout", "360")))
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
-    guest_root_session = guest_vm.wait_for_login(username="root",
-                                                 password="123456")
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
+    guest_root_session = utils_spice.lease_session(guest_vm, username="root",
+                                                   password="123456")
 
     logging.debug("Exporting guest display")
     guest_session.cmd("export DISPLAY=:0.0")
@@ -74,8 +73,9 @@ def run(test, params, env):
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
-    client_session.close()
-    guest_session.close()
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_session)
+    utils_spice.release_session(guest_root_session)
@@ -7,6 +7,7 @@ Requires: rv_connect test
 """
 import logging
 from autotest.client.shared import error, utils
+from virttest import utils_spice
 
 
 def verify_recording(recording, params):
@@ -67,42 +68,38 @@ def verify_recording(recording, params):
     return True
 
 
+@utils_spice.traced_test
 def run(test, params, env):
 
+    utils_spice.reset_sessions()
+
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
-
-    if(guest_session.cmd_status("ls %s" % params.get("audio_tgt"))):
-        print params.get("audio_src")
-        print params.get("audio_tgt")
-        guest_vm.copy_files_to(
-            params.get("audio_src"),
-            params.get("audio_tgt"))
-    if(client_session.cmd_status("ls %s" % params.get("audio_tgt"))):
-        client_vm.copy_files_to(
-            params.get("audio_src"),
-            params.get("audio_tgt"))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
+
+    utils_spice.deploy_assets([guest_vm, client_vm],
+                              [(params.get("audio_src"),
+                                params.get("audio_tgt"))])
 
     if params.get("rv_record") == "yes":
         logging.info("rv_record set; Testing recording")
-        player = client_vm.wait_for_login(
-            timeout=int(params.get("login_timeout", 360)))
-        recorder_session = guest_vm.wait_for_login(
-            timeout=int(params.get("login_timeout", 360)))
+        player = utils_spice.lease_session(
+            client_vm, timeout=int(params.get("login_timeout", 360)))
+        recorder_session = utils_spice.lease_session(
+            guest_vm, timeout=int(params.get("login_timeout", 360)))
         recorder_session_vm = guest_vm
     else:
         logging.info("rv_record not set; Testing playback")
-        player = guest_vm.wait_for_login(
-            timeout=int(params.get("login_timeout", 360)))
-        recorder_session = client_vm.wait_for_login(
-            timeout=int(params.get("login_timeout", 360)))
+        player = utils_spice.lease_session(
+            guest_vm, timeout=int(params.get("login_timeout", 360)))
+        recorder_session = utils_spice.lease_session(
+            client_vm, timeout=int(params.get("login_timeout", 360)))
         recorder_session_vm = client_vm
 
     player.cmd("aplay %s &> /dev/null &" %  # starts playback
@@ -122,5 +119,8 @@ def run(test, params, env):
 
     recorder_session_vm.copy_files_from(
         params.get("audio_rec"), "./recorded.wav")
+
+    for session in (player, recorder_session, client_session, guest_session):
+        utils_spice.release_session(session)
     if not verify_recording("./recorded.wav", params):
         raise error.TestFail("Test failed")
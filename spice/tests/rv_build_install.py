@@ -25,40 +25,47 @@ def connect_to_vm(vm_name, env, params):
 
     vm = env.get_vm(params[vm_name + "_vm"])
     vm.verify_alive()
-    vm_root_session = vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    vm_root_session = utils_spice.lease_session(
+        vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
     logging.info("VM %s is up and running" % vm_name)
     return (vm, vm_root_session)
 
 
-def install_req_pkgs(pkgsRequired, vm_root_session, params):
+def install_req_pkgs(pkgsRequired, vm, vm_root_session, params):
     """
     Checks to see if packages are installed and if not, installs the package
 
     :params rpms_to_install: List of packages to check
+    :params vm: VM object
     :params vm_root_session: Session object of VM
     :param params: Dictionary with test parameters.
     """
 
-    for pkgName in pkgsRequired:
-        logging.info("Checking to see if %s is installed" % pkgName)
+    logging.info("Checking to see if %s are installed",
+                 ", ".join(pkgsRequired))
+    installed = utils_spice.get_guest_facts(vm, vm_root_session)["rpms"]
+    missing = [pkgName for pkgName in pkgsRequired
+               if pkgName not in installed]
+    for pkgName in missing:
+        rpm = params.get(re.sub("-", "_", pkgName) + "_url")
+        logging.info("Installing %s from %s" % (pkgName, rpm))
         try:
-            vm_root_session.cmd("rpm -q %s" % pkgName)
+            vm_root_session.cmd("yum -y localinstall %s" % rpm,
+                                timeout=300)
         except ShellCmdError:
-            rpm = params.get(re.sub("-", "_", pkgName) + "_url")
-            logging.info("Installing %s from %s" % (pkgName, rpm))
-            try:
-                vm_root_session.cmd("yum -y localinstall %s" % rpm,
-                                    timeout=300)
-            except ShellCmdError:
-                logging.info("Could not install %s" % pkgName)
+            logging.info("Could not install %s" % pkgName)
+    if missing:
+        # The list of installed packages is stale now
+        utils_spice.drop_guest_facts(vm)
 
 
-def build_install_spiceprotocol(vm_root_session, vm_script_path, params):
+def build_install_spiceprotocol(vm, vm_root_session, vm_script_path,
+                                params):
     """
     Build and install spice-protocol in the VM
 
+    :param vm: VM object.
     :param vm_root_session:  VM Session object.
     :param vm_script_path: path where to find build_install.py script
     :param params: Dictionary with test parameters.
@@ -70,10 +77,11 @@ def build_install_spiceprotocol(vm_root_session, vm_script_path, params):
         raise error.TestFail("spice-protocol was not installed properly")
 
 
-def build_install_qxl(vm_root_session, vm_script_path, params):
+def build_install_qxl(vm, vm_root_session, vm_script_path, params):
     """
     Build and install QXL in the VM
 
+    :param vm: VM object.
     :param vm_root_session:  VM Session object.
     :param vm_script_path: path where to find build_install.py script
     :param params: Dictionary with test parameters.
@@ -82,7 +90,7 @@ def build_install_qxl(vm_root_session, vm_script_path, params):
     # Checking to see if required packages exist and if not, install them
     pkgsRequired = ["libpciaccess-devel", "xorg-x11-util-macros",
                     "xorg-x11-server-devel"]
-    install_req_pkgs(pkgsRequired, vm_root_session, params)
+    install_req_pkgs(pkgsRequired, vm, vm_root_session, params)
 
     output = vm_root_session.cmd("%s -p xf86-video-qxl" % (vm_script_path),
                                  timeout=600)
@@ -91,17 +99,18 @@ def build_install_qxl(vm_root_session, vm_script_path, params):
         raise error.TestFail("qxl was not installed properly")
 
 
-def build_install_virtviewer(vm_root_session, vm_script_path, params):
+def build_install_virtviewer(vm, vm_root_session, vm_script_path, params):
     """
     Build and install virt-viewer in the VM
 
+    :param vm: VM object.
     :param vm_root_session:  VM Session object.
     :param vm_script_path: path where to find build_install.py script
     :param params: Dictionary with test parameters.
     """
 
     # Building spice-gtk from tarball before building virt-viewer
-    build_install_spicegtk(vm_root_session, vm_script_path, params)
+    build_install_spicegtk(vm, vm_root_session, vm_script_path, params)
 
     try:
         output = vm_root_session.cmd("killall remote-viewer")
@@ -115,13 +124,14 @@ def build_install_virtviewer(vm_root_session, vm_script_path, params):
     except ShellCmdError, err:
         logging.error("virt-viewer package couldn't be removed! " + err.output)
 
-    if "release 7" in vm_root_session.cmd("cat /etc/redhat-release"):
+    facts = utils_spice.get_guest_facts(vm, vm_root_session)
+    if facts["release_major"] == "7":
         pkgsRequired = ["libogg-devel", "celt051-devel",
                         "spice-glib-devel", "spice-gtk3-devel"]
     else:
         pkgsRequired = ["libogg-devel", "celt051-devel"]
 
-    install_req_pkgs(pkgsRequired, vm_root_session, params)
+    install_req_pkgs(pkgsRequired, vm, vm_root_session, params)
 
     output = vm_root_session.cmd("%s -p virt-viewer" % (vm_script_path),
                                  timeout=600)
@@ -143,10 +153,11 @@ def build_install_virtviewer(vm_root_session, vm_script_path, params):
         logging.error("Can't get version number!" + err.output)
 
 
-def build_install_spicegtk(vm_root_session, vm_script_path, params):
+def build_install_spicegtk(vm, vm_root_session, vm_script_path, params):
     """
     Build and install spice-gtk in the VM
 
+    :param vm: VM object.
     :param vm_root_session:  VM Session object.
     :param vm_script_path: path where to find build_install.py script
     :param params: Dictionary with test parameters.
@@ -160,22 +171,24 @@ def build_install_spicegtk(vm_root_session, vm_script_path, params):
     except ShellCmdError:
         logging.error(output)
 
-    if "release 7" in vm_root_session.cmd("cat /etc/redhat-release"):
+    release_major = utils_spice.get_guest_facts(vm, vm_root_session)[
+        "release_major"]
+    if release_major == "7":
         pkgsRequired = ["libogg-devel", "celt051-devel", "libcacard-devel",
                         "source-highlight", "gtk-doc"]
     else:
         pkgsRequired = ["libogg-devel", "celt051-devel", "libcacard-devel"]
 
-    install_req_pkgs(pkgsRequired, vm_root_session, params)
+    install_req_pkgs(pkgsRequired, vm, vm_root_session, params)
 
-    utils_spice.deploy_epel_repo(vm_root_session, params)
+    utils_spice.deploy_epel_repo(vm_root_session, params, vm)
 
     try:
         cmd = "yum --disablerepo=\"*\" " + \
               "--enablerepo=\"epel\" -y install perl-Text-CSV"
         # In RHEL6, pyparsing is in EPEL but in RHEL7, it's part of
         # the main product repo
-        if "release 6" in vm_root_session.cmd("cat /etc/redhat-release"):
+        if release_major == "6":
             cmd += " pyparsing"
         output = vm_root_session.cmd(cmd, timeout=300)
         logging.info(output)
@@ -210,10 +223,11 @@ def build_install_spicegtk(vm_root_session, vm_script_path, params):
         logging.error(output)
 
 
-def build_install_vdagent(vm_root_session, vm_script_path, params):
+def build_install_vdagent(vm, vm_root_session, vm_script_path, params):
     """
     Build and install spice-vdagent in the VM
 
+    :param vm: VM object.
     :param vm_root_session: VM Session object.
     :param vm_script_path: path where to find build_install.py script
     :param params: Dictionary with test parameters.
@@ -227,7 +241,7 @@ def build_install_vdagent(vm_root_session, vm_script_path, params):
         logging.error(output)
 
     pkgsRequired = ["libpciaccess-devel"]
-    install_req_pkgs(pkgsRequired, vm_root_session, params)
+    install_req_pkgs(pkgsRequired, vm, vm_root_session, params)
 
     output = vm_root_session.cmd("%s -p spice-vd-agent" % (vm_script_path),
                                  timeout=600)
@@ -252,6 +266,7 @@ def build_install_vdagent(vm_root_session, vm_script_path, params):
         logging.error(output)
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Build and install packages from git on the client or guest VM
@@ -264,6 +279,8 @@ def run(test, params, env):
     :param env: Dictionary with test environment.
     """
 
+    utils_spice.reset_sessions()
+
     # Collect test parameters
     pkgName = params.get("build_install_pkg")
     script = params.get("script")
@@ -283,23 +300,29 @@ def run(test, params, env):
                  "destination directory: %s, source script location: %s",
                  vm_name, vm_script_path, host_script_path)
 
-    vm.copy_files_to(host_script_path, vm_script_path, timeout=60)
+    utils_spice.deploy_vm_assets(vm, [(host_script_path, vm_script_path)],
+                                 vm_root_session)
     time.sleep(5)
 
     # All packages require spice-protocol
-    build_install_spiceprotocol(vm_root_session, vm_script_path, params)
+    build_install_spiceprotocol(vm, vm_root_session, vm_script_path, params)
 
     # Run build_install.py script
     if pkgName == "xf86-video-qxl":
-        build_install_qxl(vm_root_session, vm_script_path, params)
+        build_install_qxl(vm, vm_root_session, vm_script_path, params)
     elif pkgName == "spice-vd-agent":
-        build_install_vdagent(vm_root_session, vm_script_path, params)
+        build_install_vdagent(vm, vm_root_session, vm_script_path, params)
     elif pkgName == "spice-gtk":
-        build_install_spicegtk(vm_root_session, vm_script_path, params)
+        build_install_spicegtk(vm, vm_root_session, vm_script_path, params)
     elif pkgName == "virt-viewer":
-        build_install_virtviewer(vm_root_session, vm_script_path, params)
+        build_install_virtviewer(vm, vm_root_session, vm_script_path,
+                                 params)
     else:
         logging.info("Not supported right now")
         raise error.TestFail("Incorrect Test_Setup")
 
+    # Freshly built packages invalidate what was probed before
+    utils_spice.drop_guest_facts(vm)
+    utils_spice.drop_rv_versions(vm)
+    utils_spice.release_session(vm_root_session)
     utils_spice.clear_interface(vm)
@@ -7,44 +7,61 @@ Requires: binaries remote-viewer, Xorg, netstat
 """
 import logging
 import socket
+import os
+import time
 from virttest.aexpect import ShellStatusError
-from virttest.aexpect import ShellCmdError
 from virttest.aexpect import ShellProcessTerminatedError
-from virttest import utils_net, utils_spice, remote, utils_misc
+from virttest import utils_net, utils_spice, utils_misc
 from autotest.client.shared import error
 
 
 def str_input(client_vm, ticket):
     """
-    sends spice_password trough vm.send_key()
+    sends spice_password trough the keyboard of the client VM
     :param client_session - vm() object
     :param ticket - use params.get("spice_password")
     """
     logging.info("Passing ticket '%s' to the remote-viewer.", ticket)
-    char_mapping = {":": "shift-semicolon",
-                    ",": "comma",
-                    ".": "dot",
-                    "/": "slash",
-                    "?": "shift-slash",
-                    "=": "equal"}
-    for character in ticket:
-        if character in char_mapping:
-            character = char_mapping[character]
-        client_vm.send_key(character)
+    utils_spice.type_string(client_vm, ticket)
 
-    client_vm.send_key("kp_enter")  # send enter
 
+def wait_for_window(client_vm, client_session, title, timeout):
+    """
+    Wait for a remote-viewer window to show up before typing into it.
+
+    Windows clients can not be queried, a fixed wait is used there.
+
+    :param client_vm - vm object
+    :param client_session - utils_spice.lease_session(vm)
+    :param title - exact window title
+    :param timeout - deadline in seconds
+    """
+    if client_vm.params.get("os_type") != "linux":
+        utils_spice.wait_timeout(1)
+        return
+    shown, _ = utils_spice.wait_for_condition(
+        lambda: utils_spice.is_window_shown(client_session, title), timeout,
+        text="Waiting for the '%s' window" % title)
+    if not shown:
+        logging.warning("The '%s' window did not show up in %ss", title,
+                        timeout)
 
-def print_rv_version(client_session, rv_binary):
+
+def print_rv_version(client_vm, client_session, rv_binary,
+                     ld_library_path=None):
     """
     prints remote-viewer and spice-gtk version available inside client_session
-    :param client_session - vm.wait_for_login()
+    :param client_vm - vm object
+    :param client_session - utils_spice.lease_session(vm)
     :param rv_binary - remote-viewer binary
+    :param ld_library_path - LD_LIBRARY_PATH remote-viewer runs with
+    :return: dict as returned by utils_spice.get_rv_version()
     """
-    logging.info("remote-viewer version: %s",
-                 client_session.cmd(rv_binary + " -V"))
-    logging.info("spice-gtk version: %s",
-                 client_session.cmd(rv_binary + " --spice-gtk-version"))
+    versions = utils_spice.get_rv_version(client_vm, client_session,
+                                          rv_binary, ld_library_path)
+    logging.info("remote-viewer version: %s", versions["rv_version"])
+    logging.info("spice-gtk version: %s", versions["spice_gtk_version"])
+    return versions
 
 
 def launch_rv(client_vm, guest_vm, params):
@@ -56,6 +73,9 @@ def launch_rv(client_vm, guest_vm, params):
     :param client_vm - vm object
     :param guest_vm - vm object
     :param params
+    :return: dict with the times (as returned by time.time()) when
+             remote-viewer was launched and when its connection was verified,
+             None when the connection was not expected to succeed
     """
     rv_binary = params.get("rv_binary", "remote-viewer")
     rv_ld_library_path = params.get("rv_ld_library_path")
@@ -108,8 +128,8 @@ def launch_rv(client_vm, guest_vm, params):
     if rv_parameters_from == 'file':
         cmd += " ~/rv_file.vv"
 
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
     if display == "spice":
 
@@ -120,14 +140,7 @@ def launch_rv(client_vm, guest_vm, params):
             # client needs cacert file
             cacert = "%s/%s" % (guest_vm.get_spice_var("spice_x509_prefix"),
                                 guest_vm.get_spice_var("spice_x509_cacert_file"))
-            client_session.cmd("rm -rf %s && mkdir -p %s" % (
-                               guest_vm.get_spice_var("spice_x509_prefix"),
-                               guest_vm.get_spice_var("spice_x509_prefix")))
-            remote.copy_files_to(client_vm.get_address(), 'scp',
-                                 params.get("username"),
-                                 params.get("password"),
-                                 params.get("shell_port"),
-                                 cacert, cacert)
+            utils_spice.deploy_file(client_session, cacert, cacert)
 
             host_tls_port = guest_vm.get_spice_var("spice_tls_port")
             host_port = guest_vm.get_spice_var("spice_port")
@@ -156,7 +169,8 @@ def launch_rv(client_vm, guest_vm, params):
                                                                   host_port)
 
             if rv_parameters_from == "menu":
-                line = spice_url
+                # The URL is typed into a dialog, not passed through a shell
+                line = spice_url.strip().replace("\\&", "&")
             elif rv_parameters_from == "file":
                 pass
             else:
@@ -213,8 +227,11 @@ def launch_rv(client_vm, guest_vm, params):
 
     if client_vm.params.get("os_type") == "linux":
         cmd = "nohup " + cmd + " &> /dev/null &"  # Launch it on background
+        # Set on the command only, the session goes back to the pool
+        if proxy and rv_parameters_from != "file":
+            cmd = "SPICE_PROXY=%s %s" % (proxy, cmd)
         if rv_ld_library_path:
-            cmd = "export LD_LIBRARY_PATH=" + rv_ld_library_path + ";" + cmd
+            cmd = "LD_LIBRARY_PATH=%s %s" % (rv_ld_library_path, cmd)
 
     if rv_parameters_from == "file":
         print "Generating file"
@@ -222,19 +239,8 @@ def launch_rv(client_vm, guest_vm, params):
         print "Uploading file to client"
         client_vm.copy_files_to("rv_file.vv", "~/rv_file.vv")
 
-    # Launching the actual set of commands
-    try:
-        if rv_ld_library_path:
-            print_rv_version(client_session, "LD_LIBRARY_PATH=/usr/local/lib " + rv_binary)
-        else:
-            print_rv_version(client_session, rv_binary)
-
-    except (ShellStatusError, ShellProcessTerminatedError):
-        # Sometimes It fails with Status error, ingore it and continue.
-        # It's not that important to have printed versions in the log.
-        logging.debug("Ignoring a Status Exception that occurs from calling "
-                      "print versions of remote-viewer or spice-gtk")
-
+    # Launching the actual set of commands, the versions were recorded by
+    # run()
     logging.info("Launching %s on the client (virtual)", cmd)
 
     if proxy:
@@ -247,10 +253,17 @@ def launch_rv(client_vm, guest_vm, params):
             host_port = split[1]
         else:
             host_port = "3128"
-        if rv_parameters_from != "file":
-            client_session.cmd("export SPICE_PROXY=%s" % proxy)
 
+    timings = {"launched": None}
     if not params.get("rv_verify") == "only":
+        # Without a QMP monitor fall back to fixed waits
+        events = utils_spice.SpiceEventBus(guest_vm)
+        connect_timeout = float(params.get("rv_connect_timeout", 60))
+        # Refusals that do not emit any SPICE event (e.g. a failed TLS
+        # handshake) only end by this timeout
+        refuse_timeout = float(params.get("rv_refuse_timeout", 5))
+        mark = events.mark()
+        timings["launched"] = mark
         try:
             client_session.cmd(cmd)
         except ShellStatusError:
@@ -259,32 +272,61 @@ def launch_rv(client_vm, guest_vm, params):
 
         # Send command line through monitor since url was not provided
         if rv_parameters_from == "menu":
-            utils_spice.wait_timeout(1)
+            wait_for_window(client_vm, client_session,
+                            params.get("rv_menu_window",
+                                       "Connection details"),
+                            connect_timeout)
             str_input(client_vm, line)
 
         # client waits for user entry (authentication) if spice_password is set
         # use qemu monitor password if set, else, if set, try normal password.
-        if qemu_ticket:
-            # Wait for remote-viewer to launch
-            utils_spice.wait_timeout(5)
-            str_input(client_vm, qemu_ticket)
-        elif ticket:
-            if ticket_send:
+        # A .vv file carries the password, nothing is asked for then.
+        if (qemu_ticket or ticket) and rv_parameters_from != "file":
+            if qemu_ticket:
+                ticket = qemu_ticket
+            elif ticket_send:
                 ticket = ticket_send
 
-            utils_spice.wait_timeout(5)  # Wait for remote-viewer to launch
+            # remote-viewer asks for the password once the server refuses
+            # its first, password-less, attempt
+            if not events.available:
+                utils_spice.wait_timeout(5)
+            elif events.wait_for("SPICE_DISCONNECTED", connect_timeout, mark,
+                                 text="Waiting for remote-viewer to ask for "
+                                      "the password") is None:
+                logging.warning("remote-viewer did not try to connect "
+                                "without the password")
+            else:
+                wait_for_window(client_vm, client_session,
+                                params.get("rv_password_window",
+                                           "Authentication required"),
+                                connect_timeout)
+            mark = events.mark()
+            timings["password"] = mark
             str_input(client_vm, ticket)
 
-        utils_spice.wait_timeout(5)  # Wait for conncetion to establish
+        if not events.available:
+            utils_spice.wait_timeout(5)  # Wait for conncetion to establish
+        elif test_type == "negative":
+            events.wait_for(["SPICE_INITIALIZED", "SPICE_DISCONNECTED"],
+                            refuse_timeout, mark,
+                            text="Waiting for the connection to be refused")
+        else:
+            channels = params.get("rv_wait_channels",
+                                  "main display inputs cursor").split()
+            if events.wait_for_channels(channels, connect_timeout,
+                                        mark) is None:
+                logging.warning("Not all of the SPICE channels %s were "
+                                "initialized in %ss", channels,
+                                connect_timeout)
 
     is_rv_connected = True
 
     try:
         utils_spice.verify_established(client_vm, host_ip,
                                        host_port, rv_binary,
-                                       host_tls_port,
-                                       params.get("spice_secure_channels",
-                                                  None))
+                                       host_tls_port)
+        timings["connected"] = time.time()
     except utils_spice.RVConnectError:
         if test_type == "negative":
             logging.info("remote-viewer connection failed as expected")
@@ -292,7 +334,8 @@ def launch_rv(client_vm, guest_vm, params):
                 # Check the qemu process output to verify what is expected
                 qemulog = guest_vm.process.get_output()
                 if "SSL_accept failed" in qemulog:
-                    return
+                    utils_spice.release_session(client_session)
+                    return None
                 else:
                     raise error.TestFail("SSL_accept failed not shown in qemu" +
                                          "process as expected.")
@@ -305,21 +348,29 @@ def launch_rv(client_vm, guest_vm, params):
                              " it was supposed to be unsuccessful")
 
     # Get spice info
-    output = guest_vm.monitor.cmd("info spice")
-    logging.debug("INFO SPICE")
-    logging.debug(output)
+    spice_info = utils_spice.query_spice(guest_vm)
+    logging.debug("SPICE server: %s", spice_info)
+
+    if is_rv_connected:
+        err = utils_spice.check_spice_channels(
+            spice_info, params.get("spice_secure_channels"),
+            tls=bool(host_tls_port))
+        if err:
+            raise error.TestFail("SPICE server channels: %s" % err)
 
     # Check to see if ipv6 address is reported back from qemu monitor
     if (check_spice_info == "ipv6"):
         logging.info("Test to check if ipv6 address is reported"
                      " back from the qemu monitor")
         # Remove brackets from ipv6 host ip
-        if (host_ip[1:len(host_ip) - 1] in output):
+        if spice_info.host and (spice_info.host.lower() ==
+                                host_ip.strip("[]").lower()):
             logging.info("Reported ipv6 address found in output from"
-                         " 'info spice'")
+                         " query-spice")
         else:
             raise error.TestFail("ipv6 address not found from qemu monitor"
-                                 " command: 'info spice'")
+                                 " command: query-spice (%s)" %
+                                 spice_info.host)
     else:
         logging.info("Not checking the value of 'info spice'"
                      " from the qemu monitor")
@@ -328,8 +379,222 @@ def launch_rv(client_vm, guest_vm, params):
     if client_vm.params.get("os_type") == "linux":
         cmd = "disown -ar"
     client_session.cmd_output(cmd)
+    utils_spice.release_session(client_session)
+    if not is_rv_connected:
+        return None
+    return timings
+
+
+def connection_variant(guest_vm, params):
+    """
+    Describe the connection options of the test, e.g. "ssl/password/ipv4/cmd"
+
+    :param guest_vm - vm object
+    :param params
+    """
+    if guest_vm.get_spice_var("spice_ssl") == "yes":
+        variant = ["ssl"]
+    else:
+        variant = ["plain"]
+    if params.get("qemu_password") or guest_vm.get_spice_var("spice_password"):
+        variant.append("password")
+    else:
+        variant.append("no_password")
+    if guest_vm.get_spice_var("listening_addr") == "ipv6":
+        variant.append("ipv6")
+    else:
+        variant.append("ipv4")
+    variant.append(params.get("rv_parameters_from", "cmd"))
+    return "/".join(variant)
+
+
+def stop_rv(client_vm, guest_vm, rv_binary, events):
+    """
+    Kill remote-viewer on the client and wait for the guest to notice.
+
+    :param client_vm - vm object
+    :param guest_vm - vm object
+    :param rv_binary - remote-viewer binary
+    :param events - utils_spice.SpiceEventBus of the guest
+    """
+    rv_name = os.path.basename(rv_binary)
+    mark = events.mark()
+    client_session = utils_spice.lease_session(client_vm)
+    try:
+        if client_vm.params.get("os_type") == "windows":
+            client_session.cmd_status("taskkill /F /IM %s.exe" % rv_name)
+        else:
+            client_session.cmd_status("killall -9 %s" % rv_name)
+            utils_spice.wait_for_condition(
+                lambda: utils_spice.is_process_gone(client_session, rv_name),
+                30, text="Waiting for %s to exit" % rv_name)
+    finally:
+        utils_spice.release_session(client_session)
+    if events.events(["SPICE_INITIALIZED"]):
+        events.wait_for("SPICE_DISCONNECTED", 30, mark,
+                        text="Waiting for %s to disconnect from %s"
+                        % (rv_name, guest_vm.name))
+
+
+def benchmark_connect(test, client_vm, guest_vm, params):
+    """
+    Repeat the connect/disconnect cycle and report the connection latency.
+
+    For each cycle the time from launching remote-viewer to the first
+    SPICE connection (the authenticated one in password variants), to all
+    channels from rv_wait_channels being initialized and to the connection
+    being verified from the client is measured. Percentiles are logged and
+    written to rv_connect_benchmark.json in the results directory.
+
+    :param test: QEMU test object.
+    :param client_vm - vm object
+    :param guest_vm - vm object
+    :param params
+    """
+    events = utils_spice.SpiceEventBus(guest_vm)
+    if not events.available:
+        raise error.TestNAError("Benchmark mode needs a QMP monitor on %s"
+                                % guest_vm.name)
+    if (params.get("test_type") == "negative" or
+            params.get("rv_verify") == "only"):
+        raise error.TestNAError("Benchmark mode needs a test which connects")
+    cycles = int(params.get("rv_benchmark_cycles", 10))
+    channels = params.get("rv_wait_channels",
+                          "main display inputs cursor").split()
+    rv_binary = params.get("rv_binary", "remote-viewer")
+    variant = connection_variant(guest_vm, params)
+
+    samples = {"first_channel": [], "all_channels": [], "usable": []}
+    for cycle in xrange(cycles):
+        stop_rv(client_vm, guest_vm, rv_binary, events)
+        timings = launch_rv(client_vm, guest_vm, params)
+        launched = timings["launched"]
+        # Skip the refused password-less attempt, latencies are still
+        # counted from the launch
+        since = timings.get("password", launched)
+        connected = events.events(["SPICE_CONNECTED"], since)
+        initialized = {}
+        for event in events.events(["SPICE_INITIALIZED"], since):
+            channel = events.channel(event)[0]
+            stamp = events.timestamp(event)
+            if channel not in initialized or stamp < initialized[channel]:
+                initialized[channel] = stamp
+        if connected:
+            samples["first_channel"].append(
+                min(events.timestamp(event) for event in connected) -
+                launched)
+        if set(channels) <= set(initialized):
+            samples["all_channels"].append(
+                max(initialized[channel] for channel in channels) - launched)
+        samples["usable"].append(timings["connected"] - launched)
+        logging.info("Cycle %d/%d (%s): usable after %.3fs", cycle + 1,
+                     cycles, variant, samples["usable"][-1])
+
+    summary = {}
+    logging.info("Connection latency of %s in %d cycles [s]:", variant,
+                 cycles)
+    for name in ("first_channel", "all_channels", "usable"):
+        summary[name] = utils_spice.summarize(samples[name])
+        stats = summary[name]
+        if stats["count"]:
+            logging.info("  %-14s p50 %.3f  p90 %.3f  p99 %.3f  max %.3f",
+                         name, stats["p50"], stats["p90"], stats["p99"],
+                         stats["max"])
+        else:
+            logging.info("  %-14s no samples", name)
+
+    result = {"variant": variant, "shortname": params.get("shortname"),
+              "cycles": cycles, "samples": samples, "percentiles": summary}
+    utils_spice.write_results_json(test, "rv_connect_benchmark", result)
 
 
+def soak_connect(test, client_vm, guest_vm, params, env):
+    """
+    Launch and kill remote-viewer in a loop and watch the resources of qemu.
+
+    Runs for rv_soak_time seconds if set, rv_soak_cycles cycles otherwise.
+    In every cycle RSS, FD count and thread count of remote-viewer are
+    sampled on the client while connected, and of qemu on the host after
+    remote-viewer was killed. The series are written to rv_connect_soak.json
+    in the results directory. The test fails when a qemu series grows
+    (almost) monotonically after rv_soak_warmup cycles by more than its
+    threshold: rv_soak_rss_threshold (kB), rv_soak_fd_threshold,
+    rv_soak_thread_threshold. remote-viewer is a new process in every
+    cycle, its series are only reported.
+
+    :param test: QEMU test object.
+    :param client_vm - vm object
+    :param guest_vm - vm object
+    :param params
+    :param env: Dictionary with test environment.
+    """
+    if params.get("test_type") == "negative":
+        raise error.TestNAError("Soak mode needs a test which connects")
+    if client_vm.params.get("os_type") == "windows":
+        raise error.TestNAError("Soak mode needs a linux client")
+    soak_time = float(params.get("rv_soak_time", 0))
+    cycles = int(params.get("rv_soak_cycles", 50))
+    warmup = int(params.get("rv_soak_warmup", 3))
+    thresholds = {"rss_kb": int(params.get("rv_soak_rss_threshold", 10240)),
+                  "fds": int(params.get("rv_soak_fd_threshold", 10)),
+                  "threads": int(params.get("rv_soak_thread_threshold", 5))}
+    rv_binary = params.get("rv_binary", "remote-viewer")
+    rv_name = os.path.basename(rv_binary)
+    events = utils_spice.SpiceEventBus(guest_vm)
+
+    series = {"time": [], "qemu": dict((key, []) for key in thresholds),
+              "remote-viewer": dict((key, []) for key in thresholds)}
+    start = time.time()
+    cycle = 0
+    while True:
+        if soak_time:
+            if time.time() - start >= soak_time:
+                break
+        elif cycle >= cycles:
+            break
+        cycle += 1
+
+        launch_rv(client_vm, guest_vm, params)
+        client_session = utils_spice.lease_session(client_vm)
+        try:
+            rv_stats = utils_spice.vm_process_stats(client_session, rv_name)
+        finally:
+            utils_spice.release_session(client_session)
+
+        mark = events.mark()
+        utils_spice.kill_app("client_vm", rv_binary, params, env)
+        if events.available:
+            events.wait_for("SPICE_DISCONNECTED", 30, mark,
+                            text="Waiting for %s to disconnect" % rv_name)
+        qemu_stats = utils_spice.host_process_stats(guest_vm.get_pid())
+
+        series["time"].append(time.time() - start)
+        for key in thresholds:
+            series["qemu"][key].append(getattr(qemu_stats, key))
+            if rv_stats:
+                series["remote-viewer"][key].append(getattr(rv_stats, key))
+        logging.info("Soak cycle %d: qemu %s, remote-viewer %s", cycle,
+                     qemu_stats, rv_stats)
+
+    leaks = []
+    for key, threshold in thresholds.items():
+        grown = utils_spice.growth(series["qemu"][key], warmup)
+        if grown > threshold:
+            leaks.append("%s grew by %s" % (key, grown))
+    utils_spice.write_results_json(test, "rv_connect_soak",
+                                   {"shortname": params.get("shortname"),
+                                    "cycles": cycle, "warmup": warmup,
+                                    "thresholds": thresholds,
+                                    "series": series})
+
+    # Leave remote-viewer connected like the other modes do
+    launch_rv(client_vm, guest_vm, params)
+    if leaks:
+        raise error.TestFail("qemu resources grow with reconnects: %s" %
+                             ", ".join(leaks))
+
+
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Simple test for Remote Desktop connection
@@ -341,17 +606,18 @@ def run(test, params, env):
     :param test: QEMU test object.  :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
 
     guest_vm = env.get_vm(params["guest_vm"])
 
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
     if (client_vm.params.get("os_type") == "windows" and
             client_vm.params.get("rv_installer", None)):
@@ -359,24 +625,39 @@ def run(test, params, env):
         return
 
     if params.get("clear_interface", "yes") == "yes":
-        for vm in params.get("vms").split():
+        vms = [env.get_vm(vm) for vm in params.get("vms").split()]
+        for vm in vms:
+            session = utils_spice.lease_session(vm, timeout=360)
             try:
-                session = env.get_vm(vm).wait_for_login(timeout=360)
-                output = session.cmd('cat /etc/redhat-release')
-                logging.info(output)
-            except ShellCmdError:
+                facts = utils_spice.get_guest_facts(vm, session)
+            finally:
+                utils_spice.release_session(session)
+            if not facts["release"]:
                 raise error.TestNAError("Test is only currently supported on "
                                         "RHEL and Fedora operating systems")
-            if "release 6." in output:
-                waittime = 15
-            else:
-                waittime = 60
-            utils_spice.clear_interface(env.get_vm(vm),
-                                        int(params.get("login_timeout", "360")))
+        utils_spice.clear_interfaces(vms,
+                                     int(params.get("login_timeout", "360")))
 
-        utils_spice.wait_timeout(waittime)
+    # Record the client versions with the results, probed once per binary
+    try:
+        versions = print_rv_version(client_vm, client_session,
+                                    params.get("rv_binary", "remote-viewer"),
+                                    params.get("rv_ld_library_path"))
+        utils_spice.write_results_json(test, "rv_version", versions)
+        if hasattr(test, "write_test_keyval"):
+            test.write_test_keyval({
+                "rv_version": versions["rv_version"],
+                "spice_gtk_version": versions["spice_gtk_version"]})
+    except (ShellStatusError, ShellProcessTerminatedError):
+        logging.debug("Could not get versions of remote-viewer or spice-gtk")
 
-    launch_rv(client_vm, guest_vm, params)
+    mode = params.get("rv_connect_mode", "default")
+    if mode == "benchmark":
+        benchmark_connect(test, client_vm, guest_vm, params)
+    elif mode == "soak":
+        soak_connect(test, client_vm, guest_vm, params, env)
+    else:
+        launch_rv(client_vm, guest_vm, params)
 
-    client_session.close()
-    guest_session.close()
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_session)
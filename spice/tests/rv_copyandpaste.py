@@ -7,21 +7,14 @@ Requires: connected binaries remote-viewer, Xorg, gnome session
 """
 import logging
 import os
+import re
 import time
+import json
+import random
 from autotest.client.shared import error
 from virttest import utils_misc, utils_spice, aexpect, data_dir
 
 
-def wait_timeout(timeout=10):
-    """
-    time.sleep(timeout) + logging.debug(timeout)
-
-    :param timeout=10
-    """
-    logging.debug("Waiting (timeout=%ss)", timeout)
-    time.sleep(timeout)
-
-
 def clear_cb(session, params):
     """
 
@@ -48,6 +41,176 @@ def clear_cb(session, params):
     logging.info("Clipboard has been cleared.")
 
 
+def clipboard_size(session, path, test_timeout):
+    """
+    Return the size in bytes of a file written by the clipboard script.
+
+    :param session: VM ssh session where the file is
+    :param path: location of the file
+    :param test_timeout: timeout time for the cmd
+    """
+    return int(session.cmd("stat -c %%s %s" % path,
+                           timeout=test_timeout).strip())
+
+
+# Targets offered for text, any image/* target is taken for images
+TEXT_TARGETS = ["UTF8_STRING", "STRING", "TEXT", "text/plain",
+                "text/plain;charset=utf-8", "COMPOUND_TEXT"]
+
+
+def get_cb_status(session, params, kind):
+    """
+    Return the targets the clipboard offers, without transferring its
+    content.
+
+    :param session: ssh session where the clipboard is to be checked
+    :param params: Dictionary with the test parameters.
+    :param kind: "text" or "image"
+    :return: list of targets
+    """
+    interpreter = params.get("interpreter")
+    dst_path = params.get("dst_dir", "guest_script")
+    script_call = os.path.join(dst_path, params.get("cb_status_script",
+                                                    "cb_status.py"))
+    cmd = "%s %s %s" % (interpreter, script_call, kind)
+    try:
+        output = session.cmd(cmd, timeout=float(params.get("test_timeout",
+                                                           600)))
+    except aexpect.ShellCmdError, err:
+        logging.debug("Clipboard status not available: %s", err)
+        return []
+    for line in output.splitlines():
+        if line.startswith("targets:"):
+            return line.split()[1:]
+    return []
+
+
+def offers(targets, kind):
+    """
+    Return True when the clipboard targets include data of the kind.
+
+    :param targets: list of targets as returned by get_cb_status()
+    :param kind: "text" or "image"
+    """
+    if kind == "text":
+        return bool(set(targets) & set(TEXT_TARGETS))
+    return bool([target for target in targets
+                 if target.startswith("image/")])
+
+
+def wait_for_paste(session_to_copy_from, session_to_paste_to, params, kind,
+                   copied_path):
+    """
+    Wait until the clipboard of the pasting session offers the copied data,
+    instead of sleeping a fixed time.
+
+    Only the offered targets are polled, the content is transferred once
+    by the paste. The deadline is cb_ready_timeout plus the time the
+    payload takes at cb_ready_rate bytes per second.
+
+    :param session_to_copy_from: VM ssh session where the data was copied
+    :param session_to_paste_to: VM ssh session where the data is pasted
+    :param params: Dictionary with the test parameters.
+    :param kind: "text" or "image"
+    :param copied_path: location of the copied data on the copying side
+    :return: tuple (True if the data is available, seconds waited)
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    expected = clipboard_size(session_to_copy_from, copied_path, test_timeout)
+    deadline = min(float(params.get("cb_ready_timeout", 10)) +
+                   expected / float(params.get("cb_ready_rate", 1048576)),
+                   test_timeout)
+
+    def ready():
+        return offers(get_cb_status(session_to_paste_to, params, kind), kind)
+
+    available, waited = utils_spice.wait_for_condition(
+        ready, deadline, step=0.2,
+        text="clipboard %s of %d bytes" % (kind, expected))
+    logging.info("Waited %.2fs for the clipboard %s (%d bytes), available: "
+                 "%s", waited, kind, expected, available)
+    return available, waited
+
+
+def get_cb_digest(session, params, kind, save_path=None):
+    """
+    Hash the clipboard content inside the VM with md5, the checksum the
+    copied data is verified with.
+
+    :param session: ssh session where the clipboard is to be hashed
+    :param params: Dictionary with the test parameters.
+    :param kind: "text" or "image"
+    :param save_path: location the content is written to as well
+    :return: dict with targets, size, algorithm and digest
+    """
+    interpreter = params.get("interpreter")
+    dst_path = params.get("dst_dir", "guest_script")
+    script_call = os.path.join(dst_path, params.get("cb_status_script",
+                                                    "cb_status.py"))
+    cmd = "%s %s --digest md5" % (interpreter, script_call)
+    if save_path:
+        cmd += " --save %s" % save_path
+    cmd += " " + kind
+    try:
+        output = session.cmd(cmd, timeout=float(params.get("test_timeout",
+                                                           600)))
+    except aexpect.ShellCmdError, err:
+        raise error.TestFail("Hashing the clipboard failed: %s" % err)
+    for line in output.splitlines():
+        if line.startswith("{"):
+            return json.loads(line)
+    raise error.TestFail("No digest of the clipboard", output)
+
+
+def verify_paste(session_to_paste_to, params, kind, final_path,
+                 expected_checksum):
+    """
+    Verify a paste of text or an image, either by writing it to a file and
+    comparing its md5sum with expected_checksum, or with cb_verify = digest
+    by comparing the md5 of the clipboard content, hashed inside the VM
+    without a file (see cb_status.py), with expected_checksum.
+    cb_save_paste = yes keeps writing the pasted content to final_path in
+    the digest mode.
+
+    :param session_to_paste_to: VM ssh session where the data is pasted
+    :param params: Dictionary with the test parameters.
+    :param kind: "text" or "image"
+    :param final_path: location of where the data should be pasted
+    :param expected_checksum: md5sum of the copied data
+    :return: size of the pasted data in bytes
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    interpreter = params.get("interpreter")
+    dst_path = params.get("dst_dir", "guest_script")
+    script_call = os.path.join(dst_path, params.get("guest_script"))
+
+    if params.get("cb_verify", "file") != "digest":
+        if kind == "text":
+            verify_txt_paste_success(session_to_paste_to, interpreter,
+                                     script_call,
+                                     params.get("script_params_writef"),
+                                     final_path, expected_checksum,
+                                     test_timeout)
+        else:
+            verify_img_paste_success(session_to_paste_to, interpreter,
+                                     script_call,
+                                     params.get("script_params_img_save"),
+                                     final_path, expected_checksum,
+                                     test_timeout)
+        return clipboard_size(session_to_paste_to, final_path, test_timeout)
+
+    save_path = None
+    if params.get("cb_save_paste") == "yes":
+        save_path = final_path
+    pasted = get_cb_digest(session_to_paste_to, params, kind, save_path)
+    logging.info("Clipboard %s md5: expected %s, pasted %s (%d bytes)", kind,
+                 expected_checksum, pasted["digest"], pasted["size"])
+    if not pasted["size"] or pasted["digest"] != expected_checksum:
+        raise error.TestFail("The pasting of the %s failed" % kind)
+    logging.info("PASS: The %s was successfully pasted", kind)
+    return pasted["size"]
+
+
 def place_img_in_clipboard(session_to_copy_from, interpreter, script_call,
                            script_params, dst_image_path, test_timeout):
     """
@@ -506,13 +669,13 @@ def restart_cppaste(session_to_copy_from, session_to_paste_to,
 
     clear_cb(session_to_paste_to, params)
     clear_cb(session_to_copy_from, params)
-    wait_timeout(5)
+    utils_spice.wait_timeout(5)
 
     # Command to copy text and put it in the keyboard, copy on the client
     place_text_in_clipboard(session_to_copy_from, interpreter, script_call,
                             script_params, testing_text, test_timeout)
 
-    wait_timeout(5)
+    utils_spice.wait_timeout(5)
     # Now test to see if the copied text from the one session can be
     # pasted on the other
     verify_paste_successful(session_to_paste_to, testing_text, interpreter,
@@ -569,7 +732,6 @@ def copy_and_paste_largetext(session_to_copy_from, session_to_paste_to,
     test_timeout = float(params.get("test_timeout", 600))
     interpreter = params.get("interpreter")
     script = params.get("guest_script")
-    script_write_params = params.get("script_params_writef")
     script_create_params = params.get("script_params_createf")
     dst_path = params.get("dst_dir", "guest_script")
     final_text_path = os.path.join(params.get("dst_dir"),
@@ -587,12 +749,12 @@ def copy_and_paste_largetext(session_to_copy_from, session_to_paste_to,
     textfile_checksum = verify_text_copy(session_to_copy_from, interpreter,
                                          script_call, script_create_params,
                                          string_length, final_text_path, test_timeout)
-    wait_timeout(30)
+    wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                   "text", final_text_path)
 
     # Verify the paste on the session to paste to
-    verify_txt_paste_success(session_to_paste_to, interpreter,
-                             script_call, script_write_params,
-                             final_text_path, textfile_checksum, test_timeout)
+    verify_paste(session_to_paste_to, params,
+                 "text", final_text_path, textfile_checksum)
 
 
 def restart_cppaste_lrgtext(session_to_copy_from, session_to_paste_to,
@@ -610,7 +772,6 @@ def restart_cppaste_lrgtext(session_to_copy_from, session_to_paste_to,
     test_timeout = float(params.get("test_timeout", 600))
     interpreter = params.get("interpreter")
     script = params.get("guest_script")
-    script_write_params = params.get("script_params_writef")
     script_create_params = params.get("script_params_createf")
     dst_path = params.get("dst_dir", "guest_script")
     final_text_path = os.path.join(params.get("dst_dir"),
@@ -628,28 +789,28 @@ def restart_cppaste_lrgtext(session_to_copy_from, session_to_paste_to,
     textfile_checksum = verify_text_copy(session_to_copy_from, interpreter,
                                          script_call, script_create_params,
                                          string_length, final_text_path, test_timeout)
-    wait_timeout(30)
+    wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                   "text", final_text_path)
 
     # Verify the paste on the session to paste to
-    verify_txt_paste_success(session_to_paste_to, interpreter,
-                             script_call, script_write_params,
-                             final_text_path, textfile_checksum, test_timeout)
+    verify_paste(session_to_paste_to, params,
+                 "text", final_text_path, textfile_checksum)
     # Restart vdagent & clear the clipboards.
     utils_spice.restart_vdagent(guest_session, test_timeout)
     clear_cb(session_to_paste_to, params)
     clear_cb(session_to_copy_from, params)
-    wait_timeout(5)
+    utils_spice.wait_timeout(5)
 
     # Command to copy text and put it in the clipboard
     textfile_checksum = verify_text_copy(session_to_copy_from, interpreter,
                                          script_call, script_create_params,
                                          string_length, final_text_path, test_timeout)
-    wait_timeout(30)
+    wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                   "text", final_text_path)
 
     # Verify the paste on the session to paste to
-    verify_txt_paste_success(session_to_paste_to, interpreter,
-                             script_call, script_write_params,
-                             final_text_path, textfile_checksum, test_timeout)
+    verify_paste(session_to_paste_to, params,
+                 "text", final_text_path, textfile_checksum)
 
 
 def copy_and_paste_image_pos(session_to_copy_from, session_to_paste_to,
@@ -695,12 +856,12 @@ def copy_and_paste_image_pos(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path, image_size)
     else:
         # Testing bmp
         place_img_in_clipboard(session_to_copy_from, interpreter, script_call,
@@ -711,12 +872,12 @@ def copy_and_paste_image_pos(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path_bmp, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path_bmp)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path_bmp, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path_bmp, image_size)
 
 
 def restart_cppaste_image(session_to_copy_from, session_to_paste_to,
@@ -762,12 +923,12 @@ def restart_cppaste_image(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path, image_size)
     else:
         # Testing bmp
         place_img_in_clipboard(session_to_copy_from, interpreter, script_call,
@@ -778,17 +939,17 @@ def restart_cppaste_image(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path_bmp, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path_bmp)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path_bmp, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path_bmp, image_size)
     # Restart vdagent & clear the clipboards.
     utils_spice.restart_vdagent(guest_session, test_timeout)
     clear_cb(session_to_paste_to, params)
     clear_cb(session_to_copy_from, params)
-    wait_timeout(5)
+    utils_spice.wait_timeout(5)
 
     if "png" in image_type:
         # Command to copy text and put it in the keyboard, copy on the client
@@ -799,12 +960,12 @@ def restart_cppaste_image(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path, image_size)
     else:
         # Testing bmp
         place_img_in_clipboard(session_to_copy_from, interpreter, script_call,
@@ -815,12 +976,12 @@ def restart_cppaste_image(session_to_copy_from, session_to_paste_to,
         image_size = verify_img_paste(session_to_copy_from, interpreter,
                                       script_call, script_save_params,
                                       final_image_path_bmp, test_timeout)
-        wait_timeout(30)
+        wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                       "image", final_image_path_bmp)
 
         # Verify the paste on the session to paste to
-        verify_img_paste_success(session_to_paste_to, interpreter,
-                                 script_call, script_save_params,
-                                 final_image_path_bmp, image_size, test_timeout)
+        verify_paste(session_to_paste_to, params,
+                     "image", final_image_path_bmp, image_size)
 
 
 def copy_and_paste_image_neg(session_to_copy_from, session_to_paste_to,
@@ -907,7 +1068,8 @@ def copyandpasteimg_cpdisabled_neg(session_to_copy_from, session_to_paste_to,
     verify_img_paste(session_to_copy_from, interpreter,
                      script_call, script_save_params,
                      final_image_path, test_timeout)
-    wait_timeout(30)
+    wait_for_paste(session_to_copy_from, session_to_paste_to, params,
+                   "image", final_image_path)
 
     # Verify the paste on the session to paste to
     verify_img_paste_fails(session_to_paste_to, interpreter,
@@ -915,6 +1077,614 @@ def copyandpasteimg_cpdisabled_neg(session_to_copy_from, session_to_paste_to,
                            final_image_path, test_timeout)
 
 
+def timed_paste(session_to_copy_from, session_to_paste_to, params, kind,
+                final_path, checksum):
+    """
+    Wait for the copied data and paste it, timing both.
+
+    :param session_to_copy_from: VM ssh session where the data was copied
+    :param session_to_paste_to: VM ssh session where the data is pasted
+    :param params: Dictionary with the test parameters.
+    :param kind: "text" or "image"
+    :param final_path: location of where the data should be pasted
+    :param checksum: md5sum of the copied data
+    :return: tuple (pasted bytes, seconds until the paste was verified,
+             seconds of it spent waiting for the data to be offered)
+    """
+    start = time.time()
+    _, waited = wait_for_paste(session_to_copy_from, session_to_paste_to,
+                               params, kind, final_path)
+    size = verify_paste(session_to_paste_to, params,
+                        kind, final_path, checksum)
+    return size, time.time() - start, waited
+
+
+def copy_and_paste_throughput(client_session, guest_session,
+                              guest_root_session, params, test):
+    """
+    Measure clipboard throughput over a sweep of payload sizes.
+
+    Text of every size from cb_throughput_sizes (bytes) and every image from
+    cb_throughput_images is copied in every direction of
+    cb_throughput_directions. The time is measured from the moment the
+    clipboard was grabbed and its content checksummed on the copying side
+    until the paste on the other side is complete and its checksum
+    verified; the part of it spent waiting for the clipboard to offer the
+    data is stored as "wait". Results are written to
+    rv_copyandpaste_throughput.json.
+
+    :param client_session: ssh session of the client
+    :param guest_session: ssh session of the guest
+    :param guest_root_session: guest root ssh session
+    :param params: Dictionary with the test parameters.
+    :param test: QEMU test object.
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    interpreter = params.get("interpreter")
+    script = params.get("guest_script")
+    script_create_params = params.get("script_params_createf")
+    script_set_params = params.get("script_params_img_set")
+    script_save_params = params.get("script_params_img_save")
+    dst_path = params.get("dst_dir", "guest_script")
+    final_text_path = os.path.join(params.get("dst_dir"),
+                                   params.get("final_textfile"))
+    script_call = os.path.join(dst_path, script)
+    sizes = [int(size) for size in
+             params.get("cb_throughput_sizes", "1024").split()]
+    images = params.get("cb_throughput_images", "").split()
+    directions = params.get("cb_throughput_directions",
+                            "client_to_guest guest_to_client").split()
+    sessions = {"client_to_guest": (client_session, guest_session),
+                "guest_to_client": (guest_session, client_session)}
+
+    utils_spice.verify_vdagent(guest_root_session, test_timeout)
+    utils_spice.verify_virtio(guest_root_session, test_timeout)
+
+    results = []
+    failed = []
+    for direction in directions:
+        session_to_copy_from, session_to_paste_to = sessions[direction]
+        payloads = [("text", size) for size in sizes]
+        payloads += [("image", image) for image in images]
+        for kind, payload in payloads:
+            clear_cb(session_to_copy_from, params)
+            clear_cb(session_to_paste_to, params)
+            case = {"direction": direction, "type": kind}
+            try:
+                if kind == "text":
+                    final_path = final_text_path
+                    checksum = verify_text_copy(session_to_copy_from,
+                                                interpreter, script_call,
+                                                script_create_params,
+                                                payload, final_path,
+                                                test_timeout)
+                else:
+                    image_path = os.path.join(params.get("dst_dir"), payload)
+                    final_path = os.path.join(params.get("dst_dir"),
+                                              "Throughput-" + payload)
+                    case["image"] = payload
+                    place_img_in_clipboard(session_to_copy_from, interpreter,
+                                           script_call, script_set_params,
+                                           image_path, test_timeout)
+                    checksum = verify_img_paste(session_to_copy_from,
+                                                interpreter, script_call,
+                                                script_save_params,
+                                                final_path, test_timeout)
+                size, elapsed, case["wait"] = timed_paste(
+                    session_to_copy_from, session_to_paste_to, params, kind,
+                    final_path, checksum)
+            except (error.TestFail, aexpect.ShellError), err:
+                logging.error("Clipboard transfer of %s %s %s failed: %s",
+                              kind, payload, direction, err)
+                case["size"] = payload if kind == "text" else None
+                case["error"] = str(err)
+                failed.append(case)
+                results.append(case)
+                continue
+            case["size"] = size
+            case["time"] = elapsed
+            case["mb_per_sec"] = case["size"] / elapsed / 1024 ** 2
+            results.append(case)
+            logging.info("Clipboard %s %s, %d bytes: %.3f s, %.2f MB/s",
+                         kind, direction, case["size"], elapsed,
+                         case["mb_per_sec"])
+
+    utils_spice.write_results_json(test, "rv_copyandpaste_throughput",
+                                   {"shortname": params.get("shortname"),
+                                    "results": results})
+    if failed:
+        raise error.TestFail("%d of %d clipboard transfers failed"
+                             % (len(failed), len(results)))
+
+
+def paste_latency(session_to_copy_from, session_to_paste_to, params, token,
+                  timeout):
+    """
+    Copy a short text and poll the other side until it can be pasted.
+
+    The clipboard script is run quietly, without logging its output. Every
+    poll starts the script anew unless cb_agent = yes, so without the
+    agent the latency includes at least one interpreter and GTK start.
+
+    :param session_to_copy_from: VM ssh session where the text is copied
+    :param session_to_paste_to: VM ssh session where the text is pasted
+    :param params: Dictionary with the test parameters.
+    :param token: unique text to copy
+    :param timeout: time after which the text counts as lost
+    :return: seconds from the grab until the text was pasted, None when it
+             did not arrive in time
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    interpreter = params.get("interpreter")
+    script_call = os.path.join(params.get("dst_dir", "guest_script"),
+                               params.get("guest_script"))
+    status, output = session_to_copy_from.cmd_status_output(
+        "%s %s %s %s" % (interpreter, script_call,
+                         params.get("script_params", ""), token),
+        timeout=test_timeout)
+    if status or "The text has been placed into the clipboard." not in output:
+        raise error.TestFail("Copying to the clipboard failed", output)
+    paste_cmd = "%s %s" % (interpreter, script_call)
+
+    def pasted():
+        status, output = session_to_paste_to.cmd_status_output(
+            paste_cmd, timeout=test_timeout)
+        return not status and token in output
+
+    done, waited = utils_spice.wait_for_condition(pasted, timeout, step=0.01,
+                                                  max_step=0.2)
+    if done:
+        return waited
+    return None
+
+
+def start_display_workload(guest_session, params):
+    """
+    Start cb_display_workload in the background on the guest display.
+
+    :param guest_session: guest ssh session
+    :param params: Dictionary with the test parameters.
+    :return: PID of the workload
+    """
+    command = params.get("cb_display_workload")
+    if not command:
+        raise error.TestError("cb_display_workload is not set")
+    output = guest_session.cmd("DISPLAY=:0.0 nohup %s &> /dev/null & "
+                               "echo $!" % command)
+    pid = output.strip().splitlines()[-1]
+    utils_spice.wait_timeout(float(params.get("cb_display_workload_delay",
+                                              5)))
+    if guest_session.cmd_status("kill -0 %s" % pid):
+        raise error.TestError("Display workload '%s' did not start"
+                              % command)
+    return pid
+
+
+def copy_and_paste_pingpong(client_session, guest_session,
+                            guest_root_session, params, test):
+    """
+    Measure the latency of short text copies bounced between guest and
+    client.
+
+    Every round copies a unique token from the guest to the client and
+    another one back. The rounds are repeated cb_pingpong_rounds times for
+    each workload of cb_pingpong_workloads ("none" or "display", which runs
+    cb_display_workload on the guest meanwhile). Tokens not pasted within
+    cb_pingpong_timeout count as lost. Percentiles of the latency and the
+    lost tokens are written to rv_copyandpaste_pingpong.json. Run it with
+    cb_agent = yes, otherwise each poll includes a clipboard script start
+    (see paste_latency()).
+
+    :param client_session: ssh session of the client
+    :param guest_session: ssh session of the guest
+    :param guest_root_session: guest root ssh session
+    :param params: Dictionary with the test parameters.
+    :param test: QEMU test object.
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    rounds = int(params.get("cb_pingpong_rounds", 1000))
+    timeout = float(params.get("cb_pingpong_timeout", 5))
+    max_lost = int(params.get("cb_pingpong_max_lost", 0))
+    workloads = params.get("cb_pingpong_workloads", "none").split()
+    legs = [("guest_to_client", guest_session, client_session),
+            ("client_to_guest", client_session, guest_session)]
+
+    utils_spice.verify_vdagent(guest_root_session, test_timeout)
+    utils_spice.verify_virtio(guest_root_session, test_timeout)
+
+    results = {}
+    failed = []
+    for workload in workloads:
+        pid = None
+        if workload == "display":
+            pid = start_display_workload(guest_session, params)
+        elif workload != "none":
+            raise error.TestError("Unknown clipboard workload %s" % workload)
+        latencies = dict((direction, []) for direction, _, _ in legs)
+        lost = dict((direction, 0) for direction, _, _ in legs)
+        try:
+            for number in xrange(rounds):
+                for direction, copy_session, paste_session in legs:
+                    token = "pingpong_%s_%d_%s_%08x" % (workload, number,
+                                                        direction,
+                                                        random.getrandbits(32))
+                    latency = paste_latency(copy_session, paste_session,
+                                            params, token, timeout)
+                    if latency is None:
+                        lost[direction] += 1
+                    else:
+                        latencies[direction].append(latency)
+                if number and not number % 100:
+                    logging.info("Clipboard ping-pong (%s workload): %d of "
+                                 "%d rounds", workload, number, rounds)
+        finally:
+            if pid:
+                guest_session.cmd_status("kill %s" % pid)
+
+        results[workload] = {}
+        everything = []
+        for direction, _, _ in legs:
+            everything += latencies[direction]
+            results[workload][direction] = dict(
+                utils_spice.summarize(latencies[direction]),
+                lost=lost[direction])
+        results[workload]["all"] = dict(utils_spice.summarize(everything),
+                                        lost=sum(lost.values()))
+        for key in [direction for direction, _, _ in legs] + ["all"]:
+            stats = results[workload][key]
+            if stats["count"]:
+                logging.info("%s workload, %s: p50 %.1f ms, p95 %.1f ms, "
+                             "p99 %.1f ms, max %.1f ms, %d lost", workload,
+                             key, stats["p50"] * 1000, stats["p95"] * 1000,
+                             stats["p99"] * 1000, stats["max"] * 1000,
+                             stats["lost"])
+            else:
+                logging.info("%s workload, %s: all %d lost", workload, key,
+                             stats["lost"])
+        if results[workload]["all"]["lost"] > max_lost:
+            failed.append("%s: %d lost" % (workload,
+                                           results[workload]["all"]["lost"]))
+
+    utils_spice.write_results_json(test, "rv_copyandpaste_pingpong",
+                                   {"shortname": params.get("shortname"),
+                                    "rounds": rounds, "timeout": timeout,
+                                    "results": results})
+    if failed:
+        raise error.TestFail("Clipboard texts were lost: %s"
+                             % ", ".join(failed))
+
+
+# Processes whose peak memory is watched by the image stress test
+STRESS_GUEST_PROCESSES = ["spice-vdagent", "spice-vdagentd"]
+STRESS_CLIENT_PROCESSES = ["remote-viewer"]
+
+
+def parse_image_specs(text):
+    """
+    Parse image specifications "WIDTHxHEIGHT:format:pattern".
+
+    :param text: whitespace separated specifications,
+                 e.g. "1920x1080:png:noise 7680x4320:bmp:flat"
+    :return: list of (width, height, format, pattern) tuples
+    """
+    specs = []
+    for item in text.split():
+        match = re.match(r"^(\d+)x(\d+):(png|bmp):(flat|noise)$", item)
+        if not match:
+            raise error.TestError("Invalid image specification '%s', "
+                                  "expected WIDTHxHEIGHT:png|bmp:flat|noise"
+                                  % item)
+        specs.append((int(match.group(1)), int(match.group(2)),
+                      match.group(3), match.group(4)))
+    return specs
+
+
+def generate_image(session, params, width, height, image_format, pattern):
+    """
+    Generate an image inside the VM with gen_image.py.
+
+    :param session: VM ssh session where the image is generated
+    :param params: Dictionary with the test parameters.
+    :return: tuple (path of the image, size in bytes)
+    """
+    dst_path = params.get("dst_dir", "guest_script")
+    script_call = os.path.join(dst_path, params.get("gen_image_script",
+                                                    "gen_image.py"))
+    image_path = os.path.join(dst_path, "Stress-%dx%d-%s.%s"
+                              % (width, height, pattern, image_format))
+    output = session.cmd("%s %s %d %d %s %s %s"
+                         % (params.get("interpreter"), script_call, width,
+                            height, image_format, pattern, image_path),
+                         timeout=float(params.get("test_timeout", 600)))
+    match = re.search(r"Image generated: \S+ (\d+) bytes", output)
+    if not match:
+        raise error.TestError("Generating %dx%d %s image failed: %s"
+                              % (width, height, image_format, output))
+    return image_path, int(match.group(1))
+
+
+def copy_and_paste_image_stress(client_session, guest_session,
+                                guest_root_session, params, test):
+    """
+    Copy generated images of growing size and watch the memory of the agents.
+
+    Every image of cb_stress_images is generated on the copying side and
+    copied in every direction of cb_stress_directions. For each transfer
+    the copy to paste latency and the peak RSS of spice-vdagent,
+    spice-vdagentd and remote-viewer during the transfer are recorded in
+    rv_copyandpaste_image_stress.json. A process which disappears during
+    a transfer, e.g. killed by the OOM killer, fails the test.
+
+    :param client_session: ssh session of the client
+    :param guest_session: ssh session of the guest
+    :param guest_root_session: guest root ssh session
+    :param params: Dictionary with the test parameters.
+    :param test: QEMU test object.
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    interpreter = params.get("interpreter")
+    script_call = os.path.join(params.get("dst_dir", "guest_script"),
+                               params.get("guest_script"))
+    specs = parse_image_specs(params.get("cb_stress_images", ""))
+    directions = params.get("cb_stress_directions",
+                            "client_to_guest guest_to_client").split()
+    sessions = {"client_to_guest": (client_session, guest_session),
+                "guest_to_client": (guest_session, client_session)}
+    # Peaks are read as root, watch the agent of the desktop user
+    owners = {"spice-vdagent": guest_session.cmd_output("id -un").strip()}
+    watched = [(guest_root_session, STRESS_GUEST_PROCESSES),
+               (client_session, STRESS_CLIENT_PROCESSES)]
+
+    utils_spice.verify_vdagent(guest_root_session, test_timeout)
+    utils_spice.verify_virtio(guest_root_session, test_timeout)
+
+    if not specs:
+        raise error.TestError("No images to generate in cb_stress_images")
+
+    results = []
+    failed = []
+    for direction in directions:
+        session_to_copy_from, session_to_paste_to = sessions[direction]
+        for width, height, image_format, pattern in specs:
+            if [case for case in results if "lost" in case]:
+                break
+            clear_cb(session_to_copy_from, params)
+            clear_cb(session_to_paste_to, params)
+            case = {"direction": direction, "width": width, "height": height,
+                    "format": image_format, "pattern": pattern}
+            image_path, case["file_size"] = generate_image(
+                session_to_copy_from, params, width, height, image_format,
+                pattern)
+            final_path = image_path.replace("Stress-", "Stress-paste-")
+            running = {}
+            case["peak_reset"] = True
+            for session, names in watched:
+                peaks, was_reset = utils_spice.vm_peak_rss(session, names,
+                                                           True, owners)
+                running.update(peaks)
+                case["peak_reset"] = case["peak_reset"] and was_reset
+            try:
+                place_img_in_clipboard(session_to_copy_from, interpreter,
+                                       script_call,
+                                       params.get("script_params_img_set"),
+                                       image_path, test_timeout)
+                checksum = verify_img_paste(
+                    session_to_copy_from, interpreter, script_call,
+                    params.get("script_params_img_save"), final_path,
+                    test_timeout)
+                case["size"], case["time"], case["wait"] = timed_paste(
+                    session_to_copy_from, session_to_paste_to, params,
+                    "image", final_path, checksum)
+            except (error.TestFail, aexpect.ShellError), err:
+                case["error"] = str(err)
+            case["peak_rss_kb"] = {}
+            for session, names in watched:
+                peaks, _ = utils_spice.vm_peak_rss(session, names,
+                                                   owners=owners)
+                case["peak_rss_kb"].update(peaks)
+            lost = [name for name, peak in case["peak_rss_kb"].items()
+                    if peak is None and running.get(name) is not None]
+            if lost:
+                # Later transfers would not tell anything new
+                case["lost"] = sorted(lost)
+                case["error"] = ("%s stopped running during the transfer"
+                                 % ", ".join(case["lost"]))
+            for session in (session_to_copy_from, session_to_paste_to):
+                session.cmd("rm -f %s %s" % (image_path, final_path))
+            results.append(case)
+            description = ("%dx%d %s %s %s (%d bytes)"
+                           % (width, height, pattern, image_format,
+                              direction, case["file_size"]))
+            if "error" in case:
+                logging.error("Image %s failed: %s", description,
+                              case["error"])
+                failed.append(description)
+                continue
+            logging.info("Image %s: %.2fs, peak RSS %s", description,
+                         case["time"],
+                         ", ".join("%s %s kB" % item for item in
+                                   sorted(case["peak_rss_kb"].items())))
+
+    utils_spice.write_results_json(test, "rv_copyandpaste_image_stress",
+                                   {"shortname": params.get("shortname"),
+                                    "results": results})
+    if failed:
+        raise error.TestFail("Image clipboard transfers failed: %s"
+                             % "; ".join(failed))
+
+
+SCENARIO_FIELDS = ("direction", "type", "payload", "vdagent", "expect")
+SCENARIO_VALUES = {"direction": ("client_to_guest", "guest_to_client"),
+                   "type": ("text", "image"),
+                   "vdagent": ("none", "start", "stop", "restart"),
+                   "expect": ("pass", "fail")}
+
+
+def parse_scenarios(text):
+    """
+    Parse a list of clipboard scenario steps.
+
+    Steps are separated by ";", each step is
+    "direction type payload vdagent expect", e.g.
+    "client_to_guest text 262144 restart pass". The payload is the text to
+    copy, or its length when numeric, or the name of an image.
+
+    :param text: steps, e.g. params["cb_scenarios"]
+    :return: list of dicts with the fields of SCENARIO_FIELDS
+    """
+    steps = []
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        fields = item.split()
+        if len(fields) != len(SCENARIO_FIELDS):
+            raise error.TestError("Scenario step '%s' needs the fields %s"
+                                  % (item.strip(), " ".join(SCENARIO_FIELDS)))
+        step = dict(zip(SCENARIO_FIELDS, fields))
+        for field, values in SCENARIO_VALUES.items():
+            if step[field] not in values:
+                raise error.TestError("Scenario step '%s': %s is not one of "
+                                      "%s" % (item.strip(), field,
+                                              ", ".join(values)))
+        steps.append(step)
+    return steps
+
+
+def run_scenario_step(session_to_copy_from, session_to_paste_to,
+                      guest_session, params, step):
+    """
+    Run one clipboard scenario step, raise TestFail when its outcome differs
+    from the expected one.
+
+    :param session_to_copy_from: ssh session of the vm to copy from
+    :param session_to_paste_to: ssh session of the vm to paste to
+    :param guest_session: guest root ssh session
+    :param params: Dictionary with the test parameters.
+    :param step: dict returned by parse_scenarios()
+    """
+    test_timeout = float(params.get("test_timeout", 600))
+    interpreter = params.get("interpreter")
+    script = params.get("guest_script")
+    dst_path = params.get("dst_dir", "guest_script")
+    script_call = os.path.join(dst_path, script)
+    payload = step["payload"]
+    positive = step["expect"] == "pass"
+
+    if step["vdagent"] == "start":
+        utils_spice.start_vdagent(guest_session, test_timeout)
+    elif step["vdagent"] == "stop":
+        utils_spice.stop_vdagent(guest_session, test_timeout)
+    elif step["vdagent"] == "restart":
+        utils_spice.restart_vdagent(guest_session, test_timeout)
+    clear_cb(session_to_copy_from, params)
+    clear_cb(session_to_paste_to, params)
+
+    if step["type"] == "text" and not payload.isdigit():
+        place_text_in_clipboard(session_to_copy_from, interpreter,
+                                script_call, params.get("script_params", ""),
+                                payload, test_timeout)
+        if positive:
+            verify_paste_successful(session_to_paste_to, payload,
+                                    interpreter, script_call, test_timeout)
+        else:
+            verify_paste_fails(session_to_paste_to, payload, interpreter,
+                               script_call, test_timeout)
+        return
+
+    if step["type"] == "text":
+        kind = "text"
+        final_path = os.path.join(params.get("dst_dir"),
+                                  params.get("final_textfile"))
+        checksum = verify_text_copy(session_to_copy_from, interpreter,
+                                    script_call,
+                                    params.get("script_params_createf"),
+                                    payload, final_path, test_timeout)
+    else:
+        kind = "image"
+        final_path = os.path.join(params.get("dst_dir"), "Scenario-" + payload)
+        place_img_in_clipboard(session_to_copy_from, interpreter, script_call,
+                               params.get("script_params_img_set"),
+                               os.path.join(params.get("dst_dir"), payload),
+                               test_timeout)
+        checksum = verify_img_paste(session_to_copy_from, interpreter,
+                                    script_call,
+                                    params.get("script_params_img_save"),
+                                    final_path, test_timeout)
+    available, _ = wait_for_paste(session_to_copy_from, session_to_paste_to,
+                                  params, kind, final_path)
+    if positive:
+        verify_paste(session_to_paste_to, params, kind,
+                     final_path, checksum)
+    elif available:
+        raise error.TestFail("The %s is available for pasting although it "
+                             "should not be" % kind)
+    elif kind == "image":
+        verify_img_paste_fails(session_to_paste_to, interpreter, script_call,
+                               params.get("script_params_img_save"),
+                               final_path, test_timeout)
+
+
+def copy_and_paste_scenarios(client_session, guest_session,
+                             guest_root_session, params, test):
+    """
+    Run the steps of cb_scenarios one after another over the same
+    connection. The outcome and duration of every step are logged and
+    written to rv_copyandpaste_scenarios.json; a failed step does not stop
+    the remaining ones.
+
+    :param client_session: ssh session of the client
+    :param guest_session: ssh session of the guest
+    :param guest_root_session: guest root ssh session
+    :param params: Dictionary with the test parameters.
+    :param test: QEMU test object.
+    """
+    steps = parse_scenarios(params.get("cb_scenarios", ""))
+    if not steps:
+        raise error.TestError("No clipboard scenario steps in cb_scenarios")
+    sessions = {"client_to_guest": (client_session, guest_session),
+                "guest_to_client": (guest_session, client_session)}
+    test_timeout = float(params.get("test_timeout", 600))
+
+    utils_spice.verify_vdagent(guest_root_session, test_timeout)
+    utils_spice.verify_virtio(guest_root_session, test_timeout)
+
+    results = []
+    for number, step in enumerate(steps, 1):
+        description = " ".join(step[field] for field in SCENARIO_FIELDS)
+        logging.info("Clipboard scenario step %d/%d: %s", number, len(steps),
+                     description)
+        session_to_copy_from, session_to_paste_to = sessions[step["direction"]]
+        result = dict(step, step=number)
+        start = time.time()
+        try:
+            run_scenario_step(session_to_copy_from, session_to_paste_to,
+                              guest_root_session, params, step)
+            result["result"] = "pass"
+        except (error.TestFail, aexpect.ShellError), err:
+            result["result"] = "fail"
+            result["error"] = str(err)
+        result["time"] = time.time() - start
+        results.append(result)
+        logging.info("Step %d %s in %.2fs: %s", number,
+                     result["result"].upper(), result["time"], description)
+
+    logging.info("Clipboard scenario results:")
+    for result in results:
+        logging.info("  %2d %-4s %7.2fs  %s", result["step"],
+                     result["result"], result["time"],
+                     " ".join(result[field] for field in SCENARIO_FIELDS))
+    utils_spice.write_results_json(test, "rv_copyandpaste_scenarios",
+                                   {"shortname": params.get("shortname"),
+                                    "results": results})
+    failed = [result["step"] for result in results
+              if result["result"] != "pass"]
+    if failed:
+        raise error.TestFail("Clipboard scenario steps failed: %s"
+                             % ", ".join(str(step) for step in failed))
+
+
+@utils_spice.traced_test
+@utils_spice.sampled_test
 def run(test, params, env):
     """
     Testing copying and pasting between a client and guest
@@ -928,27 +1698,27 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Collect test parameters
     test_type = params.get("config_test")
     script = params.get("guest_script")
     dst_path = params.get("dst_dir", "guest_script")
     image_type = params.get("image_type")
-    dst_image_path = params.get("dst_dir", "image_tocopy_name")
-    dst_image_path_bmp = params.get("dst_dir", "image_tocopy_name_bmp")
     cp_disabled_test = params.get("disable_copy_paste")
     image_name = params.get("image_tocopy_name")
     image_name_bmp = params.get("image_tocopy_name_bmp")
     testing_text = params.get("text_to_test")
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
     guest_vm = env.get_vm(params["guest_vm"])
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
-    guest_root_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
+    guest_root_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
     logging.info("Get PID of remote-viewer")
     client_session.cmd("pgrep remote-viewer")
@@ -959,45 +1729,53 @@ def run(test, params, env):
     scriptdir = os.path.join("scripts", script)
     script_path = utils_misc.get_path(test.virtdir, scriptdir)
 
-    # The following is to copy the test image to either the client or guest
-    # if the test deals with images.
-    image_path = os.path.join(data_dir.get_deps_dir(), 'spice', image_name)
-    image_path_bmp = os.path.join(data_dir.get_deps_dir(), 'spice', image_name_bmp)
-
-    logging.info("Transferring the clipboard script to client & guest,"
-                 "destination directory: %s, source script location: %s",
-                 dst_path, script_path)
-
-    client_vm.copy_files_to(script_path, dst_path, timeout=60)
-    guest_vm.copy_files_to(script_path, dst_path, timeout=60)
-
-    if "image" in test_type:
-        if "client_to_guest" in test_type:
-            if "png" in image_type:
-                logging.info("Transferring the image to client"
-                             "destination directory: %s, source image: %s",
-                             dst_image_path, image_path)
-                client_vm.copy_files_to(image_path, dst_image_path, timeout=60)
-            else:
-                logging.info("Transferring a bmp image to client"
-                             "destination directory: %s, source image: %s",
-                             dst_image_path_bmp, image_path_bmp)
-                client_vm.copy_files_to(image_path_bmp, dst_image_path_bmp,
-                                        timeout=60)
-        elif "guest_to_client" in test_type:
-            if "png" in image_type:
-                logging.info("Transferring the image to client"
-                             "destination directory: %s, source image: %s",
-                             dst_image_path, image_path)
-                guest_vm.copy_files_to(image_path, dst_image_path, timeout=60)
-            else:
-                logging.info("Transferring a bmp image to client"
-                             "destination directory: %s, source image: %s",
-                             dst_image_path_bmp, image_path_bmp)
-                guest_vm.copy_files_to(image_path_bmp, dst_image_path_bmp,
-                                       timeout=60)
-        else:
+    # The clipboard status script is used to wait for pastes to be ready,
+    # the agent runs all clipboard scripts when cb_agent = yes
+    deps_dir = os.path.join(data_dir.get_deps_dir(), 'spice')
+    assets = [script_path,
+              os.path.join(deps_dir, params.get("cb_status_script",
+                                                "cb_status.py"))]
+    if params.get("cb_agent") == "yes":
+        assets.append(os.path.join(deps_dir, params.get("cb_agent_script",
+                                                        "cb_agent.py")))
+
+    if "image_stress" in test_type:
+        assets.append(os.path.join(deps_dir, params.get("gen_image_script",
+                                                        "gen_image.py")))
+    if "pingpong" in test_type and params.get("source_video_file"):
+        # Played by the display workload
+        video_path = utils_misc.get_path(
+            test.virtdir, os.path.join("deps",
+                                       params.get("source_video_file")))
+        utils_spice.deploy_assets(
+            [guest_vm], [(video_path,
+                          params.get("destination_video_file_path"))])
+
+    # The test images are needed if the test deals with images.
+    if "image" in test_type and "image_stress" not in test_type:
+        if ("client_to_guest" not in test_type and
+                "guest_to_client" not in test_type):
             raise error.TestFail("Incorrect Test_Setup")
+        if "png" in image_type:
+            assets.append(os.path.join(deps_dir, image_name))
+        else:
+            assets.append(os.path.join(deps_dir, image_name_bmp))
+    images = []
+    if "throughput" in test_type:
+        images = params.get("cb_throughput_images", "").split()
+    elif "scenarios" in test_type:
+        images = set(step["payload"] for step in
+                     parse_scenarios(params.get("cb_scenarios", ""))
+                     if step["type"] == "image")
+    assets.extend(os.path.join(deps_dir, image) for image in images)
+
+    logging.info("Deploying %s to client & guest, destination directory: %s",
+                 ", ".join(os.path.basename(path) for path in assets),
+                 dst_path)
+    utils_spice.deploy_assets(
+        [client_vm, guest_vm],
+        [(path, os.path.join(dst_path, os.path.basename(path)))
+         for path in assets])
 
     client_session.cmd("export DISPLAY=:0.0")
 
@@ -1010,13 +1788,43 @@ def run(test, params, env):
 
     guest_session.cmd("export DISPLAY=:0.0")
 
+    # Sampled until the test ends, see utils_spice.sampled_test
+    utils_spice.start_process_samplers(
+        [client_vm, guest_vm], params,
+        os.path.join(deps_dir, params.get("proc_sampler_script",
+                                          "proc_sampler.py")))
+
+    sessions = (client_session, guest_session)
+    cb_agents = []
+    if params.get("cb_agent") == "yes":
+        # Run all clipboard scripts in one long running agent per VM
+        cb_agents = utils_spice.start_cb_agents([client_vm, guest_vm],
+                                                sessions, params)
+        client_session, guest_session = cb_agents
+
     # Make sure the clipboards are clear before starting the test
     clear_cb(guest_session, params)
     clear_cb(client_session, params)
-    wait_timeout(5)
+    utils_spice.wait_timeout(5)
 
     # Figure out which test needs to be run
-    if (cp_disabled_test == "yes"):
+    if "throughput" in test_type:
+        logging.info("Measuring clipboard throughput")
+        copy_and_paste_throughput(client_session, guest_session,
+                                  guest_root_session, params, test)
+    elif "pingpong" in test_type:
+        logging.info("Measuring the clipboard round trip latency")
+        copy_and_paste_pingpong(client_session, guest_session,
+                                guest_root_session, params, test)
+    elif "image_stress" in test_type:
+        logging.info("Stressing the clipboard with generated images")
+        copy_and_paste_image_stress(client_session, guest_session,
+                                    guest_root_session, params, test)
+    elif "scenarios" in test_type:
+        logging.info("Running the clipboard scenarios")
+        copy_and_paste_scenarios(client_session, guest_session,
+                                 guest_root_session, params, test)
+    elif (cp_disabled_test == "yes"):
         # These are negative tests, clipboards are not synced because the VM
         # is set to disable copy and paste.
         if "client_to_guest" in test_type:
@@ -1134,3 +1942,8 @@ def run(test, params, env):
     else:
         # The test is not supported, verify what is a supported test.
         raise error.TestFail("Couldn't Find the Correct Test To Run")
+
+    utils_spice.stop_cb_agents(cb_agents)
+    for session in sessions:
+        utils_spice.release_session(session)
+    utils_spice.release_session(guest_root_session)
@@ -10,8 +10,10 @@ Requires: connected binaries remote-viewer, Xorg, gnome session
 import logging
 from autotest.client.shared import error
 from virttest.aexpect import ShellCmdError
+from virttest import utils_spice
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Tests the --full-screen option
@@ -22,18 +24,20 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Get the parameters needed for the test
     full_screen = params.get("full_screen")
     guest_vm = env.get_vm(params["guest_vm"])
     client_vm = env.get_vm(params["client_vm"])
 
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
 
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
     # Get the resolution of the client & guest
     logging.info("Getting the Resolution on the client")
@@ -83,5 +87,5 @@ def run(test, params, env):
     else:
         raise error.TestFail("The test setup is incorrect.")
 
-    client_session.close()
-    guest_session.close()
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_session)
@@ -45,8 +45,7 @@ def deploy_test_form(test, guest_vm, params):
 
     script = params.get("guest_script")
     script_path = os.path.join(data_dir.get_deps_dir(), "spice", script)
-    guest_vm.copy_files_to(script_path, "/tmp/%s" % params.get("guest_script"),
-                           timeout=60)
+    utils_spice.deploy_assets([guest_vm], [(script_path, "/tmp/%s" % script)])
 
 
 def run_test_form(guest_session, params):
@@ -178,12 +177,10 @@ def test_leds_migration(client_vm, guest_vm, guest_session, params):
     """
 
     # Turn numlock on RHEL6 on before the test begins:
-    grep_ver_cmd = "grep -o 'release [[:digit:]]' /etc/redhat-release"
-    rhel_ver = guest_session.cmd(grep_ver_cmd).strip()
+    facts = utils_spice.get_guest_facts(guest_vm, guest_session)
+    logging.info("RHEL version: #{0}#".format(facts["release_major"]))
 
-    logging.info("RHEL version: #{0}#".format(rhel_ver))
-
-    if rhel_ver == "release 6":
+    if facts["release_major"] == "6":
         client_vm.send_key('num_lock')
 
     # Run PyGTK form catching KeyEvents on guest
@@ -258,6 +255,8 @@ def analyze_results(file_path, test_type):
     return None
 
 
+@utils_spice.traced_test
+@utils_spice.sampled_test
 def run(test, params, env):
     """
     Test for testing keyboard inputs through spice.
@@ -267,6 +266,7 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
@@ -274,10 +274,10 @@ def run(test, params, env):
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
 
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
-    guest_root_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
+    guest_root_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     # Verify that gnome is now running on the guest
@@ -292,6 +292,12 @@ def run(test, params, env):
 
     deploy_test_form(test, guest_vm, params)
 
+    # Sampled until the test ends, see utils_spice.sampled_test
+    utils_spice.start_process_samplers(
+        [client_vm, guest_vm], params,
+        os.path.join(data_dir.get_deps_dir(), "spice",
+                     params.get("proc_sampler_script", "proc_sampler.py")))
+
     # Get test type and perform proper test
     test_type = params.get("config_test")
     test_mapping = {'type_and_func_keys': test_type_and_func_keys,
@@ -321,4 +327,5 @@ def run(test, params, env):
         raise error.TestFail("Testing of sending keys failed:"
                              "  Expected keycode = %s" % result)
 
-    guest_session.close()
+    utils_spice.release_session(guest_session)
+    utils_spice.release_session(guest_root_session)
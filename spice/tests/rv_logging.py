@@ -9,9 +9,10 @@ Requires: connected binaries remote-viewer, Xorg, gnome session
 import logging
 import os
 from autotest.client.shared import error
-from virttest import utils_misc, utils_spice
+from virttest import utils_misc, utils_spice, data_dir
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Tests the logging of remote-viewer
@@ -21,6 +22,8 @@ def run(test, params, env):
     :param env: Dictionary with test environment.
     """
 
+    utils_spice.reset_sessions()
+
     # Get the necessary parameters to run the tests
     log_test = params.get("logtest")
     qxl_logfile = params.get("qxl_log")
@@ -34,10 +37,10 @@ def run(test, params, env):
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
-    guest_root_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
+    guest_root_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     scriptdir = os.path.join("scripts", script)
@@ -47,11 +50,25 @@ def run(test, params, env):
     logging.info("Transferring the clipboard script to the guest,"
                  "destination directory: %s, source script location: %s",
                  dst_path, script_path)
-    guest_vm.copy_files_to(script_path, dst_path, timeout=60)
+    assets = [(script_path, os.path.join(dst_path, script))]
+    if params.get("cb_agent") == "yes":
+        agent_script = params.get("cb_agent_script", "cb_agent.py")
+        assets.append((os.path.join(data_dir.get_deps_dir(), "spice",
+                                    agent_script),
+                       os.path.join(dst_path, agent_script)))
+    utils_spice.deploy_vm_assets(guest_vm, assets, guest_session)
 
     # Some logging tests need the full desktop environment
     guest_session.cmd("export DISPLAY=:0.0")
 
+    plain_session = guest_session
+    cb_agents = []
+    if params.get("cb_agent") == "yes":
+        # Run the clipboard script in a long running agent
+        cb_agents = utils_spice.start_cb_agents([guest_vm], [guest_session],
+                                                params)
+        guest_session = cb_agents[0]
+
     # Logging test for the qxl driver
     if(log_test == 'qxl'):
         logging.info("Running the logging test for the qxl driver")
@@ -61,14 +78,13 @@ def run(test, params, env):
 
         # Check for RHEL6 or RHEL7
         # RHEL7 uses gsettings and RHEL6 uses gconftool-2
-        try:
-            release = guest_session.cmd("cat /etc/redhat-release")
-            logging.info("Redhat Release: %s" % release)
-        except:
+        facts = utils_spice.get_guest_facts(guest_vm, guest_session)
+        if not facts["release"]:
             raise error.TestNAError("Test is only currently supported on "
                                     "RHEL and Fedora operating systems")
+        logging.info("Redhat Release: %s" % facts["release"])
 
-        if "release 7." in release:
+        if facts["release_major"] == "7":
             spice_vdagent_loginfo_cmd = "journalctl" \
                                         " SYSLOG_IDENTIFIER=spice-vdagent" \
                                         " SYSLOG_IDENTIFIER=spice-vdagentd"
@@ -126,8 +142,11 @@ def run(test, params, env):
 
     else:
         # Couldn't find the right test to run
-        guest_session.close()
-        guest_root_session.close()
+        utils_spice.stop_cb_agents(cb_agents)
+        utils_spice.release_session(plain_session)
+        utils_spice.release_session(guest_root_session)
         raise error.TestFail("Couldn't find the right test to run,"
                              " check cfg files.")
-    guest_session.close()
+    utils_spice.stop_cb_agents(cb_agents)
+    utils_spice.release_session(plain_session)
+    utils_spice.release_session(guest_root_session)
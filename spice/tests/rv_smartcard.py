@@ -8,10 +8,69 @@ options to handle smartcards.
 
 """
 import logging
-from virttest import aexpect
+from virttest import aexpect, utils_spice
 from autotest.client.shared import error
 
 
+def check_pklogin_output(output, searchstr, cert_list, certstr, certcheck1,
+                         certcheck2):
+    """
+    Check that the output of pklogin_finder lists all the certificates.
+
+    After searchstr, the output has to contain for each certificate (in
+    order) certstr followed by the certificate number, its common name,
+    certcheck1 and certcheck2.
+
+    :param output: output of "pklogin_finder debug"
+    :param searchstr: string starting the list of certificates
+    :param cert_list: list of certificate names
+    :param certstr: prefix of the certificate number
+    :param certcheck1: first string expected after the common name
+    :param certcheck2: second string expected after the common name
+    :raise error.TestFail: when any of the expected strings is missing
+    """
+    testindex = output.find(searchstr)
+    if testindex < 0:
+        raise error.TestFail(searchstr + " not found in output of pklogin"
+                             " on the guest")
+    string_aftercheck = output[testindex:]
+
+    # Loop through the cert list. and check for the expected data
+    for index, cert in enumerate(cert_list):
+        subj_string = "CN=" + cert
+        checkstr = certstr + str(index + 1)
+        testindex = string_aftercheck.find(checkstr)
+        if testindex < 0:
+            raise error.TestFail(checkstr + " not found in output of "
+                                 "pklogin on the guest")
+        logging.debug("Found " + checkstr + "in output of pklogin")
+        string_aftercheck = string_aftercheck[testindex:]
+
+        testindex = string_aftercheck.find(subj_string)
+        if testindex < 0:
+            raise error.TestFail("Common name %s, not found "
+                                 "in pkogin_finder after software "
+                                 "smartcard was inserted into the "
+                                 "guest" % subj_string)
+        logging.debug("Found " + subj_string + "in output of pklogin")
+        string_aftercheck = string_aftercheck[testindex:]
+
+        testindex = string_aftercheck.find(certcheck1)
+        if testindex < 0:
+            raise error.TestFail(certcheck1 + " not found in "
+                                 "output of pklogin on the"
+                                 " guest")
+        logging.debug("Found " + certcheck1 + "in output of pklogin")
+        string_aftercheck = string_aftercheck[testindex:]
+
+        if string_aftercheck.find(certcheck2) < 0:
+            raise error.TestFail(certcheck2 + " not found"
+                                 " in output of pklogin "
+                                 "on the guest")
+        logging.debug("Found " + certcheck2 + "in output of pklogin")
+
+
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Tests disconnection of remote-viewer.
@@ -20,6 +79,8 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Get the required parameters needed for the tests
     cert_list = params.get("gencerts").split(",")
     cert_db = params.get("certdb")
@@ -33,15 +94,15 @@ def run(test, params, env):
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
 
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
     # Verify remote-viewer is running
     try:
@@ -97,54 +158,8 @@ def run(test, params, env):
             except:
                 raise error.TestFail("Test failed trying to get the output"
                                      " of pklogin_finder")
-        testindex = certsinfo_output.find(searchstr)
-        if testindex >= 0:
-            string_aftercheck = certsinfo_output[testindex:]
-
-            # Loop through the cert list. and check for the expected data, and
-            for index, cert in enumerate(cert_list):
-                subj_string = "CN=" + cert
-                checkstr = certstr + str(index + 1)
-                testindex = string_aftercheck.find(checkstr)
-                # print testindex
-                if testindex >= 0:
-                    logging.debug("Found " + checkstr + "in output of pklogin")
-                    string_aftercheck = string_aftercheck[testindex:]
-                    testindex2 = string_aftercheck.find(subj_string)
-                    if testindex >= 0:
-                        logging.debug("Found " + subj_string +
-                                      "in output of pklogin")
-                        string_aftercheck = string_aftercheck[testindex2:]
-                        testindex3 = string_aftercheck.find(certcheck1)
-                        if testindex3 >= 0:
-                            logging.debug("Found " + certcheck1 +
-                                          "in output of pklogin")
-                            string_aftercheck = string_aftercheck[testindex3:]
-                            testindex4 = string_aftercheck.find(certcheck2)
-                            if testindex4 >= 0:
-                                logging.debug("Found " + certcheck2 +
-                                              "in output of pklogin")
-                            else:
-                                raise error.TestFail(certcheck2 + " not found"
-                                                     " in output of pklogin "
-                                                     "on the guest")
-                        else:
-                            raise error.TestFail(certcheck1 + " not found in "
-                                                 "output of pklogin on the"
-                                                 " guest")
-                    else:
-                        raise error.TestFail("Common name %s, not found "
-                                             "in pkogin_finder after software "
-                                             "smartcard was inserted into the "
-                                             "guest" % subj_string)
-
-                else:
-                    raise error.TestFail(checkstr + " not found in output of "
-                                         "pklogin on the guest")
-
-        else:
-            raise error.TestFail(searchstr + " not found in output of pklogin"
-                                 " on the guest")
+        check_pklogin_output(certsinfo_output, searchstr, cert_list,
+                             certstr, certcheck1, certcheck2)
 
         logging.info("Certs Info on the guest:  " + certsinfo_output)
     else:
@@ -163,5 +178,5 @@ def run(test, params, env):
                 cert)
         logging.debug("Output of " + cmd + ": " + output)
 
-    client_session.close()
-    guest_session.close()
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_session)
@@ -0,0 +1,207 @@
+"""
+rv_tls_benchmark.py - TLS handshake rate of the spice TLS port
+
+Opens TLS sessions from the client VM to the spice TLS port of the guest
+with "openssl s_time" and measures the number of handshakes per second for
+each cipher list and number of parallel handshake loops. The handshake
+latency is measured by timing single "openssl s_client" handshakes.
+
+Requires: spice_ssl = yes, openssl on the client
+
+"""
+import logging
+import re
+from autotest.client.shared import error
+from virttest import utils_spice, utils_net
+
+# Channels remote-viewer opens when all of them are secure
+ALL_CHANNELS = "main,display,inputs,cursor,playback,record"
+
+
+def parse_s_time(output):
+    """
+    Parse the output of several "openssl s_time" runs.
+
+    :param output: concatenated output of s_time processes
+    :return: list of (connections, real seconds), one item per process
+    """
+    return [(int(match.group(1)), int(match.group(2)))
+            for match in re.finditer(r"(\d+) connections in (\d+) real "
+                                     r"seconds", output)]
+
+
+def parse_timed_handshakes(output):
+    """
+    Parse the output of run_timed_handshakes().
+
+    :param output: output of the handshake loop
+    :return: list of handshake durations in seconds
+    """
+    return [int(match.group(1)) / 1e9
+            for match in re.finditer(r"^HS (\d+)$", output, re.M)]
+
+
+def run_timed_handshakes(session, host, port, cacert, cipher, count):
+    """
+    Time single TLS handshakes done one after another by "openssl
+    s_client" on the client. Each duration includes the start of s_client.
+
+    :param session: session of the client VM
+    :param host: address of the spice server
+    :param port: spice TLS port
+    :param cacert: path of the CA certificate on the client
+    :param cipher: OpenSSL cipher list offered by the client
+    :param count: number of handshakes
+    :return: list of durations in seconds of the successful handshakes
+    """
+    cmd = ("for i in $(seq %d); do s=$(date +%%s%%N); echo | openssl "
+           "s_client -connect %s:%s -CAfile %s -cipher '%s' > /dev/null "
+           "2>&1 && echo \"HS $(($(date +%%s%%N) - s))\"; done"
+           % (count, host, port, cacert, cipher))
+    return parse_timed_handshakes(session.cmd_output(cmd,
+                                                     timeout=count * 10 + 60))
+
+
+def run_s_time(session, host, port, cacert, cipher, seconds, clients):
+    """
+    Run parallel "openssl s_time" handshake loops on the client.
+
+    :param session: session of the client VM
+    :param host: address of the spice server
+    :param port: spice TLS port
+    :param cacert: path of the CA certificate on the client
+    :param cipher: OpenSSL cipher list offered by the client
+    :param seconds: duration of each loop
+    :param clients: number of parallel loops
+    :return: list of (connections, real seconds), one item per loop
+    """
+    cmd = ("for i in $(seq %d); do openssl s_time -connect %s:%s "
+           "-CAfile %s -cipher '%s' -new -time %d > /tmp/s_time.$i 2>&1 & "
+           "done; wait; cat /tmp/s_time.*; rm -f /tmp/s_time.*"
+           % (clients, host, port, cacert, cipher, seconds))
+    output = session.cmd_output(cmd, timeout=seconds * 2 + 60)
+    results = parse_s_time(output)
+    if len(results) != clients:
+        logging.debug("s_time output: %s", output)
+    return results
+
+
+@utils_spice.traced_test
+def run(test, params, env):
+    """
+    Benchmark TLS handshakes against the spice TLS port of the guest.
+
+    The secure channels of the server (spice_secure_channels) are not
+    changed. A secure channel subset from tls_benchmark_channel_sets (";"
+    separated) only stands for the number of TLS handshakes one reconnect
+    of remote-viewer does: for every cipher list from tls_benchmark_ciphers
+    and every subset, as many parallel handshake loops as there are
+    channels in the subset times tls_benchmark_clients are started on the
+    client. Subsets and client counts giving the same number of loops
+    measure the same thing, so each number of loops is run once and the
+    reconnects it stands for are listed with it. s_time only reports
+    whole seconds per loop, so the per-loop mean time per handshake is
+    coarse; tls_benchmark_handshakes single handshakes are timed for the
+    latency percentiles of each cipher list.
+
+    :param test: QEMU test object.
+    :param params: Dictionary with the test parameters.
+    :param env: Dictionary with test environment.
+    """
+    utils_spice.reset_sessions()
+
+    guest_vm = env.get_vm(params["guest_vm"])
+    guest_vm.verify_alive()
+    if guest_vm.get_spice_var("spice_ssl") != "yes":
+        raise error.TestNAError("TLS benchmark needs spice_ssl = yes")
+
+    client_vm = env.get_vm(params["client_vm"])
+    client_vm.verify_alive()
+    if client_vm.params.get("os_type") == "windows":
+        raise error.TestNAError("TLS benchmark needs a linux client")
+
+    seconds = int(params.get("tls_benchmark_time", 10))
+    ciphers = params.get("tls_benchmark_ciphers",
+                         guest_vm.get_spice_var("spice_tls_ciphers") or
+                         "DEFAULT").split()
+    channel_sets = params.get("tls_benchmark_channel_sets")
+    if channel_sets:
+        channel_sets = channel_sets.split(";")
+    else:
+        channel_sets = ["main", params.get("spice_secure_channels", "main"),
+                        ALL_CHANNELS]
+    client_counts = [int(count) for count in
+                     params.get("tls_benchmark_clients", "1 4").split()]
+    handshakes = int(params.get("tls_benchmark_handshakes", 50))
+
+    host = utils_net.get_host_ip_address(params)
+    port = guest_vm.get_spice_var("spice_tls_port")
+    cacert = "%s/%s" % (guest_vm.get_spice_var("spice_x509_prefix"),
+                        guest_vm.get_spice_var("spice_x509_cacert_file"))
+
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
+    # The same CA certificate launch_rv hands to remote-viewer
+    utils_spice.deploy_file(client_session, cacert, cacert)
+
+    # Number of parallel loops -> reconnects it stands for
+    loads = {}
+    for channel_set in channel_sets:
+        channels = [channel.strip() for channel in channel_set.split(",")
+                    if channel.strip()]
+        for clients in client_counts:
+            loads.setdefault(clients * len(channels), []).append(
+                "%d x %s" % (clients, ",".join(channels)))
+
+    results = []
+    latencies = {}
+    failed = []
+    for cipher in ciphers:
+        durations = run_timed_handshakes(client_session, host, port, cacert,
+                                         cipher, handshakes)
+        latencies[cipher] = utils_spice.summarize(durations)
+        if durations:
+            logging.info("cipher %s: handshake p50 %.2f ms, p95 %.2f ms, "
+                         "p99 %.2f ms (%d of %d)", cipher,
+                         latencies[cipher]["p50"] * 1000,
+                         latencies[cipher]["p95"] * 1000,
+                         latencies[cipher]["p99"] * 1000, len(durations),
+                         handshakes)
+        for loops in sorted(loads):
+            runs = run_s_time(client_session, host, port, cacert, cipher,
+                              seconds, loops)
+            connections = sum(count for count, _ in runs)
+            case = {"cipher": cipher, "loops": loops,
+                    "reconnects": loads[loops], "connections": connections}
+            if not connections:
+                logging.error("No TLS handshake succeeded with cipher '%s'",
+                              cipher)
+                failed.append(case)
+                results.append(case)
+                continue
+            # Whole seconds of each loop divided by its handshakes
+            loop_means = [float(real) / count for count, real in runs
+                          if count]
+            case["handshakes_per_sec"] = connections / float(seconds)
+            case["loop_mean_handshake_time"] = utils_spice.summarize(
+                loop_means)
+            results.append(case)
+            logging.info("cipher %s, %d parallel handshake loops (%s "
+                         "reconnecting): %.1f handshakes/s, %.2f ms per "
+                         "handshake and loop", cipher, loops,
+                         "; ".join(loads[loops]),
+                         case["handshakes_per_sec"],
+                         case["loop_mean_handshake_time"]["mean"] * 1000)
+
+    utils_spice.release_session(client_session)
+    # The secure channels of the server are the same in every case
+    secure_channels = guest_vm.get_spice_var("spice_secure_channels")
+    utils_spice.write_results_json(test, "rv_tls_benchmark",
+                                   {"shortname": params.get("shortname"),
+                                    "time": seconds, "results": results,
+                                    "secure_channels": secure_channels,
+                                    "handshake_latency": latencies})
+    if failed:
+        raise error.TestFail("TLS handshakes failed for cipher lists: %s" %
+                             ", ".join(sorted(set(case["cipher"]
+                                                  for case in failed))))
@@ -9,6 +9,7 @@ from autotest.client.shared import error
 from virttest import utils_spice
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Tests spice vdagent (starting, stopping, restarting, and status)
@@ -17,20 +18,22 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Get necessary params
     test_timeout = float(params.get("test_timeout", 600))
     vdagent_test = params.get("vdagent_test")
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_root_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_root_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)))
 
     vdagent_status = utils_spice.get_vdagent_status(
         guest_root_session, test_timeout)
@@ -103,5 +106,5 @@ def run(test, params, env):
     else:
         raise error.TestFail("No test to run, check value of vdagent_test")
 
-    client_session.close()
-    guest_root_session.close()
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_root_session)
@@ -9,21 +9,20 @@ Requires: binaries Xorg, totem, gnome-session
 """
 import logging
 import os
-import time
 import re
 from autotest.client.shared import error
-from virttest import utils_misc, remote
+from virttest import utils_misc, utils_spice
 
 
-def launch_totem(guest_session, params):
+def launch_totem(guest_vm, guest_session, params):
     """
     Launch Totem player
 
     :param guest_vm - vm object
     """
 
-    totem_version = guest_session.cmd_output("totem --version")
-    logging.info("Totem version: %s" % totem_version)
+    facts = utils_spice.get_guest_facts(guest_vm, guest_session)
+    logging.info("Totem version: %s" % facts["rpms"].get("totem"))
 
     # repeat parameters for totem
     logging.info("Set up video repeat to '%s' to the Totem.",
@@ -31,17 +30,12 @@ def launch_totem(guest_session, params):
 
     # Check for RHEL6 or RHEL7
     # RHEL7 uses gsettings and RHEL6 uses gconftool-2
-    try:
-        release = guest_session.cmd("cat /etc/redhat-release")
-        logging.info("Redhat Release: %s" % release)
-    except:
+    if not facts["release"]:
         raise error.TestNAError("Test is only currently supported on "
                                 "RHEL and Fedora operating systems")
+    logging.info("Redhat Release: %s" % facts["release"])
 
-    cmd = "export DISPLAY=:0.0"
-    guest_session.cmd(cmd)
-
-    if "release 6." in release:
+    if facts["release_major"] == "6":
         cmd = "gconftool-2 --set /apps/totem/repeat -t bool"
         totem_params = "--display=:0.0 --play"
     else:
@@ -52,10 +46,6 @@ def launch_totem(guest_session, params):
         cmd += " true"
     else:
         cmd += " false"
-    guest_session.cmd(cmd)
-
-    cmd = "export DISPLAY=:0.0"
-    guest_session.cmd(cmd)
 
     # Fullscreen parameters for totem
     if params.get("fullscreen", "no") == "yes":
@@ -63,26 +53,32 @@ def launch_totem(guest_session, params):
     else:
         fullscreen = ""
 
-    cmd = "nohup totem %s %s --display=:0.0 &> /dev/null &" \
-          % (fullscreen, params.get("destination_video_file_path"))
-    guest_session.cmd(cmd)
-
-    time.sleep(10)
-
-    cmd = "pgrep totem"
-    pid = guest_session.cmd_output(cmd)
-    if pid:
-        logging.info("PID: %s" % pid)
-
-        if not re.search("^(\d+)", pid):
-            logging.info("Could not find Totem running! Try starting again!")
-            # Sometimes totem doesn't start properly; try again
-            cmd = "nohup totem %s %s --display=:0.0 &> /dev/null &" \
-                  % (fullscreen, params.get("destination_video_file_path"))
-            guest_session.cmd(cmd)
-            cmd = "pgrep totem"
-            pid = guest_session.cmd_output(cmd)
-            logging.info("PID: %s" % pid)
+    launch_cmd = "nohup totem %s %s --display=:0.0 &> /dev/null &" \
+                 % (fullscreen, params.get("destination_video_file_path"))
+    _, repeat, _ = utils_spice.cmd_batch(guest_session,
+                                         ["export DISPLAY=:0.0", cmd,
+                                          launch_cmd], timeout=60)
+    if repeat.status:
+        raise error.TestFail("Setting up video repeat failed: %s" %
+                             repeat.output)
+
+    def totem_pid():
+        pid = guest_session.cmd_output("pgrep totem").strip()
+        if re.search(r"^(\d+)", pid):
+            return pid
+        return None
+
+    start_timeout = float(params.get("totem_start_timeout", 10))
+    pid, _ = utils_spice.wait_for_condition(
+        totem_pid, start_timeout, step=0.5, text="Waiting for totem to start")
+    if not pid:
+        logging.info("Could not find Totem running! Try starting again!")
+        # Sometimes totem doesn't start properly; try again
+        guest_session.cmd(launch_cmd)
+        pid, _ = utils_spice.wait_for_condition(
+            totem_pid, start_timeout, step=0.5,
+            text="Waiting for totem to start again")
+    logging.info("PID: %s" % pid)
 
 
 def deploy_video_file(test, vm_obj, params):
@@ -96,14 +92,13 @@ def deploy_video_file(test, vm_obj, params):
     video_dir = os.path.join("deps", source_video_file)
     video_path = utils_misc.get_path(test.virtdir, video_dir)
 
-    remote.copy_files_to(vm_obj.get_address(), 'scp',
-                         params.get("username"),
-                         params.get("password"),
-                         params.get("shell_port"),
-                         video_path,
-                         params.get("destination_video_file_path"))
+    utils_spice.deploy_assets([vm_obj],
+                              [(video_path,
+                                params.get("destination_video_file_path"))])
 
 
+@utils_spice.traced_test
+@utils_spice.sampled_test
 def run(test, params, env):
     """
     Test of video through spice
@@ -112,11 +107,26 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)))
     deploy_video_file(test, guest_vm, params)
 
-    launch_totem(guest_session, params)
-    guest_session.close()
+    vms = [guest_vm]
+    if params.get("client_vm"):
+        vms.append(env.get_vm(params["client_vm"]))
+    samplers = utils_spice.start_process_samplers(
+        vms, params,
+        utils_misc.get_path(test.virtdir,
+                            os.path.join("deps", params.get(
+                                "proc_sampler_script", "proc_sampler.py"))))
+
+    launch_totem(guest_vm, guest_session, params)
+    if samplers:
+        # Totem keeps playing after the test, sample a part of it
+        utils_spice.wait_timeout(float(params.get("proc_sampler_time", 60)))
+        utils_spice.stop_process_samplers(samplers, test)
+    utils_spice.release_session(guest_session)
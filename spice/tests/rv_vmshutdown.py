@@ -13,6 +13,7 @@ from virttest import utils_misc
 from virttest import utils_net
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Tests clean exit after shutting down the VM.
@@ -29,6 +30,7 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
 
     # Get the required variables
     rv_binary = params.get("rv_binary", "remote-viewer")
@@ -40,14 +42,14 @@ def run(test, params, env):
 
     guest_vm = env.get_vm(params["guest_vm"])
     guest_vm.verify_alive()
-    guest_session = guest_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    guest_session = utils_spice.lease_session(
+        guest_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
     if guest_vm.get_spice_var("spice_ssl") == "yes":
@@ -103,3 +105,6 @@ def run(test, params, env):
         raise error.TestFail("Remote-viewer is still running on the client.")
     except ShellCmdError:
         logging.info("Remote-viewer process is not running as expected.")
+
+    utils_spice.release_session(client_session)
+    utils_spice.release_session(guest_session)
@@ -13,6 +13,7 @@ from virttest import utils_misc, utils_spice, aexpect
 from autotest.client.shared import error
 
 
+@utils_spice.traced_test
 def run(test, params, env):
     """
     Simple setup test to create certs on the client to be passed to VM's
@@ -22,6 +23,8 @@ def run(test, params, env):
     :param params: Dictionary with the test parameters.
     :param env: Dictionary with test environment.
     """
+    utils_spice.reset_sessions()
+
     # Get necessary params
     cert_list = params.get("gencerts").split(",")
     cert_db = params.get("certdb")
@@ -38,13 +41,13 @@ def run(test, params, env):
     client_vm = env.get_vm(params["client_vm"])
     client_vm.verify_alive()
 
-    client_session = client_vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)),
+    client_session = utils_spice.lease_session(
+        client_vm, timeout=int(params.get("login_timeout", 360)),
         username="root", password="123456")
 
-    for vm in params.get("vms").split():
-        utils_spice.clear_interface(env.get_vm(vm),
-                                    int(params.get("login_timeout", "360")))
+    utils_spice.clear_interfaces([env.get_vm(vm)
+                                  for vm in params.get("vms").split()],
+                                 int(params.get("login_timeout", "360")))
 
     # generate a random string, used to create a random key for the certs
     randomstring = utils_misc.generate_random_string(2048)
@@ -74,4 +77,4 @@ def run(test, params, env):
         if not(cert in output):
             raise error.TestFail("Certificate %s not found" % cert)
 
-    client_session.close()
+    utils_spice.release_session(client_session)
@@ -6,9 +6,28 @@ import os
 import logging
 import time
 import sys
-from autotest.client.shared import error
+import re
+import random
+import socket
+import struct
+import threading
+import collections
+import functools
+import json
+import base64
+import csv
+import hashlib
+import shlex
+import tarfile
+import tempfile
+from autotest.client.shared import error, utils
 from aexpect import ShellCmdError, ShellStatusError
-from virttest import utils_net, utils_misc
+from virttest import utils_net, remote, qemu_monitor
+
+# Upper limit for waiting on a service or device to settle
+SERVICE_TIMEOUT = 30
+# Upper limit for waiting on X/gdm to come back after a restart
+DISPLAY_TIMEOUT = 180
 
 
 class RVConnectError(Exception):
@@ -17,6 +36,176 @@ class RVConnectError(Exception):
     pass
 
 
+class SessionPool(object):
+
+    """
+    Pool of reusable login sessions keyed by (VM name, username).
+
+    Sessions are handed out by lease() and given back by release(). A
+    returned session is health-checked before it is leased again, dead
+    sessions are dropped and replaced by a fresh login.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(vm, username):
+        return (vm.name, username or vm.params.get("username"))
+
+    @staticmethod
+    def _is_healthy(session):
+        try:
+            return (session.is_alive() and
+                    session.cmd_status("echo", timeout=10) == 0)
+        except Exception:
+            return False
+
+    def lease(self, vm, username=None, password=None, timeout=None):
+        """
+        Return a healthy session to vm, log in only if there is none idle.
+
+        :param vm: VM object
+        :param username: user to log in as, defaults to vm's username
+        :param password: password of the user
+        :param timeout: login timeout, defaults to vm's login_timeout
+        """
+        key = self._key(vm, username)
+        while True:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(key)
+                session = idle and idle.pop()
+            finally:
+                self._lock.release()
+            if not session:
+                break
+            if self._is_healthy(session):
+                logging.debug("Reusing session %s@%s", key[1], key[0])
+                break
+            logging.debug("Dropping dead session %s@%s", key[1], key[0])
+            session.close()
+
+        if not session:
+            if timeout is None:
+                timeout = int(vm.params.get("login_timeout", 360))
+            kwargs = {"timeout": timeout}
+            if username:
+                kwargs["username"] = username
+            if password:
+                kwargs["password"] = password
+            session = vm.wait_for_login(**kwargs)
+
+        self._lock.acquire()
+        try:
+            self._leased[id(session)] = (key, session)
+        finally:
+            self._lock.release()
+        return session
+
+    def release(self, session):
+        """
+        Return a leased session to the pool. Sessions that were not
+        leased from the pool are closed.
+
+        :param session: session returned by lease()
+        """
+        self._lock.acquire()
+        try:
+            entry = self._leased.pop(id(session), None)
+            if entry:
+                self._idle.setdefault(entry[0], []).append(session)
+        finally:
+            self._lock.release()
+        if not entry:
+            session.close()
+
+    def reset(self):
+        """
+        Return all leased sessions and drop the dead ones. Meant to be
+        called between tests.
+        """
+        self._lock.acquire()
+        try:
+            for key, session in self._leased.values():
+                self._idle.setdefault(key, []).append(session)
+            self._leased.clear()
+            for key, sessions in self._idle.items():
+                alive = [_ for _ in sessions if _.is_alive()]
+                for session in sessions:
+                    if session not in alive:
+                        session.close()
+                self._idle[key] = alive
+        finally:
+            self._lock.release()
+
+    def sessions(self):
+        """
+        Return (VM name, session) of every session known to the pool.
+        """
+        self._lock.acquire()
+        try:
+            known = [(key[0], session)
+                     for key, session in self._leased.values()]
+            for key, sessions in self._idle.items():
+                known.extend((key[0], session) for session in sessions)
+        finally:
+            self._lock.release()
+        return known
+
+    def close_all(self):
+        """
+        Close every session known to the pool.
+        """
+        self.reset()
+        self._lock.acquire()
+        try:
+            for sessions in self._idle.values():
+                for session in sessions:
+                    session.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+
+_SESSION_POOL = SessionPool()
+
+
+def lease_session(vm, username=None, password=None, timeout=None):
+    """
+    Lease a session to vm from the shared session pool.
+
+    :param vm: VM object
+    :param username: user to log in as, defaults to vm's username
+    :param password: password of the user
+    :param timeout: login timeout, defaults to vm's login_timeout
+    """
+    return _SESSION_POOL.lease(vm, username, password, timeout)
+
+
+def release_session(session):
+    """
+    Give a session back to the shared session pool.
+
+    :param session: session returned by lease_session()
+    """
+    _SESSION_POOL.release(session)
+
+
+def reset_sessions():
+    """
+    Return all leased sessions to the shared pool, drop the dead ones.
+    Clipboard agents and process samplers left running by a failed test
+    are stopped.
+    """
+    _SESSION_POOL.reset()
+    stop_cb_agents(list(_CB_AGENTS))
+    for sampler in list(_PROC_SAMPLERS):
+        sampler.close()
+
+
 def _is_pid_alive(session, pid):
 
     try:
@@ -37,6 +226,775 @@ def wait_timeout(timeout=10):
     time.sleep(timeout)
 
 
+class Tracer(object):
+
+    """
+    Collect timing spans of the expensive operations done by a test.
+
+    Spans are recorded as Chrome trace events (chrome://tracing, Perfetto).
+    Calls made while another span is open in the same thread (e.g.
+    session.cmd() calling session.cmd_output(), or the commands polled by
+    wait_for_condition()) are accounted to the outer span only.
+    """
+
+    # (attribute, category) pairs instrumented on VM, monitor and session
+    # objects
+    VM_METHODS = [("wait_for_login", "login"),
+                  ("wait_for_serial_login", "login"),
+                  ("copy_files_to", "scp"),
+                  ("copy_files_from", "scp"),
+                  ("send_key", "input"),
+                  ("migrate", "migration")]
+    MONITOR_METHODS = [("cmd", "monitor")]
+    SESSION_METHODS = [("cmd", "cmd"),
+                       ("cmd_output", "cmd"),
+                       ("cmd_status", "cmd"),
+                       ("cmd_status_output", "cmd")]
+
+    def __init__(self):
+        self.events = []
+        self._patched = []
+        self._local = threading.local()
+        self._start = time.time()
+
+    def record(self, name, category, start, end, args=None):
+        """
+        Store one finished span.
+
+        :param name: name of the span
+        :param category: category used for the summary
+        :param start: start time as returned by time.time()
+        :param end: end time as returned by time.time()
+        :param args: dict of extra details shown in the trace viewer
+        """
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": int(start * 1000000),
+                 "dur": int((end - start) * 1000000),
+                 "pid": os.getpid(), "tid": threading.current_thread().ident}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def wrap(self, func, category, describe=None):
+        """
+        Return func wrapped in a span of the given category.
+
+        :param func: callable to be traced
+        :param category: category of the span
+        :param describe: callable returning (name, args) for the call
+        """
+        tracer = self
+
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            if getattr(tracer._local, "busy", False):
+                return func(*args, **kwargs)
+            if describe:
+                name, details = describe(*args, **kwargs)
+            else:
+                name, details = func.__name__, None
+            tracer._local.busy = True
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.record(name, category, start, time.time(), details)
+                tracer._local.busy = False
+        return traced
+
+    def patch(self, obj, attr, category, describe=None):
+        """
+        Replace obj.attr with a traced version; undone by restore().
+
+        :param obj: object, class instance or module
+        :param attr: name of the callable attribute
+        :param category: category of the span
+        :param describe: callable returning (name, args) for the call
+        """
+        orig = getattr(obj, attr, None)
+        if orig is None or getattr(orig, "_spice_traced", False):
+            return
+        own = attr in getattr(obj, "__dict__", {})
+        traced = self.wrap(orig, category, describe)
+        traced._spice_traced = True
+        setattr(obj, attr, traced)
+        self._patched.append((obj, attr, orig, own))
+
+    def instrument_session(self, session, vm_name):
+        """
+        Trace the command methods of an aexpect session.
+
+        :param session: session returned by the VM
+        :param vm_name: name of the VM, stored with each span
+        """
+        def describe(cmd, *args, **kwargs):
+            return cmd[:60], {"vm": vm_name, "cmd": cmd}
+        for attr, category in self.SESSION_METHODS:
+            self.patch(session, attr, category, describe)
+        return session
+
+    def instrument_vm(self, vm):
+        """
+        Trace logins, file transfers, key presses and monitor commands
+        of a VM. Sessions returned by the VM are instrumented as well.
+
+        :param vm: VM object
+        """
+        def describe_by(attr):
+            return lambda *args, **kwargs: (attr, {"vm": vm.name})
+
+        for attr, category in self.VM_METHODS:
+            self.patch(vm, attr, category, describe_by(attr))
+
+        login = vm.__dict__.get("wait_for_login")
+        if login is not None and getattr(login, "_spice_traced", False):
+            def wait_for_login(*args, **kwargs):
+                return self.instrument_session(login(*args, **kwargs),
+                                               vm.name)
+            wait_for_login._spice_traced = True
+            vm.wait_for_login = wait_for_login
+
+        for monitor in getattr(vm, "monitors", None) or []:
+            self.patch(monitor, "cmd", "monitor",
+                       lambda cmd, *args, **kwargs: (cmd, {"vm": vm.name}))
+
+    def instrument(self, env):
+        """
+        Trace all VMs of the environment and the sessions pooled by earlier
+        tests plus the sleeps of utils_spice and the scp helpers of
+        virttest.remote.
+
+        :param env: Dictionary with test environment.
+        """
+        for vm in env.get_all_vms():
+            self.instrument_vm(vm)
+        for vm_name, session in _SESSION_POOL.sessions():
+            self.instrument_session(session, vm_name)
+        this = sys.modules[__name__]
+        self.patch(this, "wait_timeout", "sleep",
+                   lambda timeout=10: ("wait_timeout(%s)" % timeout, None))
+        self.patch(this, "wait_for_condition", "wait",
+                   lambda func, timeout, *args, **kwargs:
+                   (kwargs.get("text") or "wait_for_condition", None))
+        self.patch(remote, "copy_files_to", "scp",
+                   lambda address, *args, **kwargs:
+                   ("copy_files_to %s" % address, None))
+        self.patch(remote, "copy_files_from", "scp",
+                   lambda address, *args, **kwargs:
+                   ("copy_files_from %s" % address, None))
+
+    def restore(self):
+        """
+        Undo all patches, so the VMs can be pickled with the environment.
+        """
+        while self._patched:
+            obj, attr, orig, own = self._patched.pop()
+            if own:
+                setattr(obj, attr, orig)
+            else:
+                try:
+                    delattr(obj, attr)
+                except AttributeError:
+                    pass
+
+    def summary(self):
+        """
+        Return list of (category, total seconds, count) sorted by the total
+        time spent. The span of the whole test is left out.
+        """
+        totals = {}
+        for event in self.events:
+            if event["cat"] == "test":
+                continue
+            total, count = totals.get(event["cat"], (0, 0))
+            totals[event["cat"]] = (total + event["dur"] / 1000000.0,
+                                    count + 1)
+        result = [(cat, spent, calls)
+                  for cat, (spent, calls) in totals.items()]
+        return sorted(result, key=lambda item: item[1], reverse=True)
+
+    def log_summary(self):
+        """
+        Log the time spent in each category.
+        """
+        elapsed = max(time.time() - self._start, 1e-6)
+        logging.info("Time spent by category (wall clock %.2fs, summed over "
+                     "threads):", elapsed)
+        traced = 0
+        for category, total, count in self.summary():
+            traced += total
+            logging.info("  %-10s %8.2fs %5.1f%% in %d calls", category,
+                         total, total * 100 / elapsed, count)
+        other = max(elapsed - traced, 0)
+        logging.info("  %-10s %8.2fs %5.1f%%", "other", other,
+                     other * 100 / elapsed)
+
+    def write(self, path):
+        """
+        Write the spans as Chrome trace-event JSON.
+
+        :param path: path of the output file
+        """
+        trace = open(path, "w")
+        try:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, trace)
+        finally:
+            trace.close()
+
+
+TRACE_FILE = "spice_trace.json"
+
+
+def traced_test(run):
+    """
+    Decorator for the run() function of spice tests.
+
+    VMs, their sessions and monitors and the sleep helpers are traced for
+    the duration of the test. The trace is written to TRACE_FILE in the
+    results directory and a per-category summary is logged.
+    """
+    @functools.wraps(run)
+    def traced_run(test, params, env):
+        tracer = Tracer()
+        tracer.instrument(env)
+        start = time.time()
+        try:
+            return run(test, params, env)
+        finally:
+            tracer.record(run.__module__, "test", start, time.time())
+            tracer.restore()
+            tracer.log_summary()
+            try:
+                tracer.write(os.path.join(test.resultsdir, TRACE_FILE))
+            except (IOError, AttributeError), err:
+                logging.warning("Could not write trace: %s", err)
+    return traced_run
+
+
+def wait_for_condition(func, timeout, first=0.0, step=0.1, max_step=2.0,
+                       text=None):
+    """
+    Poll func() with exponential backoff until it returns a true value
+    or the deadline passes.
+
+    :param func: predicate to be polled
+    :param timeout: deadline in seconds
+    :param first: time to sleep before the first attempt
+    :param step: initial delay between attempts, doubled after each attempt
+    :param max_step: upper limit of the delay between attempts
+    :param text: description of the condition, used for logging
+    :return: tuple (last value returned by func, seconds actually waited)
+    """
+    start = time.time()
+    end = start + timeout
+    if first:
+        time.sleep(first)
+    while True:
+        output = func()
+        now = time.time()
+        if output or now >= end:
+            break
+        time.sleep(min(step, max_step, end - now))
+        step *= 2
+    waited = time.time() - start
+    if text:
+        if output:
+            logging.debug("%s: done after %.2fs", text, waited)
+        else:
+            logging.debug("%s: timed out after %.2fs", text, waited)
+    return output, waited
+
+
+def percentile(values, pct):
+    """
+    Return the pct-th percentile of values, interpolating linearly between
+    the closest ranks.
+
+    :param values: list of numbers
+    :param pct: percentile, 0-100
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values, points=(50, 90, 95, 99)):
+    """
+    Return dict with count, min, mean, max and the given percentiles
+    (keys p50, p90, ...) of values.
+
+    :param values: list of numbers
+    :param points: percentiles to be computed
+    """
+    summary = {"count": len(values)}
+    if not values:
+        return summary
+    summary["min"] = min(values)
+    summary["max"] = max(values)
+    summary["mean"] = sum(values) / float(len(values))
+    for point in points:
+        summary["p%d" % point] = percentile(values, point)
+    return summary
+
+
+def _cmd_succeeds(session, cmd):
+    try:
+        return session.cmd_status(cmd) == 0
+    except ShellStatusError:
+        return False
+
+
+def is_service_active(session, service):
+    """
+    Return True when the init script reports the service as running.
+
+    :param session: ssh session of the VM
+    :param service: name of the service
+    """
+    return _cmd_succeeds(session, "service %s status" % service)
+
+
+def is_path_present(session, path):
+    """
+    Return True when path exists inside the VM.
+
+    :param session: ssh session of the VM
+    :param path: path to be checked
+    """
+    return _cmd_succeeds(session, "test -e %s" % path)
+
+
+def is_process_gone(session, name):
+    """
+    Return True when no process of the given name is running in the VM.
+
+    :param session: ssh session of the VM
+    :param name: exact process name
+    """
+    return not _cmd_succeeds(session, "pgrep -x %s" % name)
+
+
+def is_display_ready(session, display=":0.0"):
+    """
+    Return True when the X server accepts connections on the display.
+
+    :param session: ssh session of the user logged into the desktop
+    :param display: X display to be checked
+    """
+    return _cmd_succeeds(session, "DISPLAY=%s xset q" % display)
+
+
+def is_window_shown(session, title, display=":0.0"):
+    """
+    Return True when a window of the given title exists on the display.
+
+    :param session: ssh session of the user logged into the desktop
+    :param title: exact window title, e.g. "Authentication required"
+    :param display: X display to be searched
+    """
+    return _cmd_succeeds(session, "xwininfo -display %s -name '%s'" %
+                         (display, title))
+
+
+BatchResult = collections.namedtuple("BatchResult", ["status", "output"])
+
+
+def cmd_batch(session, commands, timeout=60):
+    """
+    Run several shell commands in a single round trip.
+
+    The commands run one after another in the session's own shell, so
+    exported variables stay set. Output of each command is framed by
+    unique markers and split afterwards.
+
+    :param session: ssh session of a linux VM
+    :param commands: list of shell commands
+    :param timeout: timeout for the whole batch
+    :return: list of BatchResult(status, output), one per command
+    """
+    token = "SPICE_BATCH_%08x" % random.getrandbits(32)
+    parts = []
+    for index, command in enumerate(commands):
+        command = command.strip()
+        if not command.endswith("&"):
+            command += ";"
+        parts.append("echo %s_B_%d; { %s } 2>&1; echo %s_E_%d:$?" %
+                     (token, index, command, token, index))
+    output = session.cmd_output("; ".join(parts), timeout=timeout)
+
+    results = {}
+    regex = re.compile(r"%s_B_(\d+)\r?\n(.*?)%s_E_\1:(\d+)" %
+                       (token, token), re.DOTALL)
+    for match in regex.finditer(output):
+        results[int(match.group(1))] = BatchResult(int(match.group(3)),
+                                                   match.group(2))
+    if len(results) != len(commands):
+        logging.debug("Batch output: %s", output)
+        raise error.TestError("Output of batched commands is incomplete, "
+                              "got %d of %d results" %
+                              (len(results), len(commands)))
+    results = [results[index] for index in range(len(commands))]
+    for command, result in zip(commands, results):
+        logging.debug("[%s] %s: %s", result.status, command,
+                      result.output.rstrip())
+    return results
+
+
+# Base64 characters sent by one command, keeps the command line well
+# below the 4096 bytes a terminal accepts
+SEND_CHUNK = 2048
+
+
+def file_digest(path, algorithm="sha1"):
+    """
+    Return the hex digest of a local file.
+
+    :param path: path of the file
+    :param algorithm: name of a hashlib algorithm
+    """
+    digest = hashlib.new(algorithm)
+    source = open(path, "rb")
+    try:
+        for block in iter(lambda: source.read(1 << 16), ""):
+            digest.update(block)
+    finally:
+        source.close()
+    return digest.hexdigest()
+
+
+def send_file(session, local_path, remote_path):
+    """
+    Write a small local file to a linux VM through an open session.
+
+    The content is sent base64 encoded in SEND_CHUNK sized commands, so
+    no new scp connection is needed.
+
+    :param session: ssh session of the VM
+    :param local_path: path of the file on the host
+    :param remote_path: destination path in the VM
+    """
+    source = open(local_path, "rb")
+    try:
+        data = base64.b64encode(source.read())
+    finally:
+        source.close()
+    encoded = remote_path + ".b64"
+    session.cmd("mkdir -p %s && rm -f %s" % (os.path.dirname(remote_path),
+                                             encoded))
+    for start in xrange(0, len(data), SEND_CHUNK):
+        session.cmd("echo -n '%s' >> %s" % (data[start:start + SEND_CHUNK],
+                                            encoded))
+    session.cmd("base64 -d %s > %s && rm -f %s" % (encoded, remote_path,
+                                                   encoded))
+
+
+def deploy_file(session, local_path, remote_path):
+    """
+    Make sure a linux VM has an identical copy of a local file.
+
+    The SHA-1 of the local file is compared with the one of the copy in the
+    VM and the file is only sent (over the given session) when they differ.
+
+    :param session: ssh session of the VM
+    :param local_path: path of the file on the host
+    :param remote_path: destination path in the VM
+    :return: True when the file was transferred
+    """
+    local_digest = file_digest(local_path)
+    output = session.cmd_output("sha1sum %s 2>/dev/null" % remote_path)
+    if output.split()[:1] == [local_digest]:
+        logging.debug("%s is up to date (sha1 %s)", remote_path, local_digest)
+        return False
+    logging.debug("Sending %s to %s", local_path, remote_path)
+    send_file(session, local_path, remote_path)
+    output = session.cmd_output("sha1sum %s" % remote_path)
+    if output.split()[:1] != [local_digest]:
+        raise error.TestError("Checksum of %s differs after the transfer"
+                              % remote_path)
+    return True
+
+
+# Where the archive of missing assets is unpacked from in the VMs
+ASSET_BUNDLE = "/tmp/spice_assets.tar.gz"
+
+
+def _bundle_assets(assets):
+    # One gzipped tar with the files at their destination paths
+    handle, path = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(handle)
+    bundle = tarfile.open(path, "w:gz")
+    try:
+        for local_path, remote_path in assets:
+            bundle.add(local_path, arcname=remote_path.lstrip("/"))
+    finally:
+        bundle.close()
+    return path
+
+
+def _remote_digests(session, remote_paths):
+    # SHA-1 of the given paths in one call, keyed by the given paths
+    output = session.cmd_output("sha1sum %s 2>/dev/null"
+                                % " ".join(remote_paths.values()))
+    by_real_path = dict((real, path) for path, real in remote_paths.items())
+    digests = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2 and fields[1].strip() in by_real_path:
+            digests[by_real_path[fields[1].strip()]] = fields[0]
+    return digests
+
+
+def deploy_vm_assets(vm, assets, session=None, timeout=300):
+    """
+    Make sure a VM has identical copies of local files.
+
+    The SHA-1 of every file is compared with the copies in the VM, checked
+    with a single sha1sum call each time, so a reboot or a cleaned /tmp
+    is noticed. Missing or different files are sent as one compressed tar
+    archive. Windows VMs get all files copied one by one.
+
+    :param vm: VM object
+    :param assets: list of (local path, destination path) tuples, the
+                   destination is absolute or relative to the home (~/)
+    :param session: ssh session of the VM, leased from the pool if None
+    :param timeout: transfer timeout
+    :return: list of the destination paths which were transferred
+    """
+    if vm.params.get("os_type") == "windows":
+        for local_path, remote_path in assets:
+            vm.copy_files_to(local_path, remote_path, timeout=timeout)
+        return [remote_path for _, remote_path in assets]
+
+    wanted = dict((remote_path, file_digest(local_path))
+                  for local_path, remote_path in assets)
+    leased = session is None
+    if leased:
+        session = lease_session(vm)
+    try:
+        real_paths = dict((path, path) for path in wanted)
+        if [path for path in wanted if path.startswith("~/")]:
+            home = session.cmd_output("echo $HOME").strip()
+            for path in wanted:
+                if path.startswith("~/"):
+                    real_paths[path] = home + path[1:]
+        digests = _remote_digests(session, real_paths)
+        missing = [(local_path, remote_path)
+                   for local_path, remote_path in assets
+                   if digests.get(remote_path) != wanted[remote_path]]
+        if not missing:
+            logging.debug("%s: all %d assets are up to date", vm.name,
+                          len(assets))
+            return []
+        logging.info("%s: deploying %s", vm.name,
+                     ", ".join(path for _, path in missing))
+        bundle = _bundle_assets([(local_path, real_paths[remote_path])
+                                 for local_path, remote_path in missing])
+        try:
+            vm.copy_files_to(bundle, ASSET_BUNDLE, timeout=timeout)
+        finally:
+            os.remove(bundle)
+        session.cmd("tar -xzf %s -C / && rm -f %s"
+                    % (ASSET_BUNDLE, ASSET_BUNDLE), timeout=timeout)
+        sent = [path for _, path in missing]
+        digests = _remote_digests(
+            session, dict((path, real_paths[path]) for path in sent))
+        for path in sent:
+            if digests.get(path) != wanted[path]:
+                raise error.TestError("Checksum of %s differs after the "
+                                      "transfer to %s" % (path, vm.name))
+    finally:
+        if leased:
+            release_session(session)
+    return sent
+
+
+def deploy_assets(vms, assets, timeout=300):
+    """
+    Deploy the same local files to several VMs at the same time.
+
+    :param vms: list of VM objects
+    :param assets: list of (local path, destination path) tuples
+    :param timeout: transfer timeout
+    :return: dict mapping VM names to the transferred destination paths
+    """
+    threads = []
+    for vm in vms:
+        thread = utils.InterruptedThread(deploy_vm_assets, (vm, assets),
+                                         {"timeout": timeout})
+        thread.start()
+        threads.append((vm, thread))
+
+    sent = {}
+    errors = []
+    for vm, thread in threads:
+        try:
+            sent[vm.name] = thread.join()
+        except Exception:
+            errors.append(sys.exc_info())
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return sent
+
+
+# Random id the kernel generates on every boot
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+
+def probe_guest_facts(session):
+    """
+    Collect OS release, architecture, kernel, installed RPMs and boot id of
+    a linux VM in a single round trip.
+
+    :param session: ssh session of the VM
+    :return: dict with keys release, release_major, arch, kernel, rpms
+             (dict mapping package names to version-release) and boot_id
+    """
+    release, arch, kernel, rpms, boot_id = cmd_batch(
+        session, ["cat /etc/redhat-release", "arch", "uname -r",
+                  "rpm -qa --qf '%{NAME} %{VERSION}-%{RELEASE}\\n'",
+                  "cat %s" % BOOT_ID],
+        timeout=120)
+    facts = {"release": "", "release_major": None,
+             "arch": arch.output.strip(), "kernel": kernel.output.strip(),
+             "rpms": {}, "boot_id": boot_id.output.strip() or None}
+    if release.status == 0:
+        facts["release"] = release.output.strip()
+        match = re.search(r"release (\d+)", facts["release"])
+        if match:
+            facts["release_major"] = match.group(1)
+    for line in rpms.output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            facts["rpms"][fields[0]] = fields[1]
+    return facts
+
+
+def _facts_token(vm, boot_id):
+    # Changes whenever the VM is recreated, its qemu process is replaced
+    # (e.g. by migration) or the guest reboots
+    if not boot_id:
+        return None
+    try:
+        return (vm.instance, vm.get_pid(), boot_id)
+    except Exception:
+        return None
+
+
+def _boot_id(session):
+    return session.cmd_output("cat %s 2>/dev/null" % BOOT_ID).strip()
+
+
+def get_guest_facts(vm, session=None):
+    """
+    Return facts about a linux VM, probing it only once per boot.
+
+    The facts are attached to the VM object and dropped when the VM is
+    recreated, migrated or the guest reboots, which costs one round trip
+    to read the boot id. Call drop_guest_facts() after changing its
+    packages.
+
+    :param vm: VM object
+    :param session: ssh session of the VM, leased from the pool if None
+    :return: dict as returned by probe_guest_facts()
+    """
+    leased = session is None
+    if leased:
+        session = lease_session(vm)
+    try:
+        cached = getattr(vm, "spice_guest_facts", None)
+        if cached and cached[0] is not None:
+            if cached[0] == _facts_token(vm, _boot_id(session)):
+                return cached[1]
+        facts = probe_guest_facts(session)
+    finally:
+        if leased:
+            release_session(session)
+    logging.info("%s: %s (%s)", vm.name, facts["release"], facts["arch"])
+    vm.spice_guest_facts = (_facts_token(vm, facts["boot_id"]), facts)
+    return facts
+
+
+def drop_guest_facts(vm):
+    """
+    Forget the cached facts of a VM.
+
+    :param vm: VM object
+    """
+    vm.spice_guest_facts = None
+
+
+def get_rv_version(client_vm, session, rv_binary, ld_library_path=None):
+    """
+    Return the versions of remote-viewer and spice-gtk on a client VM.
+
+    The versions are probed once per client VM, binary, LD_LIBRARY_PATH and
+    modification time of the binary (Windows clients: binary and
+    LD_LIBRARY_PATH only); the result is attached to the VM. Call
+    drop_rv_versions() after replacing the libraries only, or the binary
+    of a Windows client.
+
+    :param client_vm: client VM object
+    :param session: session of the client VM
+    :param rv_binary: remote-viewer binary
+    :param ld_library_path: LD_LIBRARY_PATH remote-viewer runs with
+    :return: dict with keys binary, ld_library_path, mtime, rv_version and
+             spice_gtk_version
+    """
+    prefix = ""
+    if ld_library_path:
+        prefix = "LD_LIBRARY_PATH=%s " % ld_library_path
+    windows = client_vm.params.get("os_type") == "windows"
+    mtime = None
+    if not windows:
+        mtime = session.cmd_output("stat -L -c %%Y $(command -v %s) "
+                                   "2>/dev/null" % rv_binary).strip() or None
+
+    cache = getattr(client_vm, "spice_rv_versions", None)
+    if cache is None:
+        cache = client_vm.spice_rv_versions = {}
+    key = (rv_binary, ld_library_path)
+    if ((windows or mtime is not None) and key in cache and
+            cache[key][0] == mtime):
+        return cache[key][1]
+
+    rv_version = session.cmd(prefix + rv_binary + " -V")
+    gtk_version = session.cmd(prefix + rv_binary + " --spice-gtk-version")
+    versions = {"binary": rv_binary, "ld_library_path": ld_library_path,
+                "mtime": mtime, "rv_version": rv_version.strip(),
+                "spice_gtk_version": gtk_version.strip()}
+    cache[key] = (mtime, versions)
+    return versions
+
+
+def drop_rv_versions(vm):
+    """
+    Forget the cached remote-viewer versions of a VM.
+
+    :param vm: VM object
+    """
+    vm.spice_rv_versions = None
+
+
+def write_results_json(test, name, data):
+    """
+    Store data as name.json in the results directory of the test.
+
+    :param test: QEMU test object.
+    :param name: name of the file without extension
+    :param data: JSON serializable data
+    """
+    out = open(os.path.join(test.resultsdir, name + ".json"), "w")
+    try:
+        json.dump(data, out, indent=2)
+    finally:
+        out.close()
+
+
 def kill_app(vm_name, app_name, params, env):
     """
     Kill selected app on selected VM
@@ -47,8 +1005,8 @@ def kill_app(vm_name, app_name, params, env):
     vm = env.get_vm(params[vm_name])
 
     vm.verify_alive()
-    vm_session = vm.wait_for_login(
-        timeout=int(params.get("login_timeout", 360)))
+    vm_session = lease_session(vm,
+                               timeout=int(params.get("login_timeout", 360)))
 
     logging.info("Try to kill %s", app_name)
     if vm.params.get("os_type") == "linux":
@@ -58,57 +1016,713 @@ def kill_app(vm_name, app_name, params, env):
         vm_session.cmd_output("taskkill /F /IM %s" % app_name
                               .split('\\')[-1])
     vm.verify_alive()
-    vm_session.close()
+    release_session(vm_session)
 
 
-def verify_established(client_vm, host, port, rv_binary,
-                       tls_port=None, secure_channels=None):
+ProcStats = collections.namedtuple("ProcStats", ["rss_kb", "fds",
+                                                 "threads"])
+
+
+def parse_proc_status(status, fds):
     """
-    Parses netstat output for established connection on host:port
-    :param client_session - vm.wait_for_login()
-    :param host - host ip addr
-    :param port - port for client to connect
-    :param rv_binary - remote-viewer binary
+    Build ProcStats out of /proc/<pid>/status content and an FD count.
+
+    :param status: content of /proc/<pid>/status
+    :param fds: number of open file descriptors
     """
-    rv_binary = rv_binary.split(os.path.sep)[-1]
+    fields = {}
+    for line in status.splitlines():
+        key, _, value = line.partition(":")
+        fields[key.strip()] = value.split()
+    return ProcStats(int(fields.get("VmRSS", ["0"])[0]), int(fds),
+                     int(fields.get("Threads", ["0"])[0]))
 
-    client_session = client_vm.wait_for_login(timeout=60)
-    tls_count = 0
 
-    # !!! -n means do not resolve port names
-    if ".exe" in rv_binary:
-        cmd = "netstat -n"
+def host_process_stats(pid):
+    """
+    Return ProcStats of a process running on the host.
+
+    :param pid: PID of the process, e.g. vm.get_pid()
+    """
+    status = open("/proc/%s/status" % pid)
+    try:
+        content = status.read()
+    finally:
+        status.close()
+    return parse_proc_status(content, len(os.listdir("/proc/%s/fd" % pid)))
+
+
+def vm_process_stats(session, name):
+    """
+    Return ProcStats of the oldest process of the given name in a linux VM,
+    None when no such process runs.
+
+    :param session: session of the VM
+    :param name: exact process name
+    """
+    mark = "--- fds ---"
+    output = session.cmd_output("pid=$(pgrep -xo %s) && "
+                                "cat /proc/$pid/status && echo '%s' && "
+                                "ls /proc/$pid/fd | wc -l" % (name, mark))
+    if mark not in output:
+        return None
+    status, fds = output.split(mark)
+    return parse_proc_status(status, fds.strip())
+
+
+def vm_peak_rss(session, names, reset=False, owners=None):
+    """
+    Return the peak RSS (VmHWM) of the oldest process of each name in a
+    linux VM, in a single round trip. Processes with an owner given in
+    owners are only looked for among those of the owner, e.g. the
+    spice-vdagent of the desktop user rather than the one of the gdm
+    greeter.
+
+    With reset the peaks are reset after being read (Linux 4.0 and newer,
+    the session needs to own the processes), so the next call returns the
+    peaks reached in between instead of those over the process lifetime.
+
+    :param session: session of the VM
+    :param names: list of exact process names
+    :param reset: reset the peaks after reading them
+    :param owners: dict mapping names to the users owning the processes
+    :return: tuple (dict mapping names to kB or None when the process does
+             not run, True when all running processes had their peak reset)
+    """
+    commands = []
+    for name in names:
+        pgrep = "pgrep -xo %s" % name
+        if owners and owners.get(name):
+            pgrep = "pgrep -xo -u %s %s" % (owners[name], name)
+        command = ("p=$(%s); if [ -n \"$p\" ]; then "
+                   "h=$(awk '/^VmHWM/ {print $2}' /proc/$p/status); r=-; "
+                   % pgrep)
+        if reset:
+            command += "echo 5 2>/dev/null > /proc/$p/clear_refs && r=ok; "
+        command += ("echo \"%s $h $r\"; else echo \"%s - -\"; fi"
+                    % (name, name))
+        commands.append(command)
+    output = session.cmd_output("; ".join(commands))
+    peaks = dict((name, None) for name in names)
+    was_reset = reset
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 3 or fields[0] not in peaks:
+            continue
+        if fields[1].isdigit():
+            peaks[fields[0]] = int(fields[1])
+            was_reset = was_reset and fields[2] == "ok"
+    return peaks, was_reset
+
+
+def growth(series, warmup=0, monotonic=0.9):
+    """
+    Return how much a series grew after the warm-up when it grew (almost)
+    monotonically, 0 otherwise.
+
+    :param series: list of samples
+    :param warmup: number of leading samples to be ignored
+    :param monotonic: minimal ratio of steps which must not decrease
+    """
+    window = series[warmup:]
+    if len(window) < 2:
+        return 0
+    steps = [later - earlier for earlier, later in zip(window, window[1:])]
+    rising = len([step for step in steps if step >= 0])
+    if rising < monotonic * len(steps):
+        return 0
+    return max(window[-1] - window[0], 0)
+
+
+TCPConnection = collections.namedtuple("TCPConnection",
+                                       ["local_host", "local_port",
+                                        "remote_host", "remote_port",
+                                        "state", "inode", "pid"])
+
+# Socket states as used by /proc/net/tcp (include/net/tcp_states.h)
+TCP_STATES = {1: "ESTABLISHED", 2: "SYN_SENT", 3: "SYN_RECV",
+              4: "FIN_WAIT1", 5: "FIN_WAIT2", 6: "TIME_WAIT", 7: "CLOSE",
+              8: "CLOSE_WAIT", 9: "LAST_ACK", 10: "LISTEN", 11: "CLOSING"}
+
+_OWNERS_MARK = "--- spice socket owners ---"
+
+
+def normalize_host(host):
+    """
+    Strip brackets and the IPv4-mapped IPv6 prefix from a host address so
+    it can be compared with addresses read from the socket table.
+
+    :param host: host address, e.g. "[::ffff:10.0.0.1]"
+    """
+    host = host.strip("[]")
+    if host.lower().startswith("::ffff:") and "." in host:
+        host = host[len("::ffff:"):]
+    return host
 
+
+def _decode_proc_address(address):
+    host, port = address.split(":")
+    if len(host) == 8:
+        packed = struct.pack("<I", int(host, 16))
+        host = socket.inet_ntop(socket.AF_INET, packed)
     else:
-        cmd = ('(netstat -pn 2>&1| grep "^tcp.*:.*%s.*ESTABLISHED.*%s.*")' %
-               (host, rv_binary))
-    netstat_out = client_session.cmd_output(cmd)
-    logging.info("netstat output: %s", netstat_out)
+        packed = "".join(struct.pack("<I", int(host[i:i + 8], 16))
+                         for i in range(0, 32, 8))
+        host = socket.inet_ntop(socket.AF_INET6, packed)
+    return normalize_host(host), int(port, 16)
 
-    if tls_port:
-        tls_count = netstat_out.count(tls_port)
+
+def parse_proc_net_tcp(output, owners=None):
+    """
+    Parse the content of /proc/net/tcp and /proc/net/tcp6.
+
+    :param output: content of the socket tables, header lines are skipped
+    :param owners: dict mapping socket inodes to PIDs of their owners
+    :return: list of TCPConnection records
+    """
+    owners = owners or {}
+    connections = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 10 or not fields[0].endswith(":"):
+            continue
+        local_host, local_port = _decode_proc_address(fields[1])
+        remote_host, remote_port = _decode_proc_address(fields[2])
+        state = TCP_STATES.get(int(fields[3], 16), fields[3])
+        inode = int(fields[9])
+        connections.append(TCPConnection(local_host, local_port,
+                                         remote_host, remote_port,
+                                         state, inode, owners.get(inode)))
+    return connections
+
+
+def parse_socket_owners(output):
+    """
+    Parse "<pid> <inode>" lines into a dict mapping inodes to PIDs.
+
+    :param output: output of the socket owners listing
+    """
+    owners = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+            owners[int(fields[1])] = int(fields[0])
+    return owners
+
+
+def parse_netstat_windows(output):
+    """
+    Parse the TCP part of "netstat -n" output of a Windows VM.
+
+    :param output: netstat output
+    :return: list of TCPConnection records
+    """
+    connections = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 4 or fields[0] != "TCP":
+            continue
+        local_host, local_port = fields[1].rsplit(":", 1)
+        remote_host, remote_port = fields[2].rsplit(":", 1)
+        connections.append(TCPConnection(normalize_host(local_host),
+                                         int(local_port),
+                                         normalize_host(remote_host),
+                                         int(remote_port),
+                                         fields[3], None, None))
+    return connections
+
+
+def get_tcp_connections(client_session, rv_binary):
+    """
+    Read the TCP socket table of the client together with the sockets
+    owned by rv_binary in a single round trip.
+
+    :param client_session: session to the client VM
+    :param rv_binary: remote-viewer binary
+    :return: tuple (list of TCPConnection records, set of rv_binary PIDs
+             or None when the owners are not known)
+    """
+    rv_binary = rv_binary.split(os.path.sep)[-1]
+    if ".exe" in rv_binary:
+        # !!! -n means do not resolve port names
+        output = client_session.cmd_output("netstat -n")
+        return parse_netstat_windows(output), None
+
+    cmd = ("cat /proc/net/tcp /proc/net/tcp6 2>/dev/null; echo '%s'; "
+           "for pid in $(pgrep -x %s); do ls -l /proc/$pid/fd 2>/dev/null | "
+           "sed -n \"s/.*socket:\\[\\([0-9]*\\)\\]$/$pid \\1/p\"; done" %
+           (_OWNERS_MARK, rv_binary))
+    output = client_session.cmd_output(cmd)
+    table, _, owners = output.partition(_OWNERS_MARK)
+    owners = parse_socket_owners(owners)
+    return parse_proc_net_tcp(table, owners), set(owners.values())
+
+
+def _check_established(connections, rv_pids, host, port, tls_port):
+    """
+    Check the SPICE connections of remote-viewer in the socket table.
+
+    :return: tuple (error message or None, plain count, TLS count)
+    """
+    spice_ports = set([port, tls_port])
+    channels = [conn for conn in connections
+                if conn.remote_host == host and
+                conn.remote_port in spice_ports and
+                (rv_pids is None or conn.pid in rv_pids)]
+    for conn in channels:
+        logging.debug("Client socket: %s", conn)
+    established = [conn for conn in channels if conn.state == "ESTABLISHED"]
+    plain_count = len([conn for conn in established
+                       if conn.remote_port == port])
+    tls_count = len([conn for conn in established
+                     if tls_port and conn.remote_port == tls_port])
+
+    if not established:
+        return ("Failed to get established connection", plain_count,
+                tls_count)
+    if len(established) != len(channels):
+        return ("Not all connections are established", plain_count,
+                tls_count)
+    if plain_count + tls_count < 4:
+        return ("Not enough channels were open", plain_count, tls_count)
+    return None, plain_count, tls_count
+
+
+def get_qmp_monitor(vm):
+    """
+    Return the first QMP monitor of a VM, None if it has none.
+
+    :param vm: VM object
+    """
+    for monitor in getattr(vm, "monitors", None) or []:
+        if isinstance(monitor, qemu_monitor.QMPMonitor):
+            return monitor
+    return None
+
+
+def _us_keymap():
+    keymap = {" ": ("spc", False), "\t": ("tab", False),
+              "\n": ("ret", False)}
+    for char in "abcdefghijklmnopqrstuvwxyz":
+        keymap[char] = (char, False)
+        keymap[char.upper()] = (char, True)
+    for char in "0123456789":
+        keymap[char] = (char, False)
+    # Unshifted and shifted character of the remaining keys of a US keyboard
+    for key, plain, shifted in (("1", None, "!"), ("2", None, "@"),
+                                ("3", None, "#"), ("4", None, "$"),
+                                ("5", None, "%"), ("6", None, "^"),
+                                ("7", None, "&"), ("8", None, "*"),
+                                ("9", None, "("), ("0", None, ")"),
+                                ("minus", "-", "_"), ("equal", "=", "+"),
+                                ("bracket_left", "[", "{"),
+                                ("bracket_right", "]", "}"),
+                                ("backslash", "\\", "|"),
+                                ("semicolon", ";", ":"),
+                                ("apostrophe", "'", '"'),
+                                ("grave_accent", "`", "~"),
+                                ("comma", ",", "<"), ("dot", ".", ">"),
+                                ("slash", "/", "?")):
+        if plain:
+            keymap[plain] = (key, False)
+        keymap[shifted] = (key, True)
+    return keymap
+
+
+# Printable ASCII character -> (QKeyCode name, shift needed) on a US layout
+US_KEYMAP = _us_keymap()
+
+# Characters typed by one input-send-event command. Keeps the events of a
+# batch within the 16 byte queue of the emulated PS/2 keyboard.
+TYPE_BATCH = 4
+
+
+def string_to_keys(text):
+    """
+    Translate text to the list of (QKeyCode name, shift) pairs typing it.
+
+    :param text: text to be typed, printable ASCII only
+    :raise error.TestError: when text contains a character without a key
+    """
+    try:
+        return [US_KEYMAP[char] for char in text]
+    except KeyError, details:
+        raise error.TestError("Character %r can't be typed on a US "
+                              "keyboard" % details.args[0])
+
+
+def _key_events(keys):
+    events = []
+
+    def _event(name, down):
+        events.append({"type": "key",
+                       "data": {"down": down,
+                                "key": {"type": "qcode", "data": name}}})
+
+    for name, shift in keys:
+        if shift:
+            _event("shift", True)
+        _event(name, True)
+        _event(name, False)
+        if shift:
+            _event("shift", False)
+    return events
+
+
+def type_string(vm, text, enter=True, delay=0.01):
+    """
+    Type text on the keyboard of a VM.
+
+    With a QMP monitor the text is sent by batched input-send-event
+    commands, TYPE_BATCH characters each, paced by delay. Older qemu gets
+    one QMP send-key per character, VMs without QMP one vm.send_key() per
+    character.
+
+    :param vm: VM object
+    :param text: text to be typed, printable ASCII only
+    :param enter: press enter (keypad) after the text
+    :param delay: pause between two batches in seconds
+    """
+    keys = string_to_keys(text)
+    monitor = get_qmp_monitor(vm)
+    start = time.time()
+    if monitor is None:
+        for name, shift in keys:
+            if shift:
+                name = "shift-" + name
+            vm.send_key(name)
+        if enter:
+            vm.send_key("kp_enter")
+        logging.debug("Typed %d characters by send_key in %.2fs", len(text),
+                      time.time() - start)
+        return
+
+    if enter:
+        keys.append(("kp_enter", False))
+    batches = [keys[i:i + TYPE_BATCH]
+               for i in xrange(0, len(keys), TYPE_BATCH)]
+    command = None
+    for command in ("input-send-event", "x-input-send-event"):
+        try:
+            monitor.cmd(command, {"events": _key_events(batches[0])})
+            break
+        except qemu_monitor.QMPCmdError:
+            command = None
+    if command is None:
+        for name, shift in keys:
+            names = [name]
+            if shift:
+                names.insert(0, "shift")
+            monitor.cmd("send-key", {"keys": [{"type": "qcode", "data": key}
+                                              for key in names]})
     else:
-        tls_port = port
+        for batch in batches[1:]:
+            time.sleep(delay)
+            monitor.cmd(command, {"events": _key_events(batch)})
+    logging.debug("Typed %d characters by %s in %.2fs", len(text),
+                  command or "send-key", time.time() - start)
 
-    if (netstat_out.count(port) + tls_count) < 4:
-        logging.error("Not enough channels were open")
-        raise RVConnectError()
+
+# SpiceChannel "channel-type" values reported in QMP events
+SPICE_CHANNEL_TYPES = {1: "main", 2: "display", 3: "inputs", 4: "cursor",
+                       5: "playback", 6: "record", 7: "tunnel",
+                       8: "smartcard", 9: "usbredir", 10: "port",
+                       11: "webdav"}
+
+
+SpiceServerInfo = collections.namedtuple("SpiceServerInfo",
+                                         ["enabled", "migrated", "host",
+                                          "port", "tls_port", "auth",
+                                          "mouse_mode", "channels"])
+
+SpiceChannelInfo = collections.namedtuple("SpiceChannelInfo",
+                                          ["host", "port", "family", "tls",
+                                           "channel", "channel_id",
+                                           "connection_id"])
+
+
+def _split_address(address):
+    host, _, port = address.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def parse_info_spice(output):
+    """
+    Parse the output of the human monitor command "info spice".
+
+    :param output: output of "info spice"
+    :return: SpiceServerInfo
+    """
+    server = {"enabled": True, "migrated": False, "host": None,
+              "port": None, "tls_port": None, "auth": None,
+              "mouse_mode": None}
+    channels = []
+    channel = None
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(": ")
+        value = value.strip()
+        if line.strip() == "Server: disabled":
+            server["enabled"] = False
+        elif line.strip() == "Channel:":
+            channel = {"host": None, "port": None, "family": None,
+                       "tls": False, "channel": None, "channel_id": None,
+                       "connection_id": None}
+            channels.append(channel)
+        elif key == "address":
+            tls = value.endswith("[tls]")
+            host, port = _split_address(value.replace("[tls]", "").strip())
+            if channel is not None:
+                channel.update(host=host, port=port, tls=tls,
+                               family="ipv6" if ":" in host else "ipv4")
+            else:
+                server["host"] = host
+                server["tls_port" if tls else "port"] = port
+        elif key == "session" and channel is not None:
+            channel["connection_id"] = int(value)
+        elif key == "channel" and channel is not None:
+            chtype, _, chid = value.partition(":")
+            channel["channel"] = SPICE_CHANNEL_TYPES.get(int(chtype),
+                                                         int(chtype))
+            channel["channel_id"] = int(chid)
+        elif key == "migrated" and channel is None:
+            server["migrated"] = value == "true"
+        elif key == "auth":
+            server["auth"] = value
+        elif key == "mouse-mode":
+            server["mouse_mode"] = value
+    server["channels"] = [SpiceChannelInfo(**item) for item in channels]
+    return SpiceServerInfo(**server)
+
+
+def query_spice(vm):
+    """
+    Return the state of the SPICE server of a VM.
+
+    Uses query-spice on the QMP monitor when the VM has one, which is cheap
+    enough to be polled during migration, "info spice" on the main monitor
+    otherwise.
+
+    :param vm: VM object
+    :return: SpiceServerInfo with a SpiceChannelInfo per open channel
+    """
+    monitor = get_qmp_monitor(vm)
+    if monitor is None:
+        return parse_info_spice(vm.monitor.cmd("info spice"))
+
+    data = monitor.cmd("query-spice", debug=False)
+    channels = []
+    for item in data.get("channels", []):
+        chtype = item.get("channel-type")
+        channels.append(SpiceChannelInfo(
+            item.get("host", "").strip("[]"), int(item.get("port", 0)),
+            item.get("family"), item.get("tls", False),
+            SPICE_CHANNEL_TYPES.get(chtype, chtype), item.get("channel-id"),
+            item.get("connection-id")))
+    return SpiceServerInfo(data.get("enabled", False),
+                           data.get("migrated", False), data.get("host"),
+                           data.get("port"), data.get("tls-port"),
+                           data.get("auth"), data.get("mouse-mode"),
+                           channels)
+
+
+def check_spice_channels(info, secure_channels=None, tls=False,
+                         min_channels=4):
+    """
+    Check the channels the SPICE server reports as connected.
+
+    :param info: SpiceServerInfo as returned by query_spice()
+    :param secure_channels: comma separated list of channels which have to
+                            use TLS, e.g. params["spice_secure_channels"]
+    :param tls: True when the client connected to the TLS port
+    :param min_channels: minimal number of connected channels
+    :return: error message or None when the channels are fine
+    """
+    channels = info.channels
+    secure = [channel for channel in channels if channel.tls]
+    logging.info("SPICE server reports %d channels, %d over TLS",
+                 len(channels), len(secure))
+    if len(channels) < min_channels:
+        return "Not enough channels were open"
     if secure_channels:
-        if tls_count < len(secure_channels.split(',')):
-            logging.error("Not enough secure channels open")
-            raise RVConnectError()
-    for line in netstat_out.split('\n'):
-        if ((port in line and "ESTABLISHED" not in line) or
-                (tls_port in line and "ESTABLISHED" not in line)):
-            logging.error("Failed to get established connection from netstat")
-            raise RVConnectError()
-    if "ESTABLISHED" not in netstat_out:
-        logging.error("Failed to get established connection from netstat")
-        raise RVConnectError()
+        wanted = set(name.strip() for name in secure_channels.split(",")
+                     if name.strip())
+        plain = set(channel.channel for channel in channels
+                    if not channel.tls)
+        if wanted & plain:
+            return ("Channels %s are not secure" %
+                    ", ".join(sorted(wanted & plain)))
+        if len(secure) < len(wanted):
+            return "Not enough secure channels open"
+    if not tls and secure:
+        return "TLS channels open without a TLS connection"
+    return None
+
+
+class SpiceEventBus(object):
+
+    """
+    Wait for the SPICE_* events emitted by qemu on a QMP monitor of a VM.
+
+    Events are matched by their timestamp, so callers take a mark() before
+    triggering a connection and wait for events newer than that mark. The
+    events stay in the monitor, other consumers are not affected.
+    """
+
+    def __init__(self, vm):
+        """
+        :param vm: VM object running the SPICE server
+        """
+        self.vm = vm
+        self.monitor = get_qmp_monitor(vm)
+        if self.monitor is None:
+            logging.debug("%s has no QMP monitor, SPICE events are not "
+                          "available", vm.name)
+
+    @property
+    def available(self):
+        """True when the VM has a QMP monitor to receive events from."""
+        return self.monitor is not None
+
+    @staticmethod
+    def mark():
+        """
+        Return a mark to be passed as since= to the waiting methods.
+        """
+        return time.time()
+
+    @staticmethod
+    def timestamp(event):
+        """
+        Return the time an event was emitted, comparable with time.time().
+        """
+        stamp = event.get("timestamp", {})
+        return stamp.get("seconds", 0) + stamp.get("microseconds", 0) / 1e6
+
+    @staticmethod
+    def channel(event):
+        """
+        Return (channel name, channel id) of a SPICE event.
+        """
+        client = event.get("data", {}).get("client", {})
+        chtype = client.get("channel-type")
+        return (SPICE_CHANNEL_TYPES.get(chtype, chtype),
+                client.get("channel-id"))
+
+    def events(self, names=None, since=0):
+        """
+        Return the SPICE events received so far.
+
+        :param names: list of event names, all SPICE events if None
+        :param since: only events newer than this mark are returned
+        """
+        if not self.available:
+            return []
+        result = []
+        for event in self.monitor.get_events():
+            name = event.get("event", "")
+            if names is None:
+                if not name.startswith("SPICE_"):
+                    continue
+            elif name not in names:
+                continue
+            if self.timestamp(event) >= since:
+                result.append(event)
+        return result
+
+    def wait_for(self, names, timeout, since=0, check=None, text=None):
+        """
+        Wait until the events received since the mark satisfy check.
+
+        :param names: event name or list of event names to be collected
+        :param timeout: deadline in seconds
+        :param since: mark taken before the connection was triggered
+        :param check: predicate on the list of collected events, by default
+                      any matching event is enough
+        :param text: description of the condition, used for logging
+        :return: list of collected events, None when the deadline passed
+        """
+        if isinstance(names, str):
+            names = [names]
+        if check is None:
+            check = bool
+        result = {}
+
+        def _collected():
+            result["events"] = self.events(names, since)
+            return check(result["events"])
+
+        done, _ = wait_for_condition(_collected, timeout, step=0.05,
+                                     max_step=0.5, text=text)
+        if not done:
+            return None
+        return result["events"]
+
+    def wait_for_channels(self, channels, timeout, since=0):
+        """
+        Wait until all given channels report SPICE_INITIALIZED.
+
+        :param channels: list of channel names, e.g. ["main", "display"]
+        :param timeout: deadline in seconds
+        :param since: mark taken before the connection was triggered
+        :return: set of initialized channel names, None on timeout
+        """
+        wanted = set(channels)
+
+        def _initialized(events):
+            return wanted <= set(self.channel(event)[0] for event in events)
+
+        events = self.wait_for("SPICE_INITIALIZED", timeout, since,
+                               _initialized,
+                               "Waiting for SPICE channels %s of %s"
+                               % (", ".join(sorted(wanted)), self.vm.name))
+        if events is None:
+            return None
+        return set(self.channel(event)[0] for event in events)
+
+
+def verify_established(client_vm, host, port, rv_binary,
+                       tls_port=None, timeout=0):
+    """
+    Verifies remote-viewer has established connections to host:port
+    using the socket table of the client. Use check_spice_channels() to
+    verify which channels are secure.
+
+    :param client_vm - client VM object
+    :param host - host ip addr
+    :param port - port for client to connect
+    :param rv_binary - remote-viewer binary
+    :param tls_port - TLS port for client to connect
+    :param timeout - how long to poll for the connections, 0 checks once
+    :return: tuple (number of plain channels, number of TLS channels)
+    """
+    host = normalize_host(host)
+    port = int(port)
+    if tls_port:
+        tls_port = int(tls_port)
+    result = {}
+
+    def _verify():
+        connections, rv_pids = get_tcp_connections(client_session, rv_binary)
+        result["check"] = _check_established(connections, rv_pids, host,
+                                             port, tls_port)
+        return result["check"][0] is None
+
+    client_session = lease_session(client_vm, timeout=60)
+    try:
+        wait_for_condition(_verify, timeout,
+                           text="Waiting for SPICE channels to establish")
+    finally:
+        release_session(client_session)
+
+    err, plain_count, tls_count = result["check"]
+    logging.info("SPICE channels to %s: %d plain, %d TLS",
+                 host, plain_count, tls_count)
+    if err:
+        logging.error(err)
+        raise RVConnectError(err)
     logging.info("%s connection to %s:%s successful.",
                  rv_binary, host, port)
-
-    client_session.close()
+    return plain_count, tls_count
 
 
 def start_vdagent(guest_session, test_timeout):
@@ -130,7 +1744,10 @@ def start_vdagent(guest_session, test_timeout):
 
     logging.debug("------------ End of guest checking for Spice Vdagent"
                   " Daemon ------------")
-    wait_timeout(3)
+    wait_for_condition(lambda: is_service_active(guest_session,
+                                                 "spice-vdagentd"),
+                       min(test_timeout, SERVICE_TIMEOUT),
+                       text="Waiting for spice-vdagentd to start")
 
 
 def restart_vdagent(guest_session, test_timeout):
@@ -151,7 +1768,10 @@ def restart_vdagent(guest_session, test_timeout):
 
     logging.debug("------------ End of Spice Vdagent"
                   " Daemon  Restart ------------")
-    wait_timeout(3)
+    wait_for_condition(lambda: is_service_active(guest_session,
+                                                 "spice-vdagentd"),
+                       min(test_timeout, SERVICE_TIMEOUT),
+                       text="Waiting for spice-vdagentd to restart")
 
 
 def stop_vdagent(guest_session, test_timeout):
@@ -175,7 +1795,10 @@ def stop_vdagent(guest_session, test_timeout):
 
     logging.debug("------------ End of guest checking for Spice Vdagent"
                   " Daemon ------------")
-    wait_timeout(3)
+    wait_for_condition(lambda: is_process_gone(guest_session,
+                                               "spice-vdagentd"),
+                       min(test_timeout, SERVICE_TIMEOUT),
+                       text="Waiting for spice-vdagentd to stop")
 
 
 def verify_vdagent(guest_session, test_timeout):
@@ -192,7 +1815,6 @@ def verify_vdagent(guest_session, test_timeout):
     finally:
         logging.debug("----------- End of guest check to see if vdagent "
                       "package is available ------------")
-    wait_timeout(3)
 
 
 def get_vdagent_status(vm_session, test_timeout):
@@ -204,7 +1826,6 @@ def get_vdagent_status(vm_session, test_timeout):
     output = ""
     cmd = "service spice-vdagentd status"
 
-    wait_timeout(3)
     try:
         output = vm_session.cmd(
             cmd, print_func=logging.info, timeout=test_timeout)
@@ -216,7 +1837,6 @@ def get_vdagent_status(vm_session, test_timeout):
         print "Unexpected error:", sys.exc_info()[0]
         raise error.TestFail(
             "Failed attempting to get status of spice-vdagentd")
-    wait_timeout(3)
     return(output)
 
 
@@ -228,12 +1848,417 @@ def verify_virtio(guest_session, test_timeout):
     :param test_timeout: timeout time for the cmds
     """
     cmd = "ls /dev/virtio-ports/"
+    wait_for_condition(lambda: _cmd_succeeds(guest_session,
+                                             "test -n \"$(%s)\"" % cmd),
+                       min(test_timeout, SERVICE_TIMEOUT),
+                       text="Waiting for virtio-serial ports")
     try:
         guest_session.cmd(cmd, print_func=logging.info, timeout=test_timeout)
     finally:
         logging.debug("------------ End of guest check of the Virtio-Serial"
                       " Driver------------")
-    wait_timeout(3)
+
+
+# Prefix of the answer lines of cb_agent.py
+CB_AGENT_PREFIX = "CBAGENT"
+# Sessions wrapped by start_cb_agents() whose agents are still running
+_CB_AGENTS = []
+
+
+class ClipboardAgent(object):
+
+    """
+    Long running clipboard agent (cb_agent.py) inside a VM.
+
+    The agent is started once in a session of its own and runs the
+    clipboard scripts inside its interpreter, so GTK and X are initialized
+    only once. Commands are JSON lines on its stdin, answers JSON lines on
+    its stdout. Each command carries a sequence number echoed in its
+    answer, so a late answer to a timed out command is skipped.
+    """
+
+    def __init__(self, vm, params, timeout=None):
+        """
+        :param vm: VM object
+        :param params: Dictionary with the test parameters.
+        :param timeout: login timeout, defaults to vm's login_timeout
+        """
+        if timeout is None:
+            timeout = int(vm.params.get("login_timeout", 360))
+        dst_path = params.get("dst_dir", "guest_script")
+        agent = os.path.join(dst_path, params.get("cb_agent_script",
+                                                  "cb_agent.py"))
+        self.vm_name = vm.name
+        self._seq = 0
+        self.session = vm.wait_for_login(timeout=timeout)
+        self.session.cmd("export DISPLAY=:0.0")
+        self.session.sendline("%s %s" % (params.get("interpreter"), agent))
+        self._read(60)
+        logging.debug("Clipboard agent running on %s", self.vm_name)
+
+    def _read(self, timeout, seq=None):
+        pattern = r"^%s " % CB_AGENT_PREFIX
+        end = time.time() + timeout
+        while True:
+            _, output = self.session.read_until_last_line_matches(
+                [pattern], max(end - time.time(), 0.1))
+            for line in output.splitlines():
+                if not re.match(pattern, line):
+                    continue
+                answer = json.loads(line[len(CB_AGENT_PREFIX) + 1:])
+                if seq is None or answer.get("id") == seq:
+                    return answer
+                logging.debug("Skipping late clipboard agent answer %s on "
+                              "%s", answer.get("id"), self.vm_name)
+
+    def call(self, command, timeout=60, **args):
+        """
+        Send one command to the agent and return its answer.
+
+        :param command: name of the command
+        :param timeout: time to wait for the answer
+        :param args: arguments of the command
+        """
+        self._seq += 1
+        args["cmd"] = command
+        args["id"] = self._seq
+        self.session.sendline(json.dumps(args))
+        answer = self._read(timeout, self._seq)
+        if "error" in answer:
+            raise error.TestError("Clipboard agent on %s: %s"
+                                  % (self.vm_name, answer["error"]))
+        return answer
+
+    def run(self, script, argv, timeout=60):
+        """
+        Run a clipboard script inside the agent.
+
+        :param script: path of the script in the VM
+        :param argv: list of arguments of the script
+        :param timeout: time to wait for the script
+        :return: tuple (exit status, output)
+        """
+        answer = self.call("run", timeout, script=script, argv=argv)
+        return answer["status"], answer["output"]
+
+    def close(self):
+        """
+        Stop the agent and close its session.
+        """
+        try:
+            self.call("quit", timeout=10)
+        except Exception, err:
+            logging.debug("Clipboard agent on %s did not quit: %s",
+                          self.vm_name, err)
+        self.session.close()
+
+
+class ClipboardSession(object):
+
+    """
+    Session wrapper running clipboard script commands in a ClipboardAgent.
+
+    Commands starting with "<interpreter> <script>" for one of the given
+    scripts are run by the agent when passed to cmd(), cmd_output(),
+    cmd_status() or cmd_status_output(); everything else goes to the
+    wrapped session. Other ways of running the scripts (e.g. sendline())
+    bypass the agent.
+    """
+
+    def __init__(self, session, agent, interpreter, scripts):
+        """
+        :param session: session to the VM
+        :param agent: ClipboardAgent of the same VM
+        :param interpreter: interpreter the scripts are called with
+        :param scripts: paths of the scripts to be run by the agent
+        """
+        self.session = session
+        self.agent = agent
+        self._prefixes = [("%s %s" % (interpreter, script), script)
+                          for script in scripts]
+
+    def _run(self, cmd, timeout, print_func):
+        # (status, output) of a script run by the agent, None for other
+        # commands
+        for prefix, script in self._prefixes:
+            if cmd == prefix or cmd.startswith(prefix + " "):
+                argv = shlex.split(cmd[len(prefix):])
+                status, output = self.agent.run(script, argv, timeout)
+                if print_func:
+                    for line in output.splitlines():
+                        print_func(line)
+                return status, output
+        return None
+
+    def cmd(self, cmd, timeout=60, print_func=None, **kwargs):
+        result = self._run(cmd, timeout, print_func)
+        if result is None:
+            return self.session.cmd(cmd, timeout=timeout,
+                                    print_func=print_func, **kwargs)
+        if result[0]:
+            raise ShellCmdError(cmd, result[0], result[1])
+        return result[1]
+
+    def cmd_status_output(self, cmd, timeout=60, print_func=None,
+                          **kwargs):
+        result = self._run(cmd, timeout, print_func)
+        if result is None:
+            return self.session.cmd_status_output(
+                cmd, timeout=timeout, print_func=print_func, **kwargs)
+        return result
+
+    def cmd_output(self, cmd, timeout=60, print_func=None, **kwargs):
+        return self.cmd_status_output(cmd, timeout, print_func, **kwargs)[1]
+
+    def cmd_status(self, cmd, timeout=60, print_func=None, **kwargs):
+        return self.cmd_status_output(cmd, timeout, print_func, **kwargs)[0]
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def start_cb_agents(vms, sessions, params):
+    """
+    Start a clipboard agent for each VM and wrap its session.
+
+    :param vms: list of VM objects
+    :param sessions: list of sessions to the VMs, in the same order
+    :param params: Dictionary with the test parameters.
+    :return: list of ClipboardSession
+    """
+    dst_path = params.get("dst_dir", "guest_script")
+    scripts = [os.path.join(dst_path, params.get(name, default))
+               for name, default in (("guest_script", "cb.py"),
+                                     ("cb_status_script", "cb_status.py"))]
+    wrapped = []
+    try:
+        for vm, session in zip(vms, sessions):
+            agent = ClipboardAgent(vm, params)
+            wrapped.append(ClipboardSession(session, agent,
+                                            params.get("interpreter"),
+                                            scripts))
+    except Exception:
+        stop_cb_agents(wrapped)
+        raise
+    _CB_AGENTS.extend(wrapped)
+    return wrapped
+
+
+def stop_cb_agents(sessions):
+    """
+    Stop the clipboard agents of sessions returned by start_cb_agents().
+
+    :param sessions: list of ClipboardSession
+    """
+    for session in sessions:
+        if session in _CB_AGENTS:
+            _CB_AGENTS.remove(session)
+        session.agent.close()
+
+
+# Processes sampled by ProcessSampler unless told otherwise
+PROC_SAMPLER_NAMES = ["spice-vdagent", "spice-vdagentd", "remote-viewer",
+                      "Xorg"]
+
+_PROC_SAMPLERS = []
+
+
+class ProcessSampler(object):
+
+    """
+    Resource usage sampler (proc_sampler.py) of named processes in a linux
+    VM.
+
+    The sampler runs for the whole measured period in a session of its own
+    and writes a CSV file in the VM, so sampling does not cost a round
+    trip per sample. stop() fetches the time series into the results
+    directory of the test.
+    """
+
+    def __init__(self, vm, script, names=None, interval=1.0,
+                 username=None, password=None, timeout=None):
+        """
+        :param vm: VM object
+        :param script: local path of proc_sampler.py
+        :param names: list of process names, PROC_SAMPLER_NAMES by default
+        :param interval: seconds between samples
+        :param username: user to log in as, root sees descriptors of all
+                         processes
+        :param password: password of the user
+        :param timeout: login timeout, defaults to vm's login_timeout
+        """
+        if timeout is None:
+            timeout = int(vm.params.get("login_timeout", 360))
+        self.vm = vm
+        self.script = script
+        self.names = names or PROC_SAMPLER_NAMES
+        self.interval = interval
+        self.remote_script = "/tmp/%s" % os.path.basename(script)
+        self.output = "/tmp/proc_sampler.csv"
+        self.session = vm.wait_for_login(timeout=timeout, username=username,
+                                         password=password)
+        self.started = None
+
+    def start(self):
+        """
+        Deploy the sampler and start sampling.
+        """
+        deploy_vm_assets(self.vm, [(self.script, self.remote_script)],
+                         session=self.session)
+        self.session.sendline("python %s --interval %s --output %s %s"
+                              % (self.remote_script, self.interval,
+                                 self.output, " ".join(self.names)))
+        self.session.read_until_last_line_matches(
+            [r"^proc_sampler: started"], 30)
+        self.started = time.time()
+        _PROC_SAMPLERS.append(self)
+        logging.debug("Sampling %s on %s every %ss", ", ".join(self.names),
+                      self.vm.name, self.interval)
+
+    def _interrupt(self):
+        if self in _PROC_SAMPLERS:
+            _PROC_SAMPLERS.remove(self)
+        self.session.sendcontrol("c")
+        self.session.read_up_to_prompt(timeout=30)
+
+    def stop(self, test, name="proc_sampler"):
+        """
+        Stop sampling and save the time series as name_VM.csv and
+        name_VM.json into the results directory of the test.
+
+        :param test: QEMU test object.
+        :param name: name of the result files without the VM suffix
+        :return: dict mapping "name[pid]" of each sampled process to its
+                 summary
+        """
+        try:
+            self._interrupt()
+            base = os.path.join(test.resultsdir,
+                                "%s_%s" % (name, self.vm.name))
+            self.vm.copy_files_from(self.output, base + ".csv", timeout=60)
+        finally:
+            self.session.close()
+
+        rows = list(csv.DictReader(open(base + ".csv")))
+        processes = collections.OrderedDict()
+        for row in rows:
+            processes.setdefault("%s[%s]" % (row["name"], row["pid"]),
+                                 []).append(row)
+        summary = {}
+        for key, samples in processes.items():
+            first, last = samples[0], samples[-1]
+            elapsed = float(last["time"]) - float(first["time"])
+            cpu = float(last["cpu"]) - float(first["cpu"])
+            summary[key] = {
+                "samples": len(samples),
+                "seconds": elapsed,
+                "cpu_seconds": cpu,
+                "cpu_percent": cpu * 100 / elapsed if elapsed else None,
+                "rss_kb": summarize([int(row["rss"]) for row in samples]),
+                "max_fds": max(int(row["fds"]) for row in samples),
+                "voluntary_ctxt": (int(last["voluntary_ctxt"]) -
+                                   int(first["voluntary_ctxt"])),
+                "nonvoluntary_ctxt": (int(last["nonvoluntary_ctxt"]) -
+                                      int(first["nonvoluntary_ctxt"]))}
+            logging.info("%s on %s: %.1f%% CPU, max RSS %s kB, max %d fds, "
+                         "%d/%d context switches", key, self.vm.name,
+                         summary[key]["cpu_percent"] or 0,
+                         summary[key]["rss_kb"]["max"],
+                         summary[key]["max_fds"],
+                         summary[key]["voluntary_ctxt"],
+                         summary[key]["nonvoluntary_ctxt"])
+        write_results_json(test, "%s_%s" % (name, self.vm.name),
+                           {"vm": self.vm.name, "interval": self.interval,
+                            "names": self.names, "summary": summary,
+                            "samples": rows})
+        return summary
+
+    def close(self):
+        """
+        Stop sampling without saving the results.
+        """
+        try:
+            self._interrupt()
+        except Exception, err:
+            logging.debug("Process sampler on %s did not stop: %s",
+                          self.vm.name, err)
+        self.session.close()
+
+
+def start_process_samplers(vms, params, script):
+    """
+    Start a ProcessSampler in each linux VM when proc_sampler = yes.
+
+    :param vms: list of VM objects
+    :param params: Dictionary with the test parameters; proc_sampler_names
+                   and proc_sampler_interval tune the sampling
+    :param script: local path of proc_sampler.py
+    :return: list of started ProcessSampler, empty when disabled
+    """
+    if params.get("proc_sampler", "no") != "yes":
+        return []
+    names = params.get("proc_sampler_names", "").split() or None
+    interval = float(params.get("proc_sampler_interval", 1))
+    samplers = []
+    try:
+        for vm in vms:
+            if vm.params.get("os_type") == "windows":
+                logging.info("Process sampler skipped on windows VM %s",
+                             vm.name)
+                continue
+            sampler = ProcessSampler(
+                vm, script, names, interval,
+                params.get("proc_sampler_username", "root"),
+                params.get("proc_sampler_password", "123456"))
+            sampler.start()
+            samplers.append(sampler)
+    except Exception:
+        for sampler in samplers:
+            sampler.close()
+        raise
+    return samplers
+
+
+def sampled_test(run):
+    """
+    Decorator for the run() function of tests starting process samplers.
+
+    Samplers still running when the test ends are stopped and their
+    results saved, whether the test passed or not.
+    """
+    @functools.wraps(run)
+    def sampled_run(test, params, env):
+        try:
+            return run(test, params, env)
+        finally:
+            if _PROC_SAMPLERS:
+                try:
+                    stop_process_samplers(list(_PROC_SAMPLERS), test)
+                except error.TestError, err:
+                    logging.warning(err)
+    return sampled_run
+
+
+def stop_process_samplers(samplers, test, name="proc_sampler"):
+    """
+    Stop samplers returned by start_process_samplers() and save their
+    results.
+
+    :param samplers: list of ProcessSampler
+    :param test: QEMU test object.
+    :param name: name of the result files without the VM suffix
+    """
+    errors = []
+    for sampler in samplers:
+        try:
+            sampler.stop(test, name)
+        except Exception, err:
+            logging.error("Process sampler on %s failed: %s",
+                          sampler.vm.name, err)
+            errors.append(sampler.vm.name)
+    if errors:
+        raise error.TestError("Process samplers failed on %s"
+                              % ", ".join(errors))
 
 
 def install_rv_win(client, host_path, client_path='C:\\virt-viewer.msi'):
@@ -244,14 +2269,14 @@ def install_rv_win(client, host_path, client_path='C:\\virt-viewer.msi'):
     :param host_path:   Location of installer on host
     :param client_path: Location of installer after copying
     """
-    session = client.wait_for_login(
-        timeout=int(client.params.get("login_timeout", 360)))
+    session = lease_session(client)
     client.copy_files_to(host_path, client_path)
     try:
         session.cmd_output('start /wait msiexec /i ' + client_path +
                            ' INSTALLDIR="C:\\virt-viewer"')
     except:
         pass
+    release_session(session)
 
 
 def install_usbclerk_win(client, host_path, client_path="C:\\usbclerk.msi"):
@@ -262,100 +2287,160 @@ def install_usbclerk_win(client, host_path, client_path="C:\\usbclerk.msi"):
     :param host_path:   Location of installer on host
     :param client_path: Location of installer after copying
     """
-    session = client.wait_for_login(timeout=int(
-                                    client.params.get("login_timeout", 360)))
+    session = lease_session(client)
     client.copy_files_to(host_path, client_path)
     try:
         session.cmd_output("start /wait msiexec /i " + client_path + " /qn")
     except:
         pass
+    release_session(session)
 
 
-def clear_interface(vm, login_timeout=360, timeout=5):
+def clear_interface(vm, login_timeout=360, timeout=5,
+                    ready_timeout=DISPLAY_TIMEOUT):
     """
     Clears user interface of a vm without reboot
 
     :param vm:      VM where cleaning is required
+    :param login_timeout: timeout for logging into the VM
+    :param timeout: timeout for the old X/gdm to go away
+    :param ready_timeout: timeout for the desktop to come back
     """
 #   kill remote-viewer window if it is open
     if vm.params.get("os_type") == "windows":
-        session = vm.wait_for_login()
+        session = lease_session(vm)
         try:
             session.cmd("taskkill /F /IM remote-viewer.exe")
         except:
             logging.info("Remote-viewer not running")
+        release_session(session)
     else:
-        clear_interface_linux(vm, login_timeout, timeout)
+        clear_interface_linux(vm, login_timeout, timeout, ready_timeout)
+
+
+def clear_interfaces(vms, login_timeout=360, timeout=5,
+                     ready_timeout=DISPLAY_TIMEOUT):
+    """
+    Clears user interface of several vms at the same time.
 
+    Each VM is handled by its own thread, so the whole call takes as long
+    as the slowest VM needs to get its desktop back.
 
-def clear_interface_linux(vm, login_timeout, timeout):
+    :param vms: list of VMs where cleaning is required
+    :param login_timeout: timeout for logging into the VMs
+    :param timeout: timeout for the old X/gdm to go away
+    :param ready_timeout: timeout for the desktops to come back
+    """
+    threads = []
+    for vm in vms:
+        thread = utils.InterruptedThread(clear_interface,
+                                         (vm, login_timeout, timeout,
+                                          ready_timeout))
+        thread.start()
+        threads.append(thread)
+
+    errors = []
+    for thread in threads:
+        try:
+            thread.join()
+        except Exception:
+            errors.append(sys.exc_info())
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def _get_pids(session, pgrep_process):
+    return set(session.cmd_output("pgrep %s" % pgrep_process).split())
+
+
+def clear_interface_linux(vm, login_timeout, timeout,
+                          ready_timeout=DISPLAY_TIMEOUT):
     """
     Clears user interface of a vm without reboot
 
+    X/gdm is killed and the function returns once a new X/gdm process
+    exists and the display accepts connections again.
+
     :param vm:      VM where cleaning is required
+    :param login_timeout: timeout for logging into the VM
+    :param timeout: timeout for the old X/gdm to go away
+    :param ready_timeout: timeout for the desktop to come back
     """
     logging.info("restarting X/gdm on: %s", vm.name)
-    session = vm.wait_for_login(username="root", password="123456",
-                                timeout=login_timeout)
-
-    if "release 7" in session.cmd('cat /etc/redhat-release'):
-        command = "gdm"
-        pgrep_process = "'^gdm$'"
-    else:
-        command = "Xorg"
-        pgrep_process = "Xorg"
-
-    try:
-        pid = session.cmd("pgrep %s" % pgrep_process)
-        session.cmd("killall %s" % command)
-        utils_misc.wait_for(lambda: _is_pid_alive(session, pid), 10,
-                            timeout, 0.2)
-    except:
-        pass
+    session = lease_session(vm, username="root", password="123456",
+                            timeout=login_timeout)
+    user_session = lease_session(vm, timeout=login_timeout)
 
     try:
-        session.cmd("ps -C %s" % command)
-    except ShellCmdError:
-        raise error.TestFail("X/gdm not running")
+        if get_guest_facts(vm, session)["release_major"] == "7":
+            command = "gdm"
+            pgrep_process = "'^gdm$'"
+        else:
+            command = "Xorg"
+            pgrep_process = "Xorg"
+
+        old_pids = _get_pids(session, pgrep_process)
+        session.cmd_status("killall %s" % command)
+        wait_for_condition(
+            lambda: not old_pids & _get_pids(session, pgrep_process),
+            timeout, text="old %s to exit on %s" % (command, vm.name))
+
+        new_pids, waited = wait_for_condition(
+            lambda: _get_pids(session, pgrep_process) - old_pids,
+            ready_timeout, step=0.5,
+            text="new %s to start on %s" % (command, vm.name))
+        if not new_pids:
+            raise error.TestFail("X/gdm not running")
+        ready, waited = wait_for_condition(
+            lambda: is_display_ready(user_session),
+            max(ready_timeout - waited, 0), step=0.5,
+            text="display to accept connections on %s" % vm.name)
+        if not ready:
+            raise error.TestFail("Display of %s not ready after %ss"
+                                 % (vm.name, ready_timeout))
+    finally:
+        release_session(user_session)
+        release_session(session)
 
 
-def deploy_epel_repo(guest_session, params):
+def deploy_epel_repo(guest_session, params, vm=None):
     """
     Deploy epel repository to RHEL VM If It's RHEL6 or 5.
 
     :param guest_session - ssh session to guest VM
     :param params
+    :param vm - guest VM object, used to look up cached guest facts
     """
 
     # Check existence of epel repository
     try:
         guest_session.cmd("test -a /etc/yum.repos.d/epel.repo")
+        return
     except ShellCmdError:
-        arch = guest_session.cmd("arch")
-        if "i686" in arch:
-            arch = "i386"
-        else:
-            arch = arch[:-1]
-        if "release 5" in guest_session.cmd("cat /etc/redhat-release"):
-            cmd = ("yum -y localinstall http://download.fedoraproject.org/"
-                   "pub/epel/5/%s/epel-release-5-4.noarch.rpm 2>&1" % arch)
-            logging.info("Installing epel repository to %s",
-                         params.get("guest_vm"))
-            guest_session.cmd(cmd, print_func=logging.info, timeout=90)
-        elif "release 6" in guest_session.cmd("cat /etc/redhat-release"):
-            cmd = ("yum -y localinstall http://download.fedoraproject.org/"
-                   "pub/epel/6/%s/epel-release-6-8.noarch.rpm 2>&1" % arch)
-            logging.info("Installing epel repository to %s",
-                         params.get("guest_vm"))
-            guest_session.cmd(cmd, print_func=logging.info, timeout=90)
-        elif "release 7" in guest_session.cmd("cat /etc/redhat-release"):
-            cmd = ("yum -y localinstall http://download.bos.redhat.com/"
-                   "pub/epel/7/%s/e/epel-release-7-5.noarch.rpm 2>&1" % arch)
-            logging.info("Installing epel repository to %s",
-                         params.get("guest_vm"))
-            guest_session.cmd(cmd, print_func=logging.info, timeout=90)
-        else:
-            raise Exception("Unsupported RHEL guest")
+        pass
+
+    if vm:
+        facts = get_guest_facts(vm, guest_session)
+    else:
+        facts = probe_guest_facts(guest_session)
+    arch = facts["arch"]
+    if "i686" in arch:
+        arch = "i386"
+    release = facts["release"]
+    if "release 5" in release:
+        cmd = ("yum -y localinstall http://download.fedoraproject.org/"
+               "pub/epel/5/%s/epel-release-5-4.noarch.rpm 2>&1" % arch)
+    elif "release 6" in release:
+        cmd = ("yum -y localinstall http://download.fedoraproject.org/"
+               "pub/epel/6/%s/epel-release-6-8.noarch.rpm 2>&1" % arch)
+    elif "release 7" in release:
+        cmd = ("yum -y localinstall http://download.bos.redhat.com/"
+               "pub/epel/7/%s/e/epel-release-7-5.noarch.rpm 2>&1" % arch)
+    else:
+        raise Exception("Unsupported RHEL guest")
+    logging.info("Installing epel repository to %s",
+                 params.get("guest_vm"))
+    guest_session.cmd(cmd, print_func=logging.info, timeout=90)
 
 
 def gen_rv_file(params, guest_vm, host_subj=None, cacert=None):